@@ -0,0 +1,72 @@
+"""Re-encodes stored EE images with every codec and reports size, encode and decode time
+
+    python benchmarks/bench_codecs.py --limit 20
+    python benchmarks/bench_codecs.py --database data/ee_tiles.db --codecs png webp
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tkintermapviewforked.ee_codecs import EE_CODECS, decode_image_data, encode_image_data
+
+
+def load_images(path, limit):
+    db_connection = sqlite3.connect(path)
+    db_cursor = db_connection.cursor()
+    db_cursor.execute("SELECT id, image, codec FROM images ORDER BY id DESC LIMIT ?;", (limit,))
+    rows = db_cursor.fetchall()
+    db_connection.close()
+
+    images = []
+    for eeid, data, codec in rows:
+        image = decode_image_data(data, codec).convert("RGBA")
+        images.append((eeid, image, len(data)))
+    return images
+
+
+def run(args):
+    if args.database is None:
+        from constants import EE_DATABASE_PATH
+        args.database = EE_DATABASE_PATH
+
+    images = load_images(args.database, args.limit)
+    if not images:
+        print("There are no images in", args.database)
+        return
+
+    pixels = sum(image.size[0] * image.size[1] for _, image, _ in images)
+    stored = sum(size for _, _, size in images)
+    print(f"images           {len(images)}, {pixels / 1e6:.1f} Mpx, stored {stored / 1024 / 1024:.1f} MB")
+    print(f"{'codec':8} {'size MB':>9} {'ratio':>7} {'bits/px':>8} {'encode ms':>10} {'decode ms':>10}")
+
+    for codec in args.codecs:
+        size, encode_time, decode_time = 0, 0.0, 0.0
+        for _ in range(args.repeat):
+            size = 0
+            for _, image, _ in images:
+                started = time.perf_counter()
+                data = encode_image_data(image, codec)
+                encoded = time.perf_counter()
+                decode_image_data(data, codec).load()
+                decoded = time.perf_counter()
+
+                size += len(data)
+                encode_time += encoded - started
+                decode_time += decoded - encoded
+
+        runs = len(images) * args.repeat
+        print(f"{codec:8} {size / 1024 / 1024:9.2f} {size / stored:7.2f} {size * 8 / pixels:8.2f} "
+              f"{encode_time / runs * 1000:10.1f} {decode_time / runs * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=None, help="EE database, the one of the application if not set")
+    parser.add_argument("--limit", type=int, default=20, help="number of the newest images to encode")
+    parser.add_argument("--codecs", nargs="+", default=list(EE_CODECS), choices=EE_CODECS)
+    parser.add_argument("--repeat", type=int, default=1)
+    run(parser.parse_args())
@@ -0,0 +1,143 @@
+"""Runs the EE download pipeline end to end against the offline fake backend:
+download queue -> fetch -> crop -> store -> slice into tiles
+
+    python benchmarks/bench_ee_pipeline.py --grid 4 --size 1024x1024 --latency 0.2 --workers 4
+    python benchmarks/bench_ee_pipeline.py --grid 4 --size 4096x4096 --processes 2
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tkintermapviewforked.ee_backends import FakeBackend, fetch_chunk
+from tkintermapviewforked.ee_downloads import DownloadQueue, DownloadProgress, EEDownloader
+from tkintermapviewforked.ee_processing import ImageProcessPool, slice_image_to_tiles, store_downloaded_image
+from tkintermapviewforked.ee_scenes import SceneQueryCache
+from tkintermapviewforked.ee_storage import EEImageStore
+from tkintermapviewforked.tile_storage import insert_tiles, update_tiles_database
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def grid_regions(top, left, bottom, right, grid):
+    """ splits region into grid x grid chunks """
+    height = (top - bottom) / grid
+    width = (right - left) / grid
+    return [(top - row * height, left + column * width, top - (row + 1) * height, left + (column + 1) * width)
+            for row in range(grid) for column in range(grid)]
+
+
+def run(args):
+    folder = args.data or tempfile.mkdtemp(prefix="bench_ee_pipeline_")
+    # constants creates the app databases on import, they are created in the benchmark folder instead of data/
+    os.environ["ERA_DATABASES_FOLDER"] = folder
+    from constants import DATABASE_PATH as tiles_path, EE_DATABASE_PATH as ee_path
+    db_connection = sqlite3.connect(tiles_path)
+    update_tiles_database(db_connection.cursor())
+    db_connection.commit()
+    db_connection.close()
+
+    store = EEImageStore(ee_path)
+    queue = DownloadQueue(ee_path)
+    backend = FakeBackend(size=args.size, latency=args.latency, max_pixels=args.max_pixels, seed=args.seed,
+                          query_latency=args.query_latency, scene_cache=SceneQueryCache(ee_path))
+
+    pool = ImageProcessPool(args.processes) if args.processes else None
+    stage_times = {"store": 0.0, "slice": 0.0}
+    stage_lock = threading.Lock()
+
+    def process(chunk, result):
+        if result.image is None:
+            # Scene is already stored or nothing fits the filters
+            return result.eeid
+
+        started = time.perf_counter()
+        eeid, pilimage, region, _ = store_downloaded_image(store, chunk, result.image, scene_id=result.scene.id,
+                                                           pool=pool)
+        stored = time.perf_counter()
+
+        if args.zoom_to >= args.zoom_from:
+            if pilimage is None:
+                pilimage = store.get_image(eeid)
+            db_connection = sqlite3.connect(tiles_path, timeout=10)
+            insert_tiles(db_connection.cursor(), [(zoom, x, y, f"ee://{eeid}", tile) for zoom, x, y, tile in
+                                                  slice_image_to_tiles(pilimage, *region, (args.zoom_from, args.zoom_to))])
+            db_connection.commit()
+            db_connection.close()
+        sliced = time.perf_counter()
+
+        with stage_lock:
+            stage_times["store"] += stored - started
+            stage_times["slice"] += sliced - stored
+        return eeid
+
+    for run_number in range(args.repeat):
+        progress = DownloadProgress()
+        finished = threading.Event()
+        downloader = EEDownloader(queue, fetch=lambda chunk: fetch_chunk(backend, queue, chunk),
+                                  process=process, workers=args.workers)
+        downloader.add_listener(progress)
+        downloader.add_listener(lambda event: event["type"] == "idle" and finished.set())
+        downloader.start()
+
+        started = time.perf_counter()
+        downloader.add_job(grid_regions(45.0, 37.0, 45.0 - args.degrees, 37.0 + args.degrees, args.grid),
+                           "2023-06-01", "2023-06-30", args.cloudiness, args.visualized, args.scale)
+        finished.wait()
+        elapsed = time.perf_counter() - started
+
+        result = progress.snapshot()
+        print(f"run              {run_number + 1} of {args.repeat}")
+        print(f"backend          {backend.name}, latency {args.latency} s, size {args.size or 'from scale'}")
+        print(f"chunks           {result['done']} done, {result['failed']} failed, {result['planned']} planned")
+        print(f"wall time        {elapsed:.2f} s, {result['done'] / elapsed:.2f} chunks/s")
+        print(f"downloaded       {result['bytes'] / 1024 / 1024:.1f} MB, {result['bytes'] / 1024 / 1024 / elapsed:.1f} MB/s")
+        for stage, seconds in result["stage_times"].items():
+            print(f"{stage:16} {seconds * 1000:.1f} ms per chunk")
+        if result["done"]:
+            for stage, seconds in stage_times.items():
+                print(f"  {stage:14} {seconds / result['done'] * 1000:.1f} ms per chunk")
+            stage_times.update(store=0.0, slice=0.0)
+        print()
+
+    if pool is not None:
+        pool.shutdown()
+    print(f"ee database      {os.path.getsize(ee_path) / 1024 / 1024:.1f} MB")
+    print(f"tiles database   {os.path.getsize(tiles_path) / 1024 / 1024:.1f} MB")
+
+    if not args.keep and not args.data:
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+    else:
+        print("kept", folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", type=int, default=3, help="region is split into grid x grid chunks")
+    parser.add_argument("--degrees", type=float, default=0.1, help="side of the region in degrees")
+    parser.add_argument("--size", type=parse_size, default=None, help="WIDTHxHEIGHT of fetched arrays, from scale if not set")
+    parser.add_argument("--scale", type=float, default=10, help="meters per pixel")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fetch")
+    parser.add_argument("--query-latency", type=float, default=0.0, help="seconds per scenes query")
+    parser.add_argument("--repeat", type=int, default=1, help="request the same region again, stored scenes are skipped")
+    parser.add_argument("--max-pixels", type=int, default=None, help="larger chunks are split")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=0, help="encode in a pool of processes, 0 to encode in download threads")
+    parser.add_argument("--visualized", action="store_true", help="fetch 8 bit arrays")
+    parser.add_argument("--zoom-from", type=int, default=10)
+    parser.add_argument("--zoom-to", type=int, default=14, help="less than zoom-from to skip slicing")
+    parser.add_argument("--cloudiness", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary databases")
+    parser.add_argument("--data", default=None, help="folder of the databases, kept, a temporary one if not set")
+    run(parser.parse_args())
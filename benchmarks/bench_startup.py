@@ -0,0 +1,82 @@
+"""Measures startup time in fresh interpreters: importing tkintermapviewforked and showing App,
+exits with code 1 if a budget is exceeded or a heavy module is imported at startup
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 5 --import-budget 0.5 --app-budget 3 --no-app
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Needed only for authentication, search or downloads, they are imported on first use
+HEAVY_MODULES = ("ee", "geemap", "geocoder", "pyperclip")
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import tkintermapviewforked
+result = {{"import": time.perf_counter() - started,
+           "heavy": [name for name in {heavy!r} if name in sys.modules]}}
+if {app!r}:
+    import tkinter
+    try:
+        import main
+        main.before_start()
+        app = main.App()
+        app.update()
+        result["app"] = time.perf_counter() - started
+        result["heavy"] = [name for name in {heavy!r} if name in sys.modules]
+        app.destroy()
+    except tkinter.TclError as e:
+        result["app_error"] = str(e)
+print(json.dumps(result))
+"""
+
+
+def run_child(app):
+    code = CHILD.format(root=ROOT, heavy=HEAVY_MODULES, app=app)
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if output.returncode:
+        print(output.stderr)
+        raise SystemExit("Startup failed")
+    # The application prints to stdout as well, the result is the last line
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run(args):
+    results = [run_child(args.app) for _ in range(args.repeat)]
+    failed = False
+
+    import_time = min(result["import"] for result in results)
+    print(f"import tkintermapviewforked  {import_time:.3f} s (budget {args.import_budget} s)")
+    failed |= import_time > args.import_budget
+
+    if args.app:
+        app_times = [result["app"] for result in results if "app" in result]
+        if app_times:
+            print(f"App shown                    {min(app_times):.3f} s (budget {args.app_budget} s)")
+            failed |= min(app_times) > args.app_budget
+        else:
+            print("App was not started:", results[0].get("app_error"))
+
+    heavy = sorted({name for result in results for name in result["heavy"]})
+    if heavy:
+        print("Imported at startup:", ", ".join(heavy))
+        failed = True
+
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters to run, the fastest one counts")
+    parser.add_argument("--import-budget", type=float, default=1.0, help="seconds to import tkintermapviewforked")
+    parser.add_argument("--app-budget", type=float, default=5.0, help="seconds from the first import to shown App")
+    parser.add_argument("--no-app", dest="app", action="store_false", help="only measure the import")
+    sys.exit(run(parser.parse_args()))
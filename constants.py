@@ -1,9 +1,152 @@
+import json
 import os
 import sqlite3
 
 from datetime import date
 
 
+# Small pre-encoded images for the list of downloaded images
+THUMBNAILS_TABLE = """CREATE TABLE IF NOT EXISTS "thumbnails" (
+                        "id"	INTEGER NOT NULL UNIQUE,
+                        "thumbnail"	BLOB NOT NULL,
+                        PRIMARY KEY("id"),
+                        FOREIGN KEY("id") REFERENCES "images"("id")
+                );"""
+
+
+# Spatial-temporal index of stored images, dates are day numbers as in date.toordinal()
+IMAGES_INDEX_COMMANDS = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS "images_index" USING rtree(
+                        id,
+                        min_lat, max_lat,
+                        min_lon, max_lon,
+                        fday, lday,
+                        min_cloud, max_cloud
+                );""",
+
+    """CREATE TRIGGER IF NOT EXISTS "images_index_insert" AFTER INSERT ON "images" BEGIN
+                        INSERT INTO images_index VALUES (
+                            new.id,
+                            min(new.tlxd, new.brxd), max(new.tlxd, new.brxd),
+                            min(new.tlyd, new.bryd), max(new.tlyd, new.bryd),
+                            min(julianday(new.fdate), julianday(new.ldate)) - 1721424.5,
+                            max(julianday(new.fdate), julianday(new.ldate)) - 1721424.5,
+                            CAST(new.cloudiness AS INTEGER), CAST(new.cloudiness AS INTEGER));
+                END;""",
+
+    """CREATE TRIGGER IF NOT EXISTS "images_index_delete" AFTER DELETE ON "images" BEGIN
+                        DELETE FROM images_index WHERE id = old.id;
+                END;""",
+
+    # Index images saved before there was an index
+    """INSERT INTO images_index
+            SELECT id,
+                   min(tlxd, brxd), max(tlxd, brxd),
+                   min(tlyd, bryd), max(tlyd, bryd),
+                   min(julianday(fdate), julianday(ldate)) - 1721424.5,
+                   max(julianday(fdate), julianday(ldate)) - 1721424.5,
+                   CAST(cloudiness AS INTEGER), CAST(cloudiness AS INTEGER)
+              FROM images WHERE id NOT IN (SELECT id FROM images_index);""",
+)
+
+
+# Persistent queue of EE downloads, a job is a requested region split into chunks downloaded separately
+DOWNLOAD_TABLES = (
+    """CREATE TABLE IF NOT EXISTS "download_jobs" (
+                        "id"	INTEGER NOT NULL UNIQUE,
+                        "fdate"	TEXT NOT NULL,
+                        "ldate"	TEXT NOT NULL,
+                        "cloudiness"	INTEGER NOT NULL,
+                        "visualized"	INTEGER NOT NULL DEFAULT 0,
+                        "scale"	REAL NOT NULL,
+                        "state"	TEXT NOT NULL DEFAULT 'pending',
+                        "created"	REAL NOT NULL,
+                        PRIMARY KEY("id" AUTOINCREMENT)
+                );""",
+
+    """CREATE TABLE IF NOT EXISTS "download_chunks" (
+                        "id"	INTEGER NOT NULL UNIQUE,
+                        "job_id"	INTEGER NOT NULL,
+                        "tlxd"	REAL NOT NULL,
+                        "tlyd"	REAL NOT NULL,
+                        "brxd"	REAL NOT NULL,
+                        "bryd"	REAL NOT NULL,
+                        "state"	TEXT NOT NULL DEFAULT 'pending',
+                        "attempts"	INTEGER NOT NULL DEFAULT 0,
+                        "next_attempt"	REAL NOT NULL DEFAULT 0,
+                        "error"	TEXT,
+                        "eeid"	INTEGER,
+                        PRIMARY KEY("id" AUTOINCREMENT),
+                        FOREIGN KEY("job_id") REFERENCES "download_jobs"("id")
+                );""",
+
+    """CREATE INDEX IF NOT EXISTS "download_chunks_state" ON "download_chunks" ("state", "next_attempt");""",
+)
+
+
+# Scenes matched by EE collection queries, scenes is JSON list of [scene id, acquisition time in ms, cloudiness]
+SCENE_QUERIES_TABLE = """CREATE TABLE IF NOT EXISTS "scene_queries" (
+                        "key"	TEXT NOT NULL UNIQUE,
+                        "scenes"	TEXT NOT NULL,
+                        "created"	REAL NOT NULL,
+                        PRIMARY KEY("key")
+                );"""
+
+# Regions synced with new acquisitions, last_scene_time is acquisition time in ms of the newest queued scene
+WATCHED_REGIONS_TABLE = """CREATE TABLE IF NOT EXISTS "watched_regions" (
+                        "id"	INTEGER NOT NULL UNIQUE,
+                        "name"	TEXT NOT NULL,
+                        "tlxd"	REAL NOT NULL,
+                        "tlyd"	REAL NOT NULL,
+                        "brxd"	REAL NOT NULL,
+                        "bryd"	REAL NOT NULL,
+                        "cloudiness"	INTEGER NOT NULL,
+                        "visualized"	INTEGER NOT NULL DEFAULT 0,
+                        "scale"	REAL NOT NULL,
+                        "since"	TEXT NOT NULL,
+                        "last_scene_time"	INTEGER,
+                        "last_sync"	REAL,
+                        PRIMARY KEY("id" AUTOINCREMENT)
+                );"""
+
+# Settings kept with the EE database, like the codec of new images
+EE_SETTINGS_TABLE = """CREATE TABLE IF NOT EXISTS "settings" (
+                        "key"	TEXT NOT NULL UNIQUE,
+                        "value"	TEXT NOT NULL,
+                        PRIMARY KEY("key")
+                );"""
+
+# Columns added after tables were created, (table, column, definition)
+EE_DATABASE_COLUMNS = (
+    ("images", "scene_id", "TEXT"),
+    ("images", "codec", "TEXT NOT NULL DEFAULT 'png'"),
+    ("download_chunks", "scene_id", "TEXT"),
+    ("download_chunks", "scene_time", "INTEGER"),
+    ("download_chunks", "scene_cloudiness", "REAL"),
+)
+
+
+def add_missing_columns(cursor: sqlite3.Cursor, columns):
+    for table, column, definition in columns:
+        cursor.execute(f'PRAGMA table_info("{table}");')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition};')
+
+
+def update_ee_database(cursor: sqlite3.Cursor):
+    """ creates tables and columns added to the EE database over time """
+    cursor.execute(THUMBNAILS_TABLE)
+    for command in IMAGES_INDEX_COMMANDS:
+        cursor.execute(command)
+    for command in DOWNLOAD_TABLES:
+        cursor.execute(command)
+    cursor.execute(SCENE_QUERIES_TABLE)
+    cursor.execute(WATCHED_REGIONS_TABLE)
+    cursor.execute(EE_SETTINGS_TABLE)
+    add_missing_columns(cursor, EE_DATABASE_COLUMNS)
+    cursor.execute('CREATE INDEX IF NOT EXISTS "images_scene_id" ON "images" ("scene_id");')
+
+
 def create_database_files(foldername: str, search_database: str, tiles_database: str, ee_database: str, servers):
     search_database = os.path.join(foldername, search_database + ".db")
     tiles_database = os.path.join(foldername, tiles_database + ".db")
@@ -101,12 +244,18 @@ def create_database_files(foldername: str, search_database: str, tiles_database:
                         PRIMARY KEY("id" AUTOINCREMENT)
                 );"""
         cursor.execute(command)
+        update_ee_database(cursor)
         connection.commit()
         connection.close()
         print("Created", ee_database)
 
     else:
         print("Connected to", ee_database)
+        connection = sqlite3.connect(ee_database)
+        cursor = connection.cursor()
+        update_ee_database(cursor)
+        connection.commit()
+        connection.close()
 
     return search_database, tiles_database, ee_database
 
@@ -137,9 +286,22 @@ servers = (
 
 HIDE_PROXY = False
 
+# Size of images in the list of downloaded images
+THUMBNAIL_SIZE = (85, 85)
+
+# Zoom levels EE images are sliced into when they are shown as map tiles
+EE_TILES_ZOOM_RANGE = (10, 16)
+
+# Bytes cached map tiles may take, for all servers and by server url,
+# least recently used tiles are evicted except the ones of sections saved for offline use
+TILES_DATABASE_QUOTA = 2 * 1024 ** 3
+TILES_SERVER_QUOTAS = {}
+
 DATA_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), "data")  # Includes absolute path to the main.py
+# ERA_DATABASES_FOLDER keeps the databases elsewhere, benchmarks use it to stay out of the working tree
+DATABASES_FOLDER = os.environ.get("ERA_DATABASES_FOLDER") or DATA_FOLDER
 SEARCH_DATABASE_PATH, DATABASE_PATH, EE_DATABASE_PATH = create_database_files(
-    DATA_FOLDER, "keyed_search_database", "offline_map_tiles6", "ee_tiles",
+    DATABASES_FOLDER, "keyed_search_database", "offline_map_tiles6", "ee_tiles",
     servers
 )
 LOGO_FILENAME = "logo_light.png"
@@ -148,6 +310,7 @@ ICON_FILENAME = "icon.ico"
 CORNER_FILENAME = "top_left_corner.png"
 BR_CORNER_FILENAME = "bottom_right_corner.png"
 LAST_PROXY_FILENAME = "last_proxy.txt"
+LAST_VIEW_FILENAME = "last_view.json"
 VIEW_ICON_FILENAME = "opened_eye.png"
 HIDE_ICON_FILENAME = "hidden_eye.png"
 FIND_ICON_FILENAME = "find.png"
@@ -176,6 +339,18 @@ except Exception as e:
     print("Failed proxy import because of ", e)
     DEFAULT_PROXY = ""
 
+# Map view of the last session: position, zoom, server, map size and shown images
+try:
+    with open(os.path.join(DATA_FOLDER, LAST_VIEW_FILENAME)) as f:
+        LAST_VIEW = json.load(f)
+
+except FileNotFoundError:
+    LAST_VIEW = None
+
+except Exception as e:
+    print("Failed last view import because of ", e)
+    LAST_VIEW = None
+
 # Translator
 RU_KEYS = "йцукенгшщзхъфывапролджэячсмитьбюЙЦУКЕНГШЩЗХЪФЫВАПРОЛДЖЭЯЧСМИТЬБЮ"
 EN_KEYS = "qwertyuiop[]asdfghjkl;'zxcvbnm,.QWERTYUIOP{}ASDFGHJKL:\"ZXCVBNM<>"
@@ -1,22 +1,29 @@
-import io
-from time import sleep
-import threading
-from datetime import timedelta
-from calendar import monthrange
+import profiling
 
-from PIL import Image, ImageTk
+with profiling.span("module imports"):
+    import io
+    import json
+    from time import sleep
+    import threading
+    import numpy
+    from datetime import datetime, timedelta
+    from calendar import monthrange
 
-from tkinter import StringVar, IntVar
-import customtkinterforked as customtkinter
-from tkintermapviewforked import TkinterMapView, utility_functions
+    from PIL import Image, ImageTk
 
-from constants import *
+    from tkinter import StringVar, IntVar
+    import customtkinterforked as customtkinter
+    from tkintermapviewforked import TkinterMapView, EEImageStore, EEImageCatalog, EE_CODECS, utility_functions
+
+    # constants creates and connects the databases on import
+    with profiling.span("constants"):
+        from constants import *
 
 
 
 # To do list:
 #  1. [х] - Fix ee images zoom bug
-#  2. [ ] - Download full image collection
+#  2. [x] - Download full image collection
 #  3. [x] - List of downloaded images
 #  4. [?] - Downloading progress bar
 #  4.1. [ ] - Try to get progress bar from other libs
@@ -31,7 +38,7 @@ from constants import *
 # 10. [x] - Scrollable in two direction frames
 # 11. [x] - Authentication status button
 # 12. [x] - Don't show not suitable images
-# 13. [ ] - Fix small zoom image scale exception
+# 13. [x] - Fix small zoom image scale exception
 # 14. [ ] -
 # 15. [ ] - Transparency border antialiasing
 # 16. [x] - Additional hidden panel with rare options:
@@ -61,7 +68,8 @@ from constants import *
 
 # https://customtkinter.tomschimansky.com/documentation/packaging
 
-customtkinter.set_default_color_theme(os.path.join(DATA_FOLDER, THEME_FILENAME))
+with profiling.span("theme loading"):
+    customtkinter.set_default_color_theme(os.path.join(DATA_FOLDER, THEME_FILENAME))
 
 os.environ['HTTP_PROXY'] = DEFAULT_PROXY
 os.environ['HTTPS_PROXY'] = DEFAULT_PROXY
@@ -96,7 +104,9 @@ class App(customtkinter.CTk):
 
         self.marker_list = []
 
-        self.ee_images_list = []
+        self.ee_image_store = EEImageStore(EE_DATABASE_PATH, thumbnail_size=THUMBNAIL_SIZE)
+        threading.Thread(daemon=True, target=self.ee_image_store.backfill_thumbnails).start()
+        self.ee_catalog = EEImageCatalog()
         self.last_eeid = [0]
         self.load_ee_images()
 
@@ -193,13 +203,16 @@ class App(customtkinter.CTk):
             text="Скачать регион",
             command=self.get_ee_image_new)
         self.download_button.grid(row=1, column=0, columnspan=2, pady=(20, 0), padx=(20, 20))
-        self.number_of_images_downloading = 0
 
-        self.download_progress_bar = customtkinter.CTkProgressBar(master=self.frame_left_main,
-                                                                  mode="indeterminate",
-                                                                  indeterminate_speed=2)
-        self.download_progress_bar.start()
-        # self.download_progress_bar.grid(row=1, column=0, columnspan=2, pady=(20, 0), padx=(20, 20))
+        # Download progress is shown instead of the button
+        self.download_progress_frame = customtkinter.CTkFrame(master=self.frame_left_main, fg_color="transparent")
+        self.download_progress_bar = customtkinter.CTkProgressBar(master=self.download_progress_frame,
+                                                                  mode="determinate")
+        self.download_progress_bar.set(0)
+        self.download_progress_bar.grid(row=0, column=0, sticky="we")
+        self.download_progress_label = customtkinter.CTkLabel(master=self.download_progress_frame, text="")
+        self.download_progress_label.grid(row=1, column=0, sticky="we")
+        self.download_progress_update = None
 
         # ee switch
         self.use_ee_switch = customtkinter.CTkSwitch(
@@ -272,6 +285,17 @@ class App(customtkinter.CTk):
             command=self.change_map)
         self.map_option_menu.grid(row=7, column=0, columnspan=2, padx=(20, 20), pady=(10, 20))
 
+        # Live ee layer switch
+        self.ee_live_layer_update = None
+        self.ee_live_layer_switch = customtkinter.CTkSwitch(
+            master=self.frame_left_main,
+            text="Слой Earth Engine",
+            command=self.switch_ee_live_layer)
+        self.ee_live_layer_switch.grid(row=8, column=0, columnspan=2, pady=(0, 20), padx=(20, 20))
+        customtkinter.CTkToolTip(widget=self.ee_live_layer_switch,
+                                 message="Показывать композит Sentinel-2 по дате и облачности\n"
+                                         "как слой тайлов, загружаются только видимые тайлы")
+
         # ============ images frame ============
 
         self.frame_left_images = customtkinter.CTkScrollableFrame(
@@ -290,7 +314,7 @@ class App(customtkinter.CTk):
         self.is_filtering_required = False
         self.is_filtering_images = False
         self.number_of_shown_images_frames = 0
-        self.images_frames = []
+        self.images_frames = {}  # catalog row -> frame
         self.render_images_frames()
         # self.filter_thread = threading.Thread(daemon=True, target=self.filter_ee_images_thread)
         # self.filter_thread.start()
@@ -384,6 +408,99 @@ class App(customtkinter.CTk):
                                                       text="")
         self.forcing_switch.grid(row=8, column=1, sticky="e", padx=(0, 12), pady=12)
 
+        self.ee_tiles_label = customtkinter.CTkLabel(self.frame_left_options,
+                                                     text="Снимки\nтайлами",
+                                                     anchor="w", justify="left")
+        self.ee_tiles_label.grid(row=9, column=0, sticky="w", padx=(12, 0), pady=12)
+        self.ee_tiles_switch = customtkinter.CTkSwitch(master=self.frame_left_options,
+                                                       command=self.switch_ee_tiles,
+                                                       text="")
+        self.ee_tiles_switch.grid(row=9, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.ee_tiles_switch,
+                                 message="Показывать снимки как слой тайлов карты "
+                                         f"(уровни {EE_TILES_ZOOM_RANGE[0]}-{EE_TILES_ZOOM_RANGE[1]})")
+
+        self.is_downloading_visualized = False
+        self.visualized_label = customtkinter.CTkLabel(self.frame_left_options,
+                                                       text="8 бит\nс сервера",
+                                                       anchor="w", justify="left")
+        self.visualized_label.grid(row=10, column=0, sticky="w", padx=(12, 0), pady=12)
+        self.visualized_switch = customtkinter.CTkSwitch(master=self.frame_left_options,
+                                                         command=self.switch_downloading_visualized,
+                                                         text="")
+        self.visualized_switch.grid(row=10, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.visualized_switch,
+                                 message="Запрашивать готовое 8-битное RGB изображение в PNG,\n"
+                                         "данных загружается в несколько раз меньше")
+
+        self.is_downloading_time_series = False
+        self.time_series_label = customtkinter.CTkLabel(self.frame_left_options,
+                                                        text="Все снимки\nза период",
+                                                        anchor="w", justify="left")
+        self.time_series_label.grid(row=11, column=0, sticky="w", padx=(12, 0), pady=12)
+        self.time_series_switch = customtkinter.CTkSwitch(master=self.frame_left_options,
+                                                          command=self.switch_downloading_time_series,
+                                                          text="")
+        self.time_series_switch.grid(row=11, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.time_series_switch,
+                                 message="Скачивать все подходящие снимки региона за период\n"
+                                         "с настоящими датами съемки, уже скачанные пропускаются")
+
+        self.is_adaptive_scale = False
+        self.adaptive_scale_label = customtkinter.CTkLabel(self.frame_left_options,
+                                                           text="Адаптивное\nкачество",
+                                                           anchor="w", justify="left")
+        self.adaptive_scale_label.grid(row=12, column=0, sticky="w", padx=(12, 0), pady=12)
+        self.adaptive_scale_switch = customtkinter.CTkSwitch(master=self.frame_left_options,
+                                                             command=self.switch_adaptive_scale,
+                                                             text="")
+        self.adaptive_scale_switch.grid(row=12, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.adaptive_scale_switch,
+                                 message="Подбирать качество по размеру региона и масштабу карты\n"
+                                         "вместо заданного, сначала показывается быстрый эскиз")
+
+        # Watched regions get only scenes acquired after the last sync
+        self.watch_region_button = customtkinter.CTkButton(master=self.frame_left_options, width=0,
+                                                           text="Следить",
+                                                           command=self.watch_region)
+        self.watch_region_button.grid(row=13, column=0, sticky="w", padx=(12, 0), pady=12)
+        customtkinter.CTkToolTip(widget=self.watch_region_button,
+                                 message="Запомнить выбранный регион с фильтрами,\n"
+                                         "снимки ищутся начиная с даты \"от\"")
+        self.sync_regions_button = customtkinter.CTkButton(master=self.frame_left_options, width=0,
+                                                           text="Синхронизировать",
+                                                           command=self.sync_watched_regions)
+        self.sync_regions_button.grid(row=13, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.sync_regions_button,
+                                 message="Скачать снимки отслеживаемых регионов,\n"
+                                         "снятые после последней синхронизации")
+
+        self.codec_label = customtkinter.CTkLabel(self.frame_left_options,
+                                                  text="Формат\nснимков",
+                                                  anchor="w", justify="left")
+        self.codec_label.grid(row=14, column=0, sticky="w", padx=(12, 0), pady=12)
+        self.codec_menu = customtkinter.CTkOptionMenu(master=self.frame_left_options,
+                                                      values=EE_CODECS,
+                                                      command=self.change_ee_codec)
+        self.codec_menu.set(self.ee_image_store.codec)
+        self.codec_menu.grid(row=14, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.codec_menu,
+                                 message="Формат хранения снимков в базе: png, webp без потерь,\n"
+                                         "jpeg с маской прозрачности или raw со сжатием zlib.\n"
+                                         "Сохраненные снимки пережимаются в фоне")
+
+        self.tile_coverage_label = customtkinter.CTkLabel(self.frame_left_options,
+                                                          text="Покрытие\nтайлами",
+                                                          anchor="w", justify="left")
+        self.tile_coverage_label.grid(row=15, column=0, sticky="w", padx=(12, 0), pady=12)
+        self.tile_coverage_switch = customtkinter.CTkSwitch(master=self.frame_left_options,
+                                                            command=self.switch_tile_coverage,
+                                                            text="")
+        self.tile_coverage_switch.grid(row=15, column=1, sticky="e", padx=(0, 12), pady=12)
+        customtkinter.CTkToolTip(widget=self.tile_coverage_switch,
+                                 message="Подсвечивать места, где тайлы текущей карты\n"
+                                         "и масштаба сохранены в базе")
+
         # ============ frame_middle ============
         self.frame_middle.grid_rowconfigure(1, weight=1)
         self.frame_middle.grid_rowconfigure(0, weight=0)
@@ -391,17 +508,34 @@ class App(customtkinter.CTk):
         self.frame_middle.grid_columnconfigure(1, weight=0)
         self.frame_middle.grid_columnconfigure(2, weight=1)
 
-        self.map_widget = TkinterMapView(
-            self.frame_middle,
-            corner_radius=0,
-            database_path=DATABASE_PATH,
-            search_database_path=SEARCH_DATABASE_PATH,
-            ee_database_path=EE_DATABASE_PATH,
-            set_connection_status=self.set_connection_status,
-            get_connection_status=self.get_connection_status,
-            eeid=self.last_eeid,
-        )
+        # The last view is shown right away with its stored tiles instead of searching for the default address
+        last_server = servers[0]
+        if LAST_VIEW is not None:
+            last_server = next((server for server in servers if server[1] == LAST_VIEW.get("server")), servers[0])
+        with profiling.span("map widget construction"):
+            self.map_widget = TkinterMapView(
+                self.frame_middle,
+                corner_radius=0,
+                tile_server=last_server[1],
+                max_zoom=last_server[2],
+                position=tuple(LAST_VIEW["position"]) if LAST_VIEW is not None else None,
+                zoom=LAST_VIEW.get("zoom", 17) if LAST_VIEW is not None else 17,
+                preload_size=tuple(LAST_VIEW["size"]) if LAST_VIEW is not None and "size" in LAST_VIEW else None,
+                database_path=DATABASE_PATH,
+                search_database_path=SEARCH_DATABASE_PATH,
+                ee_database_path=EE_DATABASE_PATH,
+                ee_image_store=self.ee_image_store,
+                ee_catalog=self.ee_catalog,
+                set_connection_status=self.set_connection_status,
+                get_connection_status=self.get_connection_status,
+                eeid=self.last_eeid,
+            )
         self.map_widget.grid(row=1, rowspan=1, column=0, columnspan=3, sticky="nswe", padx=(0, 0), pady=(0, 0))
+        self.map_widget.set_ee_tiles_zoom_range(*EE_TILES_ZOOM_RANGE)
+        self.map_widget.set_tiles_quota(TILES_DATABASE_QUOTA, TILES_SERVER_QUOTAS)
+        if self.map_widget.download_queue is not None and self.map_widget.download_queue.count_unfinished():
+            # Downloads of the last session continue after authentication
+            self.show_download_progress()
         self.map_widget.add_right_click_menu_command(label="Загрузить все сохраненные изображения",
                                                      command=self.load_images_on_map)
         self.map_widget.add_right_click_menu_command(label="Выбрать верхний левый угол",
@@ -410,6 +544,10 @@ class App(customtkinter.CTk):
         self.map_widget.add_right_click_menu_command(label="Выбрать нижний правый угол",
                                                      command=self.select_bottom_right,
                                                      pass_coords=True)
+        self.map_widget.add_right_click_menu_command(label="Статистика тайлов",
+                                                     command=self.print_tile_statistics)
+        self.map_widget.add_right_click_menu_command(label="Сжать базу тайлов",
+                                                     command=self.vacuum_tiles_database)
         self.map_widget.set_ee_settings_vars(date_from=self.date_from_entry.get(),
                                              date_until=self.date_until_entry.get(),
                                              cloudiness=int(self.cloudiness_slider.get())
@@ -455,23 +593,27 @@ class App(customtkinter.CTk):
                                                                       label_text="Сохраненные адреса")
         self.address_frame.grid(row=1, column=0, columnspan=2, padx=(12, 0), pady=12, sticky="nswe")
         self.address_button_list = []
-        for location in locations:
-            button = customtkinter.CTkButton(master=self.address_frame,
-                                             text=location,
-                                             fg_color="transparent",
-                                             anchor="w",
-                                             text_color=("#000000", "#FFFFFF"),
-                                             command=lambda loc=location: self.choose_address(loc)
-
-            )
-            button.grid(row=len(self.address_button_list), column=0, sticky="w")
-            self.address_button_list.append(button)
+        with profiling.span("saved address buttons"):
+            for location in locations:
+                button = customtkinter.CTkButton(master=self.address_frame,
+                                                 text=location,
+                                                 fg_color="transparent",
+                                                 anchor="w",
+                                                 text_color=("#000000", "#FFFFFF"),
+                                                 command=lambda loc=location: self.choose_address(loc)
+
+                )
+                button.grid(row=len(self.address_button_list), column=0, sticky="w")
+                self.address_button_list.append(button)
 
         self.frame_left.lift()
 
         # Set default values
-        self.map_widget.set_address("Анапа")
-        self.map_option_menu.set(servers[0][0])
+        if LAST_VIEW is None:
+            self.map_widget.set_address("Анапа")
+        else:
+            self.after_idle(self.show_last_view_images, LAST_VIEW.get("shown_images", ()))
+        self.map_option_menu.set(last_server[0])
         self.appearance_mode_option_menu.set(LIGHT_MODE_NAME)
 
         # Autoauthentication
@@ -507,6 +649,26 @@ class App(customtkinter.CTk):
                                              )
         self.map_widget.draw_move()
 
+        # Rebuild live layer only when settings stop changing
+        if self.ee_live_layer_switch.get():
+            if self.ee_live_layer_update is not None:
+                self.after_cancel(self.ee_live_layer_update)
+            self.ee_live_layer_update = self.after(1000, self.set_ee_live_layer)
+
+    def set_ee_live_layer(self):
+        self.ee_live_layer_update = None
+        self.map_widget.set_ee_live_layer(self.date_from_entry.get(),
+                                          self.date_until_entry.get(),
+                                          int(self.cloudiness_slider.get()))
+
+    def switch_ee_live_layer(self):
+        if self.ee_live_layer_switch.get():
+            if not self.map_widget.is_ee_authenticated:
+                print("Authentication required, showing saved tiles only")
+            self.set_ee_live_layer()
+        else:
+            self.map_widget.remove_ee_live_layer()
+
     def set_connection_status(self, status: bool):
         if self.map_widget.use_database_only:
             self.connection_status_button.configure(#text="x",
@@ -536,53 +698,48 @@ class App(customtkinter.CTk):
         else:
             return "?"
 
+    @profiling.profiled("App.load_ee_images")
     def load_ee_images(self):
-        db_connection = sqlite3.connect(EE_DATABASE_PATH)
-        db_cursor = db_connection.cursor()
-        db_cursor.execute("SELECT id, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image FROM images")
-        images = db_cursor.fetchall()
+        """Loads metadata of stored images, image data is read on demand"""
+        self.ee_catalog.extend(self.ee_image_store.load_metadata())
 
-        for eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image in images:
-
-            self.ee_images_list.append((eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image))
-        self.last_eeid[0] = eeid
+        if len(self.ee_catalog):
+            self.last_eeid[0] = self.ee_catalog.last_eeid
 
     def load_new_ee_images(self):
-        eeid = self.ee_images_list[-1][0]
-
-        db_connection = sqlite3.connect(EE_DATABASE_PATH)
-        db_cursor = db_connection.cursor()
-        db_cursor.execute("SELECT id, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image FROM images WHERE id>?",
-                          (eeid,))
-        images = db_cursor.fetchall()
+        rows = self.ee_catalog.extend(self.ee_image_store.load_metadata(after_eeid=self.ee_catalog.last_eeid))
+        for row in rows:
+            self.render_image_frame(row, new=True)
+        if len(self.ee_catalog):
+            self.last_eeid[0] = self.ee_catalog.last_eeid
 
-        for eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image in images:
+    def add_ee_image_item(self, item):
+        return self.ee_catalog.extend([item])[0]
 
-            self.ee_images_list.append((eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image))
-            self.render_image_frame((eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image), new=True)
-        self.last_eeid[0] = eeid
+    def get_ee_image_index(self, eeid):
+        return self.ee_catalog.row_of(eeid)
 
+    @profiling.profiled("render_images_frames")
     def render_images_frames(self):
-        for item in self.ee_images_list:
-            self.render_image_frame(item)
+        thumbnails = self.ee_image_store.load_thumbnails()
+        for row in range(len(self.ee_catalog)):
+            thumbnail = thumbnails.get(int(self.ee_catalog.ids[row]))
+            if thumbnail is not None:
+                thumbnail = Image.open(io.BytesIO(thumbnail))
+            self.render_image_frame(row, thumbnail=thumbnail)
 
 # 10 12 2 1
-    def render_image_frame(self, item: tuple[int, float, float, float, float, "Any", "Any", int, str],
-                           new=False):
-        eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image = item
+    def render_image_frame(self, row: int, new=False, thumbnail: Image.Image = None):
+        """Renders frame of an image in the list, if thumbnail is not given
+           it is loaded when the frame is shown first time"""
+        eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness = self.ee_catalog.item(row)
 
         frame = customtkinter.CTkFrame(master=self.frame_left_images)
-        #frame.grid(row=len(self.images_frames), column=0, padx=(10, 10), pady=(10, 10), sticky="nswe")
-        frame.is_hidden = True
-        frame.position = ((tlxd + brxd)/2, (tlyd + bryd)/2)
-
-        # thumb = ImageTk.PhotoImage(Image.open(io.BytesIO(image)).resize((85, 85)))
-        if isinstance(image, Image.Image):
-            thumb = customtkinter.CTkImage(image, size=(85, 85))
-        else:
-            thumb = customtkinter.CTkImage(Image.open(io.BytesIO(image)), size=(85, 85))
+        frame.thumbnail = None
+        if thumbnail is not None:
+            frame.thumbnail = customtkinter.CTkImage(thumbnail, size=THUMBNAIL_SIZE)
 
-        label = customtkinter.CTkLabel(master=frame, justify="left", image=thumb, compound="left",
+        label = customtkinter.CTkLabel(master=frame, justify="left", image=frame.thumbnail, compound="left",
                                        text=f""" eeid: {eeid}
  Координаты: 
  ({tlxd:2.3f}, {tlyd:2.3f})
@@ -590,17 +747,21 @@ class App(customtkinter.CTk):
  Дата: {ldate}
  Облачность: {cloudiness}""")
         label.grid(row=0, column=0, rowspan=3, padx=(5, 5), pady=(5, 5))
+        frame.thumbnail_label = label
+        self.images_frames[row] = frame
+        if new:
+            self.load_image_frame_thumbnail(row)
 
-        frame.is_image_hidden = not new
-        if frame.is_image_hidden:
-            img = self.view_icon
+        self.ee_catalog.shown[row] = new
+        if new:
+            img = self.hide_icon
 
         else:
-            img = self.hide_icon
+            img = self.view_icon
 
         button = customtkinter.CTkButton(master=frame, text="", width=20,
                                          image=img, compound="left",
-                                         command=lambda index=len(self.images_frames): self.load_images_on_map(index))
+                                         command=lambda index=row: self.load_images_on_map(index))
         button.grid(row=0, column=1, padx=(0, 5), pady=(5, 0))
 
         customtkinter.CTkToolTip(widget=button, message="Показать/скрыть")
@@ -608,20 +769,29 @@ class App(customtkinter.CTk):
 
         button = customtkinter.CTkButton(master=frame, text="", width=20,
                                          image=self.find_icon, compound="left",
-                                         command=lambda index=len(self.images_frames): self.find_ee_image(index))
+                                         command=lambda index=row: self.find_ee_image(index))
         button.grid(row=1, column=1, padx=(0, 5))
         customtkinter.CTkToolTip(widget=button, message="Найти")
 
         button = customtkinter.CTkButton(master=frame, text="", width=20,
                                          image=self.delete_icon, compound="left",
-                                         command=lambda index=len(self.images_frames): self.delete_ee_image(index))
+                                         command=lambda index=row: self.delete_ee_image(index))
         button.grid(row=2, column=1, padx=(0, 5), pady=(0, 5))
         customtkinter.CTkToolTip(widget=button, message="Удалить")
-        self.images_frames.append(frame)
 
     def render_new_ee_image(self):
         pass
 
+    def load_image_frame_thumbnail(self, row):
+        frame = self.images_frames[row]
+        if frame.thumbnail is not None:
+            return
+
+        image = self.ee_image_store.get_thumbnail(int(self.ee_catalog.ids[row]))
+        if image is not None:
+            frame.thumbnail = customtkinter.CTkImage(image, size=THUMBNAIL_SIZE)
+            frame.thumbnail_label.configure(image=frame.thumbnail)
+
     def switch_filter_images(self):
         self.is_filtering_images = not self.is_filtering_images
         self.map_widget.initiate_filtering(True)
@@ -633,54 +803,109 @@ class App(customtkinter.CTk):
     def switch_forcing_download(self):
         self.is_forcing_download = not self.is_forcing_download
 
+    def switch_downloading_visualized(self):
+        self.is_downloading_visualized = not self.is_downloading_visualized
+
+    def switch_downloading_time_series(self):
+        self.is_downloading_time_series = not self.is_downloading_time_series
+
+    def switch_adaptive_scale(self):
+        self.is_adaptive_scale = not self.is_adaptive_scale
+        self.scale_entry.configure(state="disabled" if self.is_adaptive_scale else "normal")
+
+    def switch_tile_coverage(self):
+        self.map_widget.show_tile_coverage(bool(self.tile_coverage_switch.get()))
+
+    def print_tile_statistics(self):
+        threading.Thread(daemon=True, target=self.print_tile_statistics_thread).start()
+
+    def print_tile_statistics_thread(self):
+        statistics = self.map_widget.get_tile_statistics()
+        for row in statistics.get("tiles", ()):
+            oldest = datetime.fromtimestamp(row.oldest_access).strftime("%Y-%m-%d") if row.oldest_access else "-"
+            newest = datetime.fromtimestamp(row.newest_access).strftime("%Y-%m-%d") if row.newest_access else "-"
+            print(f"{row.server} z{row.zoom}: {row.tiles} tiles ({row.pinned} pinned), "
+                  f"{row.bytes // 1024} KB, read {oldest} - {newest}")
+        if "bytes" in statistics:
+            print("Tiles database images take", statistics["bytes"] // 1024 // 1024, "MB")
+        print("Requested tiles:", ", ".join(f"{source} {count} ({ratio:.0%})"
+                                            for source, (count, ratio) in statistics["cache"].items()))
+
+    def vacuum_tiles_database(self):
+        threading.Thread(daemon=True, target=self.vacuum_tiles_database_thread).start()
+
+    def vacuum_tiles_database_thread(self):
+        print("Compacting tiles database, tiles are not saved until it is done")
+        try:
+            sizes = self.map_widget.vacuum_tiles_database()
+        except sqlite3.OperationalError as e:
+            print("Failed to compact tiles database because of", e)
+            return
+        if sizes is not None:
+            print("Tiles database is compacted from", sizes[0] // 1024 // 1024, "MB to", sizes[1] // 1024 // 1024, "MB")
+
+    def change_ee_codec(self, codec):
+        self.ee_image_store.set_codec(codec)
+        threading.Thread(daemon=True, target=self.recompress_ee_images, args=(codec,)).start()
+
+    def recompress_ee_images(self, codec):
+        count, old_size, new_size = self.ee_image_store.recompress(codec)
+        if count:
+            print("Recompressed", count, "images to", codec, "from", old_size // 1024, "KB to", new_size // 1024, "KB")
+
+    def switch_ee_tiles(self):
+        # Show already shown images again the other way
+        shown = self.ee_catalog.items(numpy.flatnonzero(self.ee_catalog.shown))
+        self.map_widget.unload_ee_images(shown)
+        self.map_widget.switch_ee_tiles()
+        self.map_widget.load_ee_images(shown)
+
     def filter_ee_images(self, position, distance):
         if self.is_filtering_images:
-            for frame in self.images_frames:
-                if (frame.is_hidden
-                        and -distance < frame.position[0] - position[0] < distance
-                        and -distance < frame.position[1] - position[1] < distance
-                        ):
-                    frame.grid(row=self.number_of_shown_images_frames, column=0, padx=(10, 10), pady=(10, 10), sticky="nswe")
-                    frame.is_hidden = False
-                    self.number_of_shown_images_frames += 1
-
-                elif (not frame.is_hidden
-                      and not (-distance < frame.position[0] - position[0] < distance
-                               and -distance < frame.position[1] - position[1] < distance)
-                      ):
-                    frame.grid_forget()
-                    frame.is_hidden = True
-                    self.number_of_shown_images_frames -= 1
-
+            listed = self.ee_catalog.near(position, distance)
         else:
-            for index, frame in enumerate(self.images_frames):
-                frame.grid(row=index, column=0, padx=(10, 10), pady=(10, 10), sticky="nswe")
-                frame.is_hidden = False
-
-            self.number_of_shown_images_frames = len(self.images_frames)
+            listed = ~self.ee_catalog.deleted
+
+        # Only frames whose visibility changed are touched, grid rows follow catalog rows
+        for row in numpy.flatnonzero(listed != self.ee_catalog.listed).tolist():
+            if row not in self.images_frames:
+                # Frame of a just added image is not rendered yet
+                listed[row] = False
+            elif listed[row]:
+                self.load_image_frame_thumbnail(row)
+                self.images_frames[row].grid(row=row, column=0, padx=(10, 10), pady=(10, 10), sticky="nswe")
+            else:
+                self.images_frames[row].grid_forget()
+
+        self.ee_catalog.listed = listed
+        self.number_of_shown_images_frames = int(numpy.count_nonzero(listed))
 
     def load_images_on_map(self, index=None, forced_to_show=False):
         """Shows and hides images on map
            If index is not specified shows all images
            """
+        catalog = self.ee_catalog
         if index is None:
-            self.map_widget.load_ee_images(self.ee_images_list)
+            rows = numpy.flatnonzero(~catalog.shown & ~catalog.deleted).tolist()
+            self.map_widget.load_ee_images(catalog.items(rows))
+            for row in rows:
+                self.images_frames[row].view_hide_button.configure(image=self.hide_icon)
+            catalog.shown[rows] = True
             return
-        if self.images_frames[index].is_image_hidden:
-            self.map_widget.load_ee_images(self.ee_images_list[index:index+1])
+        if not catalog.shown[index]:
+            self.map_widget.load_ee_images([catalog.item(index)])
             self.images_frames[index].view_hide_button.configure(image=self.hide_icon)
         elif not forced_to_show:
-            self.map_widget.unload_ee_images(self.ee_images_list[index:index+1])
+            self.map_widget.unload_ee_images([catalog.item(index)])
             self.images_frames[index].view_hide_button.configure(image=self.view_icon)
         else:
             print("Nothing changed ;)")
             return
-        self.images_frames[index].is_image_hidden = not self.images_frames[index].is_image_hidden
+        catalog.shown[index] = not catalog.shown[index]
 
     def find_ee_image(self, index):
-        #print(self.ee_images_list[index])
-        self.map_widget.set_position(deg_x=(self.ee_images_list[index][1]+self.ee_images_list[index][3])/2,
-                                     deg_y=(self.ee_images_list[index][2]+self.ee_images_list[index][4])/2)
+        lat, lon = self.ee_catalog.centers[index].tolist()
+        self.map_widget.set_position(deg_x=lat, deg_y=lon)
         self.map_widget.initiate_filtering(forced=True)
 
     def delete_ee_image(self, index):
@@ -689,22 +914,21 @@ class App(customtkinter.CTk):
         if not dialog.get_input():
             return
 
-        if not self.images_frames[index].is_image_hidden:
-            self.map_widget.unload_ee_images(self.ee_images_list[index:index+1])
+        item = self.ee_catalog.item(index)
+        if self.ee_catalog.shown[index]:
+            self.map_widget.unload_ee_images([item])
+            self.ee_catalog.shown[index] = False
 
         try:
-            connection = sqlite3.connect(EE_DATABASE_PATH)
-            cursor = connection.cursor()
-
-            command = """DELETE FROM images WHERE id = ?"""
-
-            cursor.execute(command, (self.ee_images_list[index][0],))
-            connection.commit()
-            connection.close()
+            self.ee_image_store.delete_image(item[0])
+            self.map_widget.delete_ee_tiles(item[0])
             self.images_frames[index].grid_forget()
+            self.ee_catalog.deleted[index] = True
+            self.ee_catalog.listed[index] = False
+            self.map_widget.update_fit_ee_ids()
 
         except Exception as e:
-            print("Failed to delete", self.ee_images_list[index])
+            print("Failed to delete", item)
             print(e)
 
     def print_cloud(self, *args):
@@ -786,16 +1010,70 @@ class App(customtkinter.CTk):
 
         cloud = int(self.cloudiness_slider.get())
 
+        self.show_download_progress()
+        if self.is_downloading_time_series:
+            self.map_widget.get_ee_time_series(from_date, until_date, cloud)
+        else:
+            self.map_widget.get_ee_image_new(from_date, until_date, cloud,
+                                             forced=self.is_forcing_download)
+
+    def watch_region(self):
+
+        if self.map_widget.region_polygon is None:
+            print("Choose region first")
+            return
+
+        from_date = self.date_from_entry.get()
+        if len(from_date) != 10 or from_date.count("-") != 2:
+            print("Wrong date format")
+            return
+
+        dialog = customtkinter.CTkInputDialog(text="Название региона:", title="Слежение за регионом")
+        name = dialog.get_input()
+        if not name:
+            return
+
+        self.map_widget.watch_ee_region(name, from_date, int(self.cloudiness_slider.get()))
+        print("Region", name, "is watched")
+
+    def sync_watched_regions(self):
+        self.show_download_progress()
+        self.map_widget.sync_watched_regions()
+
+    def show_download_progress(self):
         self.download_button.grid_forget()
-        self.download_progress_bar.grid(row=1, column=0, columnspan=2, pady=(20, 0), padx=(20, 20))
-        self.map_widget.get_ee_image_new(from_date, until_date, cloud,
-                                         forced=self.is_forcing_download)
+        self.download_progress_frame.grid(row=1, column=0, columnspan=2, pady=(20, 0), padx=(20, 20))
+        if self.download_progress_update is None:
+            self.update_download_progress()
+
+    def update_download_progress(self):
+        """Shows progress of downloads, polled while they are shown"""
+        progress = self.map_widget.download_progress.snapshot()
+        self.download_progress_bar.set(progress["fraction"])
+
+        text = f"{progress['done'] + progress['failed']}/{progress['planned']}"
+        if progress["throughput"]:
+            text += f"  {progress['throughput'] / 1024 / 1024:.1f} МБ/с"
+        if progress["eta"] is not None and progress["remaining"]:
+            minutes, seconds = divmod(int(progress["eta"]), 60)
+            text += f"  ~{minutes:02d}:{seconds:02d}"
+        if progress["failed"]:
+            text += f"  ошибок: {progress['failed']}"
+        if not self.map_widget.is_ee_authenticated:
+            text += "  (нужна аутентификация)"
+        self.download_progress_label.configure(text=text)
+
+        self.download_progress_update = self.after(500, self.update_download_progress)
 
     def reset_download_button(self):
-        self.download_progress_bar.grid_forget()
+        if self.download_progress_update is not None:
+            self.after_cancel(self.download_progress_update)
+            self.download_progress_update = None
+        self.download_progress_frame.grid_forget()
         self.download_button.grid(row=1, column=0, columnspan=2, pady=(20, 0), padx=(20, 20))
-        self.map_widget.region_polygon.delete()
-        self.map_widget.region_polygon = None
+        if self.map_widget.region_polygon is not None:
+            self.map_widget.region_polygon.delete()
+            self.map_widget.region_polygon = None
 
     def switch_ee(self):
         self.map_widget.switch_ee()
@@ -852,6 +1130,21 @@ class App(customtkinter.CTk):
             if new_sentinel == name:
                 pass
 
+    def show_last_view_images(self, eeids):
+        for eeid in eeids:
+            row = self.get_ee_image_index(eeid)
+            if row is not None and not self.ee_catalog.deleted[row]:
+                self.load_images_on_map(row, forced_to_show=True)
+
+    def save_last_view(self):
+        view = {"position": list(self.map_widget.get_position()),
+                "zoom": round(self.map_widget.zoom),
+                "server": self.map_widget.tile_server,
+                "size": [self.map_widget.width, self.map_widget.height],
+                "shown_images": self.ee_catalog.ids[self.ee_catalog.shown].tolist()}
+        with open(os.path.join(DATA_FOLDER, LAST_VIEW_FILENAME), "w") as f:
+            json.dump(view, f)
+
     def on_closing(self):
         try:
             if not HIDE_PROXY:
@@ -861,6 +1154,11 @@ class App(customtkinter.CTk):
         except:
             pass
 
+        try:
+            self.save_last_view()
+        except Exception as e:
+            print("Failed to save last view because of", e)
+
         self.destroy()
 
     def start(self):
@@ -874,7 +1172,16 @@ class App(customtkinter.CTk):
             print("Wrong scale format. Using 2 instead")
             return 2
 
+def mark_first_frame(app):
+    # Pending geometry and redraws are idle tasks too, the frame is painted once they are done
+    app.update_idletasks()
+    profiling.mark("first painted frame")
+
+
 if __name__ == "__main__":
     before_start()
-    app = App()
+    with profiling.span("App construction"):
+        app = App()
+    if profiling.ENABLED:
+        app.after_idle(mark_first_frame, app)
     app.start()
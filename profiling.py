@@ -0,0 +1,111 @@
+"""Startup phase profiling, off unless enabled with
+
+    python main.py --profile-startup              prints phases sorted by duration at exit
+    python main.py --profile-startup=trace.json   writes a trace for chrome://tracing or Perfetto as well
+    ERA_PROFILE_STARTUP=1 or ERA_PROFILE_STARTUP=trace.json python main.py
+
+Spans are wall-clock times measured from the import of this module, which main.py imports first
+"""
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+PROFILE_ENV = "ERA_PROFILE_STARTUP"
+PROFILE_FLAG = "--profile-startup"
+
+STARTED = time.perf_counter()
+
+
+def get_profile_setting():
+    """ returns None if profiling is off, True to print the report, or a path to write the trace to as well """
+
+    for argument in sys.argv[1:]:
+        if argument == PROFILE_FLAG:
+            return True
+        if argument.startswith(PROFILE_FLAG + "="):
+            return argument.split("=", 1)[1] or True
+
+    value = os.environ.get(PROFILE_ENV, "")
+    if value.lower() in ("", "0", "false", "no"):
+        return None
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    return value
+
+
+SETTING = get_profile_setting()
+ENABLED = SETTING is not None
+
+spans = []  # (name, start, duration) in seconds from STARTED
+_depth = threading.local()
+
+
+@contextlib.contextmanager
+def _span(name: str):
+    depth = getattr(_depth, "value", 0)
+    _depth.value = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _depth.value = depth
+        spans.append((name, start - STARTED, end - start, depth))
+
+
+def span(name: str):
+    """ context manager timing a phase, does nothing when profiling is off """
+    if not ENABLED:
+        return contextlib.nullcontext()
+    return _span(name)
+
+
+def profiled(name: str):
+    """ decorator timing every call of a function as a phase """
+
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        def wrapper(*args, **kwargs):
+            with _span(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def mark(name: str):
+    """ records a phase from the start of the process until now """
+    if ENABLED:
+        spans.append((name, 0.0, time.perf_counter() - STARTED, 0))
+
+
+def report():
+    if not spans:
+        return
+
+    print(f"Startup phases, {len(spans)} spans:")
+    print(f"{'phase':40} {'start s':>9} {'duration s':>11}")
+    for name, start, duration, depth in sorted(spans, key=lambda item: item[2], reverse=True):
+        print(f"{'  ' * depth + name:40} {start:9.3f} {duration:11.3f}")
+
+    if isinstance(SETTING, str):
+        events = [{"name": name, "ph": "X", "ts": round(start * 1e6), "dur": round(duration * 1e6),
+                   "pid": os.getpid(), "tid": 0}
+                  for name, start, duration, depth in spans]
+        try:
+            with open(SETTING, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            print("Startup trace is written to", SETTING)
+        except OSError as e:
+            print("Failed to write startup trace because of", e)
+
+
+if ENABLED:
+    atexit.register(report)
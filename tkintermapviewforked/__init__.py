@@ -2,6 +2,12 @@ __version__ = "1.29"
 
 from .map_widget import TkinterMapView
 from .offline_loading import OfflineLoader
+from .ee_storage import EEImageStore
+from .ee_codecs import EE_CODECS
+from .ee_catalog import EEImageCatalog
+from .ee_downloads import DownloadQueue, DownloadProgress, EEDownloader
+from .ee_backends import ImageryBackend, EarthEngineBackend, FakeBackend
+from .ee_watch import WatchedRegions
 from .utility_functions import convert_coordinates_to_address, convert_coordinates_to_country, convert_coordinates_to_city
 from .utility_functions import convert_address_to_coordinates
-from .utility_functions import decimal_to_osm, osm_to_decimal
+from .utility_functions import decimal_to_osm, osm_to_decimal, subtract_rectangles
@@ -1,4 +1,5 @@
 import tkinter
+import math
 import sys
 from datetime import datetime
 from typing import TYPE_CHECKING, Callable
@@ -8,6 +9,9 @@ if TYPE_CHECKING:
 
 from .utility_functions import decimal_to_osm, osm_to_decimal
 
+# How far (in pixels) the rendered part of an image reaches beyond the canvas
+RENDER_MARGIN = 256
+
 
 class CanvasEEImage:
     def __init__(self,
@@ -36,6 +40,8 @@ class CanvasEEImage:
 
         self.canvas_icon = None
         self.size = None
+        self.source_box = None  # rendered part of the image in source pixels
+        self.icon_offset = (0, 0)  # canvas offset of the rendered part from the image top left corner
         self.render_icon()
 
         # Map settings
@@ -55,16 +61,61 @@ class CanvasEEImage:
 
         self.cloudiness = int(cloudiness)
 
-    def render_icon(self):
+    def get_source_box(self, margin: int = 0):
+        """Returns the part of the source image (in source pixels) which is visible on canvas
+           extended by margin, canvas position of the whole image and its size on canvas.
+           Box is None if the image is out of view"""
         canvas_x0, canvas_y0 = self.get_canvas_pos(self.position)
         canvas_x1, canvas_y1 = self.get_canvas_pos(self.brposition)
-        self.size = int(canvas_x1 - canvas_x0), int(canvas_y1 - canvas_y0)
+        width, height = canvas_x1 - canvas_x0, canvas_y1 - canvas_y0
 
-        resized_image = self.image.resize(self.size, resample=0)
-        self.icon = ImageTk.PhotoImage(resized_image)
-        self.canvas_icon = None
+        left = max(canvas_x0, -margin)
+        top = max(canvas_y0, -margin)
+        right = min(canvas_x1, self.map_widget.width + margin)
+        bottom = min(canvas_y1, self.map_widget.height + margin)
+        if width <= 0 or height <= 0 or left >= right or top >= bottom:
+            return None, (canvas_x0, canvas_y0), (width, height)
+
+        image_width, image_height = self.image.size
+        box = (max(0, math.floor((left - canvas_x0) / width * image_width)),
+               max(0, math.floor((top - canvas_y0) / height * image_height)),
+               min(image_width, math.ceil((right - canvas_x0) / width * image_width)),
+               min(image_height, math.ceil((bottom - canvas_y0) / height * image_height)))
+
+        return box, (canvas_x0, canvas_y0), (width, height)
 
+    def render_icon(self):
+        """Renders only the visible part of the image (plus RENDER_MARGIN around the canvas),
+           so the icon is never larger than the canvas no matter how close the zoom is"""
         self.zoom = self.map_widget.zoom
+        box, _, (width, height) = self.get_source_box(RENDER_MARGIN)
+        self.size = int(width), int(height)
+
+        if box is None:
+            self.icon = None
+            self.source_box = None
+            return
+
+        image_width, image_height = self.image.size
+        # Crop first, so we never resize the whole image to the on-screen size
+        cropped_image = self.image.crop(box)
+        icon_size = (max(1, round((box[2] - box[0]) / image_width * width)),
+                     max(1, round((box[3] - box[1]) / image_height * height)))
+
+        self.icon = ImageTk.PhotoImage(cropped_image.resize(icon_size, resample=0))
+        self.source_box = box
+        self.icon_offset = box[0] / image_width * width, box[1] / image_height * height
+
+        if self.canvas_icon is not None:
+            self.map_widget.canvas.itemconfigure(self.canvas_icon, image=self.icon)
+
+    def is_render_outdated(self, visible_box):
+        """Checks if panning exposed a part of the image which was not rendered"""
+        if self.zoom != self.map_widget.zoom or self.source_box is None:
+            return True
+
+        return not (self.source_box[0] <= visible_box[0] and self.source_box[1] <= visible_box[1]
+                    and visible_box[2] <= self.source_box[2] and visible_box[3] <= self.source_box[3])
 
     def delete(self):
         if self in self.map_widget.canvas_ee_image_list:
@@ -99,6 +150,14 @@ class CanvasEEImage:
         return canvas_pos_x, canvas_pos_y
 
     def is_fit_with_map_settings(self):
+        # Previews of downloads are not stored and are always shown
+        if self.eeid is None:
+            return True
+
+        # Stored images are looked up in the images index once per settings change
+        if self.map_widget.fit_ee_ids is not None:
+            return self.eeid in self.map_widget.fit_ee_ids
+
         is_fdate_fit = self.map_widget.date_from <= self.fdate <= self.map_widget.date_until
         is_ldate_fit = self.map_widget.date_from <= self.ldate <= self.map_widget.date_until
         is_cloudiness_fit = self.cloudiness <= self.map_widget.cloudiness
@@ -115,20 +174,19 @@ class CanvasEEImage:
         #     self.canvas_icon = None
 
 
-        canvas_pos_x, canvas_pos_y = self.get_canvas_pos(self.position)
-
-        # print(f"canvas_pos_x, canvas_pos_y {canvas_pos_x, canvas_pos_y}")
-        # print(f"self.position {self.position}")
-
         if not self.deleted:
-            if self.map_widget.use_ee_database and -self.size[0] - 50 < canvas_pos_x < self.map_widget.width + 50 \
-                    and -self.size[1] < canvas_pos_y < self.map_widget.height + 70\
+            visible_box, (canvas_pos_x, canvas_pos_y), _ = self.get_source_box()
+
+            if self.map_widget.use_ee_database and visible_box is not None \
                     and (self.is_fit_with_map_settings() or not self.map_widget.get_fit_image_draw()):
 
-                if self.zoom != self.map_widget.zoom:
+                if self.is_render_outdated(visible_box):
                     self.render_icon()
 
                 if self.icon is not None:
+                    canvas_pos_x += self.icon_offset[0]
+                    canvas_pos_y += self.icon_offset[1]
+
                     if self.canvas_icon is None:
                         self.canvas_icon = self.map_widget.canvas.create_image(canvas_pos_x, canvas_pos_y,
                                                                                anchor=self.icon_anchor,
@@ -0,0 +1,114 @@
+import math
+from typing import TYPE_CHECKING
+
+import numpy
+from PIL import Image, ImageTk
+if TYPE_CHECKING:
+    from .map_widget import TkinterMapView
+
+from .tile_storage import TileCoverage
+
+# How far (in pixels) the rendered part of the overlay reaches beyond the canvas
+RENDER_MARGIN = 256
+# Bitmap cells are sampled every few canvas pixels, cells are never smaller than a tile of the zoom
+SAMPLE_STEP = 4
+COVERAGE_COLOR = (0, 120, 255, 70)
+
+
+class CanvasTileCoverage:
+    """ Semi-transparent overlay of cells of the coverage bitmap which have stored tiles of the shown zoom """
+
+    def __init__(self, map_widget: "TkinterMapView", coverage: TileCoverage, color: tuple = COVERAGE_COLOR):
+        self.map_widget = map_widget
+        self.coverage = coverage
+        self.color = color
+
+        self.icon = None
+        self.canvas_icon = None
+        self.rendered_key = None  # (server, zoom, coverage version) of the rendered icon
+        self.tile_box = None  # rendered part in tile coordinates of the zoom
+
+    def get_visible_tile_box(self, margin: int = 0) -> tuple:
+        """ returns (left, top, right, bottom) of the canvas extended by margin pixels in tile coordinates """
+        upper_left = self.map_widget.upper_left_tile_pos
+        lower_right = self.map_widget.lower_right_tile_pos
+        margin_x = margin * (lower_right[0] - upper_left[0]) / self.map_widget.width
+        margin_y = margin * (lower_right[1] - upper_left[1]) / self.map_widget.height
+        return upper_left[0] - margin_x, upper_left[1] - margin_y, lower_right[0] + margin_x, lower_right[1] + margin_y
+
+    def get_canvas_pos(self, tile_x: float, tile_y: float) -> tuple:
+        upper_left = self.map_widget.upper_left_tile_pos
+        lower_right = self.map_widget.lower_right_tile_pos
+        return ((tile_x - upper_left[0]) / (lower_right[0] - upper_left[0]) * self.map_widget.width,
+                (tile_y - upper_left[1]) / (lower_right[1] - upper_left[1]) * self.map_widget.height)
+
+    def render_icon(self, key: tuple, zoom: int, bitmap_zoom: int, bitmap: numpy.ndarray):
+        """ renders only the visible part of the bitmap (plus RENDER_MARGIN around the canvas) """
+        self.tile_box = self.get_visible_tile_box(RENDER_MARGIN)
+        self.rendered_key = key
+        left, top, right, bottom = self.tile_box
+        canvas_left, canvas_top = self.get_canvas_pos(left, top)
+        canvas_right, canvas_bottom = self.get_canvas_pos(right, bottom)
+        width = max(1, round(canvas_right - canvas_left))
+        height = max(1, round(canvas_bottom - canvas_top))
+
+        # Cells under every SAMPLE_STEP-th pixel, tiles of the zoom per bitmap cell is a power of two
+        cell_size = 2 ** (zoom - bitmap_zoom)
+        size = bitmap.shape[0]
+        columns = numpy.floor((left + (numpy.arange(0, width, SAMPLE_STEP) + 0.5) / width * (right - left)) / cell_size).astype(int)
+        rows = numpy.floor((top + (numpy.arange(0, height, SAMPLE_STEP) + 0.5) / height * (bottom - top)) / cell_size).astype(int)
+        valid_columns = (columns >= 0) & (columns < size)
+        valid_rows = (rows >= 0) & (rows < size)
+
+        covered = bitmap[rows.clip(0, size - 1)][:, columns.clip(0, size - 1)] & valid_rows[:, None] & valid_columns[None, :]
+        if not covered.any():
+            self.icon = None
+            return
+
+        pixels = numpy.zeros((*covered.shape, 4), dtype=numpy.uint8)
+        pixels[covered] = self.color
+        self.icon = ImageTk.PhotoImage(Image.fromarray(pixels, mode="RGBA").resize((width, height), resample=Image.NEAREST))
+        if self.canvas_icon is not None:
+            self.map_widget.canvas.itemconfigure(self.canvas_icon, image=self.icon)
+
+    def is_render_outdated(self, key: tuple) -> bool:
+        """ checks if the bitmap changed or panning exposed a part which was not rendered """
+        if key != self.rendered_key or self.tile_box is None:
+            return True
+
+        left, top, right, bottom = self.get_visible_tile_box()
+        return not (self.tile_box[0] <= left and self.tile_box[1] <= top
+                    and right <= self.tile_box[2] and bottom <= self.tile_box[3])
+
+    def draw(self):
+        zoom = round(self.map_widget.zoom)
+        server = self.map_widget.tile_server
+        found = self.coverage.get(server, zoom)
+        if found is None:
+            self.delete()
+            return
+
+        bitmap_zoom, bitmap = found
+        key = (server, zoom, self.coverage.version)
+        if self.is_render_outdated(key):
+            self.render_icon(key, zoom, bitmap_zoom, bitmap)
+
+        if self.icon is None:
+            self.map_widget.canvas.delete(self.canvas_icon)
+            self.canvas_icon = None
+            return
+
+        canvas_pos_x, canvas_pos_y = self.get_canvas_pos(self.tile_box[0], self.tile_box[1])
+        if self.canvas_icon is None:
+            self.canvas_icon = self.map_widget.canvas.create_image(math.floor(canvas_pos_x), math.floor(canvas_pos_y),
+                                                                   anchor="nw", image=self.icon, tag="tile_coverage")
+        else:
+            self.map_widget.canvas.coords(self.canvas_icon, math.floor(canvas_pos_x), math.floor(canvas_pos_y))
+        self.map_widget.manage_z_order()
+
+    def delete(self):
+        self.map_widget.canvas.delete(self.canvas_icon)
+        self.canvas_icon = None
+        self.icon = None
+        self.rendered_key = None
+        self.tile_box = None
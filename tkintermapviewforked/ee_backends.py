@@ -0,0 +1,253 @@
+import io
+import math
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple, Union
+
+import numpy
+import requests
+from PIL import Image
+
+from .ee_downloads import DownloadChunk, DownloadQueue, RegionTooLargeError
+from .ee_processing import EE_IMAGE_DARKNESS, get_region_dimensions
+from .ee_scenes import Scene, SceneQueryCache
+from .lazy_imports import get_ee, get_geemap
+
+EE_COLLECTION = 'COPERNICUS/S2_SR_HARMONIZED'
+EE_PROJECT = "ee-era"
+
+
+class ImageryBackend:
+    """ Source of RGB band arrays for download chunks
+        list_scenes returns scenes which fit the chunk filters, newest first,
+        fetch returns array of shape (height, width, 3) of the scene or of the newest fitting scene if it is None,
+        uint8 if chunk.visualized, and raises RegionTooLargeError if the chunk has to be split """
+
+    name = "base"
+    scene_cache: Union[SceneQueryCache, None] = None
+
+    def authenticate(self):
+        pass
+
+    def is_ready(self) -> bool:
+        return True
+
+    def list_scenes(self, chunk: DownloadChunk) -> list:
+        raise NotImplementedError
+
+    def find_scenes(self, chunk: DownloadChunk) -> list:
+        """ returns list_scenes result, from the cache if the same query was made recently """
+
+        if self.scene_cache is None:
+            return self.list_scenes(chunk)
+
+        key = self.scene_cache.make_key(getattr(self, "collection_id", self.name), chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd,
+                                        chunk.fdate, chunk.ldate, chunk.cloudiness)
+        scenes = self.scene_cache.get(key)
+        if scenes is None:
+            scenes = self.list_scenes(chunk)
+            self.scene_cache.put(key, scenes)
+        return scenes
+
+    def fetch(self, chunk: DownloadChunk, scene: Scene = None) -> numpy.ndarray:
+        raise NotImplementedError
+
+
+class FetchResult(NamedTuple):
+    image: Union[numpy.ndarray, None]  # None if the scene is already stored or nothing fits the filters
+    scene: Union[Scene, None]
+    eeid: Union[int, None]  # stored image of the scene
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.image is None else self.image.nbytes
+
+
+def find_new_scenes(backend: ImageryBackend, queue: DownloadQueue, chunk: DownloadChunk) -> list:
+    """ returns scenes which fit the chunk filters and are not queued or downloaded for its region yet """
+
+    known = queue.find_queued_scenes(chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd)
+    return [scene for scene in backend.find_scenes(chunk) if scene.id not in known]
+
+
+def fetch_chunk(backend: ImageryBackend, queue: DownloadQueue, chunk: DownloadChunk) -> FetchResult:
+    """ finds the newest scene for the chunk if its scene is not chosen
+        and downloads it unless it was already downloaded for this region """
+
+    scene = chunk.scene
+    if scene is None:
+        scenes = backend.find_scenes(chunk)
+        if not scenes:
+            print("No scenes fit the filters")
+            return FetchResult(None, None, None)
+        scene = scenes[0]
+
+    eeid = queue.find_stored_scene(scene.id, chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd)
+    if eeid is not None:
+        print("Scene", scene.id, "is already stored")
+        return FetchResult(None, scene, eeid)
+
+    return FetchResult(backend.fetch(chunk, scene), scene, None)
+
+
+class EarthEngineBackend(ImageryBackend):
+    """ Downloads the newest image of the collection which fits the chunk filters """
+
+    name = "earthengine"
+
+    def __init__(self, collection_id: str = EE_COLLECTION, project: str = EE_PROJECT,
+                 scene_cache: SceneQueryCache = None):
+        self.collection_id = collection_id
+        self.scene_cache = scene_cache
+        self.project = project
+        self.collection = None
+        self.is_authenticated = False
+
+    def authenticate(self):
+        ee = get_ee()
+        ee.Authenticate()
+        ee.Initialize(project=self.project)
+        self.is_authenticated = True
+
+    def is_ready(self) -> bool:
+        return self.is_authenticated
+
+    def get_collection(self, bbox, fdate: str, ldate: str, cloud: int):
+        ee = get_ee()
+        if self.collection is None:
+            self.collection = ee.ImageCollection(self.collection_id)
+
+        return (self.collection
+                .filterBounds(bbox)  # Фильтруем по области
+                .filterDate(fdate, ldate)  # Укажите нужный диапазон дат example: '2023-09-30' YYYY-MM-DD
+                #.filter(ee.Filter.gt('CLOUDY_PIXEL_PERCENTAGE', max(0, cloud - 10)))
+                .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', min(100, cloud + 10)))
+                #.sort('CLOUDY_PIXEL_PERCENTAGE')
+                .sort('system:time_start', False))  # Сортируем по времени (последние изображения первыми)
+
+    def list_scenes(self, chunk: DownloadChunk) -> list:
+        ee = get_ee()
+        bbox = ee.Geometry.BBox(chunk.tlyd, chunk.brxd, chunk.bryd, chunk.tlxd)
+        # One round trip for ids, times and cloudiness of all fitting scenes
+        rows = (self.get_collection(bbox, chunk.fdate, chunk.ldate, chunk.cloudiness)
+                .reduceColumns(ee.Reducer.toList(3), ['system:index', 'system:time_start', 'CLOUDY_PIXEL_PERCENTAGE'])
+                .get('list')
+                .getInfo())
+        return sorted((Scene(*row) for row in rows), key=lambda scene: scene.time, reverse=True)
+
+    def fetch(self, chunk: DownloadChunk, scene: Scene = None) -> numpy.ndarray:
+        ee = get_ee()
+        bbox = ee.Geometry.BBox(chunk.tlyd, chunk.brxd, chunk.bryd, chunk.tlxd)
+        if scene is not None:
+            ee_image = ee.Image(f"{self.collection_id}/{scene.id}")
+        else:
+            ee_image = self.get_collection(bbox, chunk.fdate, chunk.ldate, chunk.cloudiness).first()
+
+        try:
+            if chunk.visualized:
+                rgb_img = self.download_visualized(ee_image, bbox, chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd,
+                                                   chunk.scale)
+            else:
+                rgb_img = get_geemap().ee_to_numpy(ee_image, bands=['B4', 'B3', 'B2'],
+                                                   region=bbox, scale=chunk.scale)
+
+        except Exception as e:
+            if str(e).startswith("Total"):
+                # Too large image exception handle
+                raise RegionTooLargeError(e)
+            raise
+
+        if rgb_img is None:
+            raise Exception("Earth Engine returned no image")
+        return rgb_img
+
+    @staticmethod
+    def download_visualized(ee_image, bbox, tlxd, tlyd, brxd, bryd, scale) -> numpy.ndarray:
+        """ downloads EE image visualized to 8 bit RGB on the server as PNG and decodes it
+            straight to numpy array, so there are less bytes to transfer and nothing to convert """
+
+        width, height = get_region_dimensions(tlxd, tlyd, brxd, bryd, scale)
+        url = (ee_image
+               .visualize(bands=['B4', 'B3', 'B2'], min=0, max=255 * EE_IMAGE_DARKNESS)
+               .getThumbURL({"region": bbox, "dimensions": f"{width}x{height}", "format": "png"}))
+
+        answer = requests.get(url)
+        if answer.status_code != 200:
+            try:
+                message = answer.json()["error"]["message"]
+            except Exception:
+                message = answer.text
+            # Keeps "Total request size..." message for splitting
+            raise Exception(message)
+
+        return numpy.asarray(Image.open(io.BytesIO(answer.content)).convert("RGB"))
+
+
+class FakeBackend(ImageryBackend):
+    """ Offline backend synthesizing deterministic band arrays, same chunk always gives the same array
+        size is (width, height) or None to use the chunk region at its scale,
+        latency is seconds of waiting per fetch and query_latency per scenes query,
+        chunks larger than max_pixels are split like in EE,
+        border is the part of width left black like at the edge of a satellite swath,
+        a scene is made every revisit days for each 1 degree cell """
+
+    name = "fake"
+
+    def __init__(self, size: tuple = None, latency: float = 0.0, max_pixels: int = None,
+                 border: float = 0.1, seed: int = 0, query_latency: float = 0.0, revisit: int = 5,
+                 scene_cache: SceneQueryCache = None):
+        self.size = size
+        self.latency = latency
+        self.max_pixels = max_pixels
+        self.border = border
+        self.seed = seed
+        self.query_latency = query_latency
+        self.revisit = revisit
+        self.scene_cache = scene_cache
+
+    def list_scenes(self, chunk: DownloadChunk) -> list:
+        if self.query_latency:
+            time.sleep(self.query_latency)
+
+        cell = f"{math.floor((chunk.tlxd + chunk.brxd) / 2)}_{math.floor((chunk.tlyd + chunk.bryd) / 2)}"
+        day = date.fromisoformat(chunk.fdate)
+        last_day = date.fromisoformat(chunk.ldate)
+        scenes = []
+        while day < last_day:
+            # Most scenes are clear like in real collections
+            cloudiness = (zlib.crc32(f"{self.seed} {cell} {day}".encode()) % 100) ** 2 / 100
+            if cloudiness < min(100, chunk.cloudiness + 10):
+                acquired = datetime(day.year, day.month, day.day, 8, 30, tzinfo=timezone.utc)
+                scenes.append(Scene(f"FAKE_{day:%Y%m%d}_{cell}", int(acquired.timestamp() * 1000), cloudiness))
+            day += timedelta(days=self.revisit)
+        return scenes[::-1]
+
+    def fetch(self, chunk: DownloadChunk, scene: Scene = None) -> numpy.ndarray:
+        if self.size is not None:
+            width, height = self.size
+        else:
+            width, height = get_region_dimensions(chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd, chunk.scale)
+
+        if self.max_pixels is not None and width * height > self.max_pixels:
+            raise RegionTooLargeError(f"Total request size ({width * height * 3 * 8} bytes) must be less than or equal to {self.max_pixels * 3 * 8} bytes.")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        key = f"{chunk.tlxd:.6f} {chunk.tlyd:.6f} {chunk.brxd:.6f} {chunk.bryd:.6f} {chunk.fdate} {chunk.ldate}"
+        if scene is not None:
+            key += " " + scene.id
+        rng = numpy.random.default_rng([self.seed, zlib.crc32(key.encode())])
+
+        # Smooth gradient with noise in the range of surface reflectance
+        rows = numpy.linspace(0, 1, height, dtype=numpy.float32)[:, None, None]
+        columns = numpy.linspace(0, 1, width, dtype=numpy.float32)[None, :, None]
+        base = rng.uniform(300, 1500, 3).astype(numpy.float32)
+        bands = base + 800 * rows + 600 * columns + rng.normal(0, 50, (height, width, 3)).astype(numpy.float32)
+        bands = bands.clip(1, 2550).astype(numpy.uint16)
+        bands[:, :int(width * self.border)] = 0
+
+        if chunk.visualized:
+            return numpy.minimum(255, bands // EE_IMAGE_DARKNESS).astype(numpy.uint8)
+        return bands
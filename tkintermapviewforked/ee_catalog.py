@@ -0,0 +1,91 @@
+from datetime import date
+from typing import Union
+
+import numpy
+
+from .ee_storage import to_day_number
+
+
+class EEImageCatalog:
+    """ Metadata of stored EE images kept in columns, one row per image in load order,
+        so filters over all images are vectorized expressions
+        Columns are replaced on extend, so the catalog is changed only from the Tk loop """
+
+    def __init__(self):
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.bounds = numpy.empty((0, 4), dtype=numpy.float64)  # tlxd, tlyd, brxd, bryd
+        self.centers = numpy.empty((0, 2), dtype=numpy.float64)  # lat, lon
+        self.fdays = numpy.empty(0, dtype=numpy.int32)
+        self.ldays = numpy.empty(0, dtype=numpy.int32)
+        self.cloudiness = numpy.empty(0, dtype=numpy.float32)
+        # dates are kept as given for labels
+        self.fdates = []
+        self.ldates = []
+
+        self.listed = numpy.empty(0, dtype=bool)  # row frame is shown in the images list
+        self.shown = numpy.empty(0, dtype=bool)  # image is shown on the map
+        self.deleted = numpy.empty(0, dtype=bool)
+
+        self.rows = {}  # eeid -> row
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, items: list) -> range:
+        """ appends (eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness) items and returns their rows """
+
+        start = len(self.ids)
+        if not items:
+            return range(start, start)
+
+        ids, tlxd, tlyd, brxd, bryd, fdates, ldates, cloudiness = zip(*items)
+        bounds = numpy.array((tlxd, tlyd, brxd, bryd), dtype=numpy.float64).T
+        false = numpy.zeros(len(items), dtype=bool)
+
+        self.ids = numpy.concatenate((self.ids, numpy.array(ids, dtype=numpy.int64)))
+        self.bounds = numpy.concatenate((self.bounds, bounds))
+        self.centers = numpy.concatenate((self.centers, (bounds[:, 0:2] + bounds[:, 2:4]) / 2))
+        self.fdays = numpy.concatenate((self.fdays, numpy.array([to_day_number(str(d)) for d in fdates], dtype=numpy.int32)))
+        self.ldays = numpy.concatenate((self.ldays, numpy.array([to_day_number(str(d)) for d in ldates], dtype=numpy.int32)))
+        self.cloudiness = numpy.concatenate((self.cloudiness, numpy.array([float(c) for c in cloudiness], dtype=numpy.float32)))
+        self.fdates.extend(fdates)
+        self.ldates.extend(ldates)
+        self.listed = numpy.concatenate((self.listed, false))
+        self.shown = numpy.concatenate((self.shown, false))
+        self.deleted = numpy.concatenate((self.deleted, false))
+
+        for row, eeid in enumerate(ids, start):
+            self.rows[eeid] = row
+        return range(start, len(self.ids))
+
+    def row_of(self, eeid: int) -> Union[int, None]:
+        return self.rows.get(eeid)
+
+    def item(self, row: int) -> tuple:
+        tlxd, tlyd, brxd, bryd = self.bounds[row].tolist()
+        cloudiness = self.cloudiness[row].item()
+        return (int(self.ids[row]), tlxd, tlyd, brxd, bryd, self.fdates[row], self.ldates[row],
+                int(cloudiness) if cloudiness.is_integer() else cloudiness)
+
+    def items(self, rows) -> list:
+        return [self.item(row) for row in rows]
+
+    @property
+    def last_eeid(self) -> Union[int, None]:
+        if not len(self.ids):
+            return None
+        return int(self.ids[-1])
+
+    def near(self, position: tuple, distance: float) -> numpy.ndarray:
+        """ returns mask of existing images whose center is closer than distance to position on both axes """
+
+        return numpy.all(numpy.abs(self.centers - position) < distance, axis=1) & ~self.deleted
+
+    def fitting(self, date_from: Union[str, date], date_until: Union[str, date], cloudiness: int) -> numpy.ndarray:
+        """ returns mask of existing images which fit the date range and cloudiness """
+
+        return ((self.fdays >= to_day_number(date_from)) & (self.ldays <= to_day_number(date_until))
+                & (self.cloudiness <= cloudiness) & ~self.deleted)
+
+    def fitting_ids(self, date_from: Union[str, date], date_until: Union[str, date], cloudiness: int) -> set:
+        return set(self.ids[self.fitting(date_from, date_until, cloudiness)].tolist())
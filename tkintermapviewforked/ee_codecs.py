@@ -0,0 +1,156 @@
+import io
+import struct
+import zlib
+
+import numpy
+from PIL import Image
+
+# png - RGBA PNG, webp - lossless RGBA WebP, jpeg - RGB JPEG with 1 bit alpha mask as PNG,
+# raw - zlib-compressed RGBA planes
+EE_CODECS = ("png", "webp", "jpeg", "raw")
+DEFAULT_CODEC = "png"
+JPEG_QUALITY = 90
+RAW_COMPRESSION_LEVEL = 6
+
+# (width, height) of raw images, (JPEG length) of jpeg images
+RAW_HEADER = struct.Struct(">II")
+JPEG_HEADER = struct.Struct(">I")
+
+
+def encode_image_data(image: Image.Image, codec: str = DEFAULT_CODEC) -> bytes:
+    """ encodes an RGBA image with a codec of EE_CODECS """
+
+    image = image.convert("RGBA")
+    buffer = io.BytesIO()
+
+    if codec == "png":
+        image.save(buffer, format="PNG")
+
+    elif codec == "webp":
+        # exact keeps colors of transparent pixels
+        image.save(buffer, format="WEBP", lossless=True, exact=True, method=4)
+
+    elif codec == "jpeg":
+        # Transparent pixels are only at the edges of the swath, so a bit per pixel is enough
+        image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY)
+        jpeg_length = buffer.tell()
+        image.getchannel("A").point(lambda alpha: 255 if alpha else 0).convert("1").save(buffer, format="PNG")
+        return JPEG_HEADER.pack(jpeg_length) + buffer.getvalue()
+
+    elif codec == "raw":
+        # Planes compress better than interleaved pixels
+        planes = numpy.ascontiguousarray(numpy.asarray(image).transpose(2, 0, 1))
+        return RAW_HEADER.pack(*image.size) + zlib.compress(planes.tobytes(), RAW_COMPRESSION_LEVEL)
+
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+
+    return buffer.getvalue()
+
+
+class FileSection(io.RawIOBase):
+    """ read-only file of length bytes of another file starting at offset """
+
+    def __init__(self, file, offset: int, length: int):
+        super().__init__()
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = min(max(0, offset), self.length)
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.length - self.position:
+            size = self.length - self.position
+        self.file.seek(self.offset + self.position)
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def decode_image_file(file, length: int, codec: str = DEFAULT_CODEC, max_size: tuple = None,
+                      chunk_size: int = 1 << 20) -> Image.Image:
+    """ decodes an image encoded with encode_image_data reading it from a file in parts,
+        JPEG images are decoded reduced to at least max_size if it is given, other codecs in full size """
+
+    if codec in ("png", "webp", None):
+        # Blobs do not have every method of files some image plugins check formats with
+        image = Image.open(FileSection(file, 0, length), formats=("WEBP",) if codec == "webp" else ("PNG",))
+        image.load()
+        return image
+
+    if codec == "jpeg":
+        jpeg_length, = JPEG_HEADER.unpack(file.read(JPEG_HEADER.size))
+        start = JPEG_HEADER.size
+        image = Image.open(FileSection(file, start, jpeg_length), formats=("JPEG",))
+        if max_size is not None:
+            image.draft("RGB", max_size)
+        image = image.convert("RGBA")
+
+        mask = Image.open(FileSection(file, start + jpeg_length, length - start - jpeg_length),
+                          formats=("PNG",)).convert("L")
+        if mask.size != image.size:
+            mask = mask.resize(image.size, resample=Image.NEAREST)
+        image.putalpha(mask)
+        return image
+
+    if codec == "raw":
+        width, height = RAW_HEADER.unpack(file.read(RAW_HEADER.size))
+        planes = numpy.empty(4 * width * height, dtype=numpy.uint8)
+        decompressor = zlib.decompressobj()
+        position = 0
+        while position < planes.size:
+            data = decompressor.unconsumed_tail or file.read(chunk_size)
+            if not data:
+                break
+            # Output is limited too, compressed planes can be much smaller than decompressed ones
+            data = decompressor.decompress(data, chunk_size)
+            planes[position:position + len(data)] = numpy.frombuffer(data, dtype=numpy.uint8)
+            position += len(data)
+        # Merging planes interleaves them without another copy of the array
+        return Image.merge("RGBA", [Image.frombuffer("L", (width, height), plane, "raw", "L", 0, 1)
+                                    for plane in planes.reshape(4, -1)])
+
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decode_image_data(data: bytes, codec: str = DEFAULT_CODEC) -> Image.Image:
+    """ decodes an image encoded with encode_image_data, PNG and WebP images are decoded lazily """
+
+    if codec in ("png", "webp", None):
+        return Image.open(io.BytesIO(data))
+
+    if codec == "jpeg":
+        jpeg_length, = JPEG_HEADER.unpack_from(data)
+        start = JPEG_HEADER.size
+        image = Image.open(io.BytesIO(data[start:start + jpeg_length])).convert("RGBA")
+        image.putalpha(Image.open(io.BytesIO(data[start + jpeg_length:])).convert("L"))
+        return image
+
+    if codec == "raw":
+        width, height = RAW_HEADER.unpack_from(data)
+        planes = numpy.frombuffer(zlib.decompress(data[RAW_HEADER.size:]), dtype=numpy.uint8)
+        return Image.fromarray(numpy.ascontiguousarray(planes.reshape(4, height, width).transpose(1, 2, 0)), mode="RGBA")
+
+    raise ValueError(f"Unknown codec {codec}")
@@ -0,0 +1,438 @@
+import sqlite3
+import threading
+import time
+from typing import Callable, NamedTuple, Union
+
+from .ee_scenes import Scene
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SPLIT = "split"
+
+
+class RegionTooLargeError(Exception):
+    """ raised by a fetch function when the chunk is too large to be downloaded at once """
+
+
+class DownloadChunk(NamedTuple):
+    id: int
+    job_id: int
+    tlxd: float
+    tlyd: float
+    brxd: float
+    bryd: float
+    fdate: str
+    ldate: str
+    cloudiness: int
+    visualized: bool
+    scale: float
+    attempts: int
+    scene: Union[Scene, None] = None  # scene to download, the newest fitting one if None
+
+
+class DownloadQueue:
+    """ Download jobs and their chunks kept in the EE database,
+        so downloads survive errors and restarts of the app """
+
+    def __init__(self, path: str, max_attempts: int = 6, backoff: float = 5, max_backoff: float = 600):
+        self.db_path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def add_job(self, regions: list, fdate: str, ldate: str, cloudiness: int,
+                visualized: bool, scale: float) -> int:
+        """ adds a job with a chunk per (tlxd, tlyd, brxd, bryd) region and returns its id """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("INSERT INTO download_jobs (fdate, ldate, cloudiness, visualized, scale, state, created) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                          (fdate, ldate, cloudiness, int(visualized), scale, PENDING, time.time()))
+        job_id = db_cursor.lastrowid
+        db_cursor.executemany("INSERT INTO download_chunks (job_id, tlxd, tlyd, brxd, bryd, state) VALUES (?, ?, ?, ?, ?, ?);",
+                              [(job_id, *region, PENDING) for region in regions])
+        db_connection.commit()
+        db_connection.close()
+        return job_id
+
+    def add_scenes_job(self, region: tuple, scenes: list, fdate: str, ldate: str, cloudiness: int,
+                       visualized: bool, scale: float) -> int:
+        """ adds a job with a chunk per scene of the (tlxd, tlyd, brxd, bryd) region and returns its id """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("INSERT INTO download_jobs (fdate, ldate, cloudiness, visualized, scale, state, created) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                          (fdate, ldate, cloudiness, int(visualized), scale, PENDING, time.time()))
+        job_id = db_cursor.lastrowid
+        db_cursor.executemany("""INSERT INTO download_chunks (job_id, tlxd, tlyd, brxd, bryd, state, scene_id, scene_time, scene_cloudiness)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                              [(job_id, *region, PENDING, *scene) for scene in scenes])
+        db_connection.commit()
+        db_connection.close()
+        return job_id
+
+    def find_queued_scenes(self, tlxd, tlyd, brxd, bryd) -> set:
+        """ returns ids of scenes queued, downloaded or split into quarters for chunks containing the region """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""SELECT DISTINCT scene_id FROM download_chunks
+                              WHERE scene_id IS NOT NULL AND state IN (?, ?, ?, ?)
+                                AND min(tlxd, brxd) <= ? AND max(tlxd, brxd) >= ?
+                                AND min(tlyd, bryd) <= ? AND max(tlyd, bryd) >= ?;""",
+                          (PENDING, RUNNING, DONE, SPLIT, min(tlxd, brxd), max(tlxd, brxd), min(tlyd, bryd), max(tlyd, bryd)))
+        scene_ids = {scene_id for scene_id, in db_cursor.fetchall()}
+        db_connection.close()
+        return scene_ids
+
+    def find_failed_scenes(self, tlxd, tlyd, brxd, bryd) -> dict:
+        """ returns {scene id: acquisition time} of scenes which failed for chunks containing the region
+            and are not queued, downloaded or split into quarters again """
+
+        area = (min(tlxd, brxd), max(tlxd, brxd), min(tlyd, bryd), max(tlyd, bryd))
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""SELECT scene_id, min(scene_time) FROM download_chunks
+                              WHERE scene_id IS NOT NULL AND state=?
+                                AND min(tlxd, brxd) <= ? AND max(tlxd, brxd) >= ?
+                                AND min(tlyd, bryd) <= ? AND max(tlyd, bryd) >= ?
+                                AND scene_id NOT IN (SELECT scene_id FROM download_chunks
+                                                      WHERE scene_id IS NOT NULL AND state IN (?, ?, ?, ?)
+                                                        AND min(tlxd, brxd) <= ? AND max(tlxd, brxd) >= ?
+                                                        AND min(tlyd, bryd) <= ? AND max(tlyd, bryd) >= ?)
+                              GROUP BY scene_id;""",
+                          (FAILED, *area, PENDING, RUNNING, DONE, SPLIT, *area))
+        scenes = dict(db_cursor.fetchall())
+        db_connection.close()
+        return scenes
+
+    def resume(self) -> int:
+        """ returns chunks left running by a closed app to the queue and returns the number of unfinished chunks """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("UPDATE download_chunks SET state=? WHERE state=?;", (PENDING, RUNNING))
+        db_connection.commit()
+        db_connection.close()
+        return self.count_unfinished()
+
+    def count_unfinished(self, job_id: int = None) -> int:
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        if job_id is None:
+            db_cursor.execute("SELECT count(*) FROM download_chunks WHERE state IN (?, ?);", (PENDING, RUNNING))
+        else:
+            db_cursor.execute("SELECT count(*) FROM download_chunks WHERE job_id=? AND state IN (?, ?);",
+                              (job_id, PENDING, RUNNING))
+        count = db_cursor.fetchone()[0]
+        db_connection.close()
+        return count
+
+    def take_chunk(self) -> Union[DownloadChunk, None]:
+        """ marks the next due pending chunk as running and returns it """
+
+        with self.lock:
+            db_connection = self.connect()
+            db_cursor = db_connection.cursor()
+            db_cursor.execute("""SELECT c.id, c.job_id, c.tlxd, c.tlyd, c.brxd, c.bryd,
+                                        j.fdate, j.ldate, j.cloudiness, j.visualized, j.scale, c.attempts,
+                                        c.scene_id, c.scene_time, c.scene_cloudiness
+                                   FROM download_chunks c, download_jobs j
+                                  WHERE c.state=? AND c.next_attempt <= ? AND j.id = c.job_id
+                                  ORDER BY c.next_attempt, c.id LIMIT 1;""",
+                              (PENDING, time.time()))
+            row = db_cursor.fetchone()
+            if row is not None:
+                db_cursor.execute("UPDATE download_chunks SET state=? WHERE id=?;", (RUNNING, row[0]))
+                db_cursor.execute("UPDATE download_jobs SET state=? WHERE id=?;", (RUNNING, row[1]))
+                db_connection.commit()
+            db_connection.close()
+
+        if row is None:
+            return None
+        # Scene time is known only for chunks of a chosen scene
+        scene = Scene(*row[12:15]) if row[13] is not None else None
+        return DownloadChunk(*row[:9], bool(row[9]), *row[10:12], scene)
+
+    def next_attempt_delay(self) -> Union[float, None]:
+        """ returns seconds until the earliest pending chunk is due or None if nothing is pending """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT min(next_attempt) FROM download_chunks WHERE state=?;", (PENDING,))
+        next_attempt = db_cursor.fetchone()[0]
+        db_connection.close()
+
+        if next_attempt is None:
+            return None
+        return max(0.0, next_attempt - time.time())
+
+    def complete_chunk(self, chunk: DownloadChunk, eeid: Union[int, None], scene_id: str = None):
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("UPDATE download_chunks SET state=?, eeid=?, scene_id=?, error=NULL WHERE id=?;",
+                          (DONE, eeid, scene_id, chunk.id))
+        self.update_job_state(db_cursor, chunk.job_id)
+        db_connection.commit()
+        db_connection.close()
+
+    def find_stored_scene(self, scene_id: str, tlxd, tlyd, brxd, bryd) -> Union[int, None]:
+        """ returns id of a stored image of the scene downloaded for a chunk containing the region """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""SELECT c.eeid FROM download_chunks c, images i
+                              WHERE c.scene_id=? AND c.state=? AND i.id = c.eeid
+                                AND min(c.tlxd, c.brxd) <= ? AND max(c.tlxd, c.brxd) >= ?
+                                AND min(c.tlyd, c.bryd) <= ? AND max(c.tlyd, c.bryd) >= ?
+                              ORDER BY c.id DESC LIMIT 1;""",
+                          (scene_id, DONE, min(tlxd, brxd), max(tlxd, brxd), min(tlyd, bryd), max(tlyd, bryd)))
+        result = db_cursor.fetchone()
+        db_connection.close()
+
+        if result is None:
+            return None
+        return result[0]
+
+    def retry_chunk(self, chunk: DownloadChunk, error: str):
+        """ puts the chunk back with exponential backoff or marks it failed after max_attempts """
+
+        attempts = chunk.attempts + 1
+        state = PENDING if attempts < self.max_attempts else FAILED
+        next_attempt = time.time() + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("UPDATE download_chunks SET state=?, attempts=?, next_attempt=?, error=? WHERE id=?;",
+                          (state, attempts, next_attempt, error, chunk.id))
+        self.update_job_state(db_cursor, chunk.job_id)
+        db_connection.commit()
+        db_connection.close()
+        return state
+
+    def split_chunk(self, chunk: DownloadChunk):
+        """ replaces the chunk with its four quarters """
+
+        center_x = (chunk.tlxd + chunk.brxd) / 2
+        center_y = (chunk.tlyd + chunk.bryd) / 2
+        corners = [(chunk.tlxd, chunk.tlyd, center_x, center_y),  # Top left
+                   (chunk.tlxd, center_y, center_x, chunk.bryd),  # Top right
+                   (center_x, chunk.tlyd, chunk.brxd, center_y),  # Bottom left
+                   (center_x, center_y, chunk.brxd, chunk.bryd)]  # Bottom right
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("UPDATE download_chunks SET state=? WHERE id=?;", (SPLIT, chunk.id))
+        scene = chunk.scene if chunk.scene is not None else (None, None, None)
+        db_cursor.executemany("""INSERT INTO download_chunks (job_id, tlxd, tlyd, brxd, bryd, state, scene_id, scene_time, scene_cloudiness)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                              [(chunk.job_id, *corner, PENDING, *scene) for corner in corners])
+        db_connection.commit()
+        db_connection.close()
+
+    @staticmethod
+    def update_job_state(db_cursor: sqlite3.Cursor, job_id: int):
+        db_cursor.execute("SELECT state, count(*) FROM download_chunks WHERE job_id=? GROUP BY state;", (job_id,))
+        states = dict(db_cursor.fetchall())
+        if states.get(PENDING) or states.get(RUNNING):
+            return
+        db_cursor.execute("UPDATE download_jobs SET state=? WHERE id=?;", (FAILED if states.get(FAILED) else DONE, job_id))
+
+
+class DownloadProgress:
+    """ Listener aggregating download events into counts, throughput and ETA,
+        counts start over when a download begins after the queue was empty """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.planned = 0
+        self.done = 0
+        self.failed = 0
+        self.split = 0
+        self.retries = 0
+        self.bytes = 0
+        self.stage_times = {}  # stage -> total seconds
+
+    def __call__(self, event: dict):
+        with self.lock:
+            kind = event["type"]
+            if kind == "planned":
+                if self.remaining() == 0:
+                    self.reset()
+                if self.started is None:
+                    self.started = event["time"]
+                self.planned += event["chunks"]
+            elif kind == "done":
+                self.done += 1
+                self.bytes += event["bytes"]
+                for stage, seconds in event["stages"].items():
+                    self.stage_times[stage] = self.stage_times.get(stage, 0) + seconds
+            elif kind == "split":
+                self.split += 1
+                self.planned += event["chunks"]
+            elif kind == "retry":
+                self.retries += 1
+            elif kind == "failed":
+                self.failed += 1
+
+    def remaining(self) -> int:
+        return self.planned - self.split - self.done - self.failed
+
+    def snapshot(self) -> dict:
+        """ returns counts, fraction of finished chunks, bytes per second and ETA in seconds or None """
+
+        with self.lock:
+            total = self.planned - self.split
+            finished = self.done + self.failed
+            elapsed = time.time() - self.started if self.started is not None else 0.0
+            eta = None
+            if finished and elapsed > 0:
+                eta = self.remaining() * elapsed / finished
+            return {"planned": total,
+                    "done": self.done,
+                    "failed": self.failed,
+                    "retries": self.retries,
+                    "remaining": self.remaining(),
+                    "fraction": finished / total if total else 0.0,
+                    "bytes": self.bytes,
+                    "throughput": self.bytes / elapsed if elapsed > 0 else 0.0,
+                    "eta": eta,
+                    "stage_times": {stage: seconds / self.done for stage, seconds in self.stage_times.items()}
+                    if self.done else {}}
+
+
+class EEDownloader:
+    """ Worker threads downloading chunks of the queue
+        fetch(chunk) downloads a chunk and raises RegionTooLargeError if it has to be split,
+        process(chunk, result) stores the result and returns id of the saved image
+        Listeners get progress events: dicts with "type" in planned, started, done, split, retry, failed, idle """
+
+    def __init__(self, queue: DownloadQueue, fetch: Callable, process: Callable, workers: int = 4,
+                 is_ready: Callable = None, on_idle: Callable = None):
+        self.queue = queue
+        self.fetch = fetch
+        self.process = process
+        self.workers = workers
+        self.is_ready = is_ready
+        self.on_idle = on_idle
+        self.listeners = []
+
+        self.wake_event = threading.Event()
+        self.busy_workers = 0
+        self.busy_lock = threading.Lock()
+        self.threads = []
+
+    def add_listener(self, listener: Callable):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def emit(self, kind: str, **event):
+        event["type"] = kind
+        event["time"] = time.time()
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print("Download listener failed:", e)
+
+    def start(self):
+        unfinished = self.queue.resume()
+        if unfinished:
+            self.emit("planned", job_id=None, chunks=unfinished)
+        for _ in range(self.workers):
+            thread = threading.Thread(daemon=True, target=self.worker_thread)
+            thread.start()
+            self.threads.append(thread)
+
+    def add_job(self, regions: list, fdate: str, ldate: str, cloudiness: int,
+                visualized: bool, scale: float) -> int:
+        job_id = self.queue.add_job(regions, fdate, ldate, cloudiness, visualized, scale)
+        self.emit("planned", job_id=job_id, chunks=len(regions))
+        self.wake()
+        return job_id
+
+    def add_scenes_job(self, region: tuple, scenes: list, fdate: str, ldate: str, cloudiness: int,
+                       visualized: bool, scale: float) -> int:
+        job_id = self.queue.add_scenes_job(region, scenes, fdate, ldate, cloudiness, visualized, scale)
+        self.emit("planned", job_id=job_id, chunks=len(scenes))
+        self.wake()
+        return job_id
+
+    def wake(self):
+        self.wake_event.set()
+
+    def worker_thread(self):
+        while True:
+            if self.is_ready is not None and not self.is_ready():
+                self.wait(None)
+                continue
+
+            chunk = self.queue.take_chunk()
+            if chunk is None:
+                self.wait(self.queue.next_attempt_delay())
+                continue
+
+            with self.busy_lock:
+                self.busy_workers += 1
+            try:
+                self.download_chunk(chunk)
+            finally:
+                with self.busy_lock:
+                    self.busy_workers -= 1
+                    is_last = self.busy_workers == 0
+                if is_last and self.queue.count_unfinished() == 0:
+                    self.emit("idle")
+                    if self.on_idle is not None:
+                        self.on_idle()
+
+    def wait(self, delay: Union[float, None]):
+        # Waiting is limited, so a missed wake up only delays the worker
+        if delay is None or delay > 30:
+            delay = 30
+        self.wake_event.wait(timeout=delay)
+        self.wake_event.clear()
+
+    def download_chunk(self, chunk: DownloadChunk):
+        self.emit("started", job_id=chunk.job_id, chunk_id=chunk.id)
+        started = time.perf_counter()
+        try:
+            result = self.fetch(chunk)
+            fetched = time.perf_counter()
+            eeid = self.process(chunk, result)
+
+        except RegionTooLargeError:
+            print("Split")
+            self.queue.split_chunk(chunk)
+            self.emit("split", job_id=chunk.job_id, chunk_id=chunk.id, chunks=4)
+            self.wake()
+            return
+
+        except Exception as e:
+            state = self.queue.retry_chunk(chunk, str(e))
+            print("Failed to download chunk", chunk.id, "of job", chunk.job_id, "because of", e)
+            if state == FAILED:
+                print("Gave up chunk", chunk.id, "after", chunk.attempts + 1, "attempts")
+                self.emit("failed", job_id=chunk.job_id, chunk_id=chunk.id, error=str(e))
+            else:
+                self.emit("retry", job_id=chunk.job_id, chunk_id=chunk.id, error=str(e), attempts=chunk.attempts + 1)
+            self.wake()
+            return
+
+        scene = getattr(result, "scene", None)
+        self.queue.complete_chunk(chunk, eeid, scene.id if scene is not None else None)
+        self.emit("done", job_id=chunk.job_id, chunk_id=chunk.id, eeid=eeid,
+                  bytes=getattr(result, "nbytes", 0),
+                  stages={"fetch": fetched - started, "process": time.perf_counter() - fetched})
@@ -0,0 +1,285 @@
+import io
+import math
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy
+from PIL import Image
+
+from .ee_codecs import DEFAULT_CODEC, encode_image_data
+from .utility_functions import decimal_to_osm
+
+EE_IMAGE_DARKNESS = 10
+EE_MIN_SCALE = 1
+EARTH_CIRCUMFERENCE = 40075016.686
+# Seconds a thread waits for an idle worker process before it checks if a discarded one may be replaced
+PROCESS_WAIT_INTERVAL = 1
+
+
+def numpy_to_image(npimage: numpy.ndarray, darkness: float = EE_IMAGE_DARKNESS) -> tuple:
+    """ converts downloaded bands to RGBA image cropped to colored pixels with transparent black pixels,
+        returns (cropped image, from_left, from_right, from_top, from_bottom, uncropped image) """
+
+    if npimage.dtype == numpy.uint8:
+        # Image is already visualized on the server
+        arr = npimage
+    else:
+        arr = numpy.minimum(255, npimage / darkness).astype("uint8")
+
+    img = Image.fromarray(arr)
+
+    # Find border to crop
+    is_colored = arr.any(axis=2)
+    colored_columns = numpy.flatnonzero(is_colored.any(axis=0))
+    colored_rows = numpy.flatnonzero(is_colored.any(axis=1))
+    if colored_columns.size:
+        min_x, max_x = int(colored_columns[0]), int(colored_columns[-1])
+        min_y, max_y = int(colored_rows[0]), int(colored_rows[-1])
+    else:
+        min_x, max_x, min_y, max_y = img.size[0], 0, img.size[1], 0
+    max_x += 1
+    max_y += 1
+
+    # Get proportion of part to crop
+    from_top = min_y / img.size[1]
+    from_bottom = 1 - max_y / img.size[1]
+    from_left = min_x / img.size[0]
+    from_right = 1 - max_x / img.size[0]
+
+    cimg = img.crop((min_x, min_y, max_x, max_y)).convert(mode="RGBA")
+
+    # Convert remaining black pixels to transparent pixels
+    alpha = numpy.where(is_colored[min_y:max_y, min_x:max_x], 255, 0).astype("uint8")
+    cimg.putalpha(Image.fromarray(alpha, mode="L"))
+
+    return cimg, from_left, from_right, from_top, from_bottom, img
+
+
+def crop_region(tlxd, tlyd, brxd, bryd, from_left, from_right, from_top, from_bottom) -> tuple:
+    """ returns (tlxd, tlyd, brxd, bryd) of the region left after cropping given proportions """
+
+    return (tlxd * (1 - from_top) + brxd * from_top,
+            tlyd * (1 - from_left) + bryd * from_left,
+            tlxd * from_bottom + brxd * (1 - from_bottom),
+            tlyd * from_right + bryd * (1 - from_right))
+
+
+def get_region_dimensions(tlxd, tlyd, brxd, bryd, scale) -> tuple:
+    """ returns size in pixels of a region at scale in meters per pixel """
+
+    width = (bryd - tlyd) * 111320 * math.cos(math.radians((tlxd + brxd) / 2))
+    height = (tlxd - brxd) * 110574
+    return max(1, math.ceil(abs(width) / scale)), max(1, math.ceil(abs(height) / scale))
+
+
+def get_zoom_scale(latitude, zoom, tile_size: int = 256) -> float:
+    """ returns meters per screen pixel of the Web Mercator map at latitude and zoom """
+
+    return EARTH_CIRCUMFERENCE * math.cos(math.radians(latitude)) / (tile_size * 2 ** zoom)
+
+
+def get_adaptive_scale(tlxd, tlyd, brxd, bryd, pixel_budget: int, zoom: float = None, zoom_ahead: int = 2) -> int:
+    """ returns the finest whole scale in meters per pixel fitting the region into pixel_budget pixels,
+        but not finer than the map at zoom + zoom_ahead shows, there is nothing to see in more detail """
+
+    width, height = get_region_dimensions(tlxd, tlyd, brxd, bryd, 1)
+    scale = math.sqrt(width * height / pixel_budget)
+    if zoom is not None:
+        scale = max(scale, get_zoom_scale((tlxd + brxd) / 2, zoom + zoom_ahead))
+    return max(EE_MIN_SCALE, math.ceil(scale))
+
+
+def slice_image_to_tiles(pilimage: Image.Image, tlxd, tlyd, brxd, bryd, zoom_range: tuple, tile_size: int = 256):
+    """ reprojects an image into Web Mercator XYZ tiles of zoom_range and yields (zoom, x, y, PNG data)
+        of tiles which are not fully transparent, image is treated as linear in latitude and longitude """
+
+    if tlxd == brxd or tlyd == bryd:
+        return
+
+    zoom_from, zoom_to = zoom_range
+    source = numpy.asarray(pilimage.convert("RGBA"))
+    height, width = source.shape[:2]
+    pixel_centers = (numpy.arange(tile_size) + 0.5) / tile_size
+
+    for zoom in range(zoom_from, zoom_to + 1):
+        n = 2.0 ** zoom
+        upper_left_tile_pos = decimal_to_osm(tlxd, tlyd, zoom)
+        lower_right_tile_pos = decimal_to_osm(brxd, bryd, zoom)
+
+        for x in range(math.floor(upper_left_tile_pos[0]), math.ceil(lower_right_tile_pos[0])):
+            # longitude is linear in both projections
+            longitudes = (x + pixel_centers) / n * 360.0 - 180.0
+            columns = numpy.floor((longitudes - tlyd) / (bryd - tlyd) * width).astype(int)
+            valid_columns = (columns >= 0) & (columns < width)
+
+            for y in range(math.floor(upper_left_tile_pos[1]), math.ceil(lower_right_tile_pos[1])):
+                latitudes = numpy.degrees(numpy.arctan(numpy.sinh(numpy.pi * (1 - 2 * (y + pixel_centers) / n))))
+                rows = numpy.floor((tlxd - latitudes) / (tlxd - brxd) * height).astype(int)
+                valid_rows = (rows >= 0) & (rows < height)
+
+                tile = source[rows.clip(0, height - 1)][:, columns.clip(0, width - 1)]
+                tile[~(valid_rows[:, None] & valid_columns[None, :])] = 0
+                if not tile[..., 3].any():
+                    continue
+
+                buffer = io.BytesIO()
+                Image.fromarray(tile, mode="RGBA").save(buffer, format="PNG")
+                yield zoom, x, y, buffer.getvalue()
+
+
+def get_stored_metadata(chunk) -> tuple:
+    """ returns (fdate, ldate, cloudiness) an image of the chunk is stored with,
+        acquisition date and cloudiness of the scene if it was chosen, otherwise the chunk filters """
+
+    if chunk.scene is not None:
+        return chunk.scene.date, chunk.scene.date, round(chunk.scene.cloudiness)
+    return chunk.fdate, chunk.ldate, chunk.cloudiness
+
+
+class EncodedImage(NamedTuple):
+    data: bytes  # the cropped image encoded with codec
+    codec: str
+    thumbnail: bytes  # PNG
+    from_left: float
+    from_right: float
+    from_top: float
+    from_bottom: float
+
+
+def encode_image(pilimage: Image.Image, thumbnail_size: tuple, codec: str = DEFAULT_CODEC) -> tuple:
+    """ returns (image data, codec, PNG thumbnail data) of an image """
+
+    thumbnail_buffer = io.BytesIO()
+    pilimage.resize(thumbnail_size).save(thumbnail_buffer, format="PNG")
+    return encode_image_data(pilimage, codec), codec, thumbnail_buffer.getvalue()
+
+
+def encode_shared_array(name: str, shape: tuple, dtype: str, darkness: float, thumbnail_size: tuple,
+                        codec: str = DEFAULT_CODEC) -> EncodedImage:
+    """ converts, crops and encodes bands from a shared memory block, runs in a worker process """
+
+    shared = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        # The block belongs to the GUI process, the resource tracker of the worker must not unlink it
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shared._name, "shared_memory")
+    try:
+        npimage = numpy.ndarray(shape, dtype=dtype, buffer=shared.buf)
+        pilimage, from_left, from_right, from_top, from_bottom, _ = numpy_to_image(npimage, darkness)
+        # Views of the block must be released before it is closed
+        del npimage
+        return EncodedImage(*encode_image(pilimage, thumbnail_size, codec), from_left, from_right, from_top, from_bottom)
+    finally:
+        shared.close()
+
+
+class ImageProcessPool:
+    """ Converts, crops and encodes downloaded bands in worker processes, so the GUI process
+        keeps the GIL for the Tk main loop, bands are passed in shared memory without pickling
+        and only encoded images and crop proportions are sent back.
+        Workers are started with the minimal ee_worker entry instead of multiprocessing spawn,
+        which would import the main module of the application in every worker """
+
+    def __init__(self, workers: int = 2, thumbnail_size: tuple = (85, 85)):
+        self.workers = workers
+        self.thumbnail_size = thumbnail_size
+        self.processes = []
+        self.idle = queue.Queue()  # started processes waiting for a task
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def start_process() -> subprocess.Popen:
+        environment = dict(os.environ)
+        package_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, (package_folder, environment.get("PYTHONPATH"))))
+        return subprocess.Popen([sys.executable, "-m", "tkintermapviewforked.ee_worker"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+
+    def get_process(self) -> subprocess.Popen:
+        # Processes are started on the first downloads and again in place of discarded ones,
+        # so waiting threads look for a free place now and then
+        while True:
+            with self.lock:
+                try:
+                    return self.idle.get_nowait()
+                except queue.Empty:
+                    pass
+                if len(self.processes) < self.workers:
+                    process = self.start_process()
+                    self.processes.append(process)
+                    return process
+            try:
+                return self.idle.get(timeout=PROCESS_WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def discard_process(self, process: subprocess.Popen):
+        with self.lock:
+            if process in self.processes:
+                self.processes.remove(process)
+        process.kill()
+
+    def encode(self, npimage: numpy.ndarray, darkness: float = EE_IMAGE_DARKNESS,
+               codec: str = DEFAULT_CODEC) -> EncodedImage:
+        shared = shared_memory.SharedMemory(create=True, size=max(1, npimage.nbytes))
+        try:
+            numpy.ndarray(npimage.shape, dtype=npimage.dtype, buffer=shared.buf)[...] = npimage
+            process = self.get_process()
+            try:
+                pickle.dump((shared.name, npimage.shape, npimage.dtype.str, darkness, self.thumbnail_size, codec),
+                            process.stdin)
+                process.stdin.flush()
+                status, result = pickle.load(process.stdout)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                self.discard_process(process)
+                raise Exception(f"Image worker process failed: {e}")
+
+            self.idle.put(process)
+            if status != "ok":
+                raise Exception(result)
+            return result
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def shutdown(self):
+        with self.lock:
+            processes = self.processes
+            self.processes = []
+        for process in processes:
+            # Workers exit when there are no more tasks
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def store_downloaded_image(store, chunk, rgb_img: numpy.ndarray, scene_id: str = None,
+                           pool: ImageProcessPool = None) -> tuple:
+    """ crops downloaded bands of a chunk and saves the image to EEImageStore, in worker processes if pool is given,
+        returns (eeid, cropped image, cropped region, uncropped image), images are None if the pool was used,
+        then they are decoded by EEImageStore.get_image when they are shown """
+
+    if pool is None:
+        pilimage, from_left, from_right, from_top, from_bottom, defimage = numpy_to_image(rgb_img)
+        region = crop_region(chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd, from_left, from_right, from_top, from_bottom)
+        eeid = store.save_image(pilimage, *region, *get_stored_metadata(chunk), scene_id=scene_id)
+        return eeid, pilimage, region, defimage
+
+    encoded = pool.encode(rgb_img, codec=store.codec)
+    region = crop_region(chunk.tlxd, chunk.tlyd, chunk.brxd, chunk.bryd,
+                         encoded.from_left, encoded.from_right, encoded.from_top, encoded.from_bottom)
+    eeid = store.save_image_data(encoded.data, encoded.thumbnail, *region, *get_stored_metadata(chunk),
+                                 scene_id=scene_id, codec=encoded.codec)
+    return eeid, None, region, None
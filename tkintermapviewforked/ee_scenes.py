@@ -0,0 +1,59 @@
+import json
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple, Union
+
+
+class Scene(NamedTuple):
+    id: str  # system:index in the collection
+    time: int  # acquisition time, system:time_start in ms
+    cloudiness: float
+
+    @property
+    def date(self) -> str:
+        """ acquisition date as YYYY-MM-DD in UTC """
+        return datetime.fromtimestamp(self.time / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class SceneQueryCache:
+    """ Scenes matched by collection queries kept in the EE database for ttl seconds,
+        queries are keyed by the region rounded to quantum degrees and the filters """
+
+    def __init__(self, path: str, ttl: float = 24 * 60 * 60, quantum: float = 0.001):
+        self.db_path = path
+        self.ttl = ttl
+        self.quantum = quantum
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def make_key(self, collection: str, tlxd, tlyd, brxd, bryd, fdate: str, ldate: str, cloudiness) -> str:
+        region = " ".join(str(round(value / self.quantum)) for value in (tlxd, tlyd, brxd, bryd))
+        return f"{collection} {region} {fdate} {ldate} {cloudiness}"
+
+    def get(self, key: str) -> Union[list, None]:
+        """ returns scenes of the query if it was made less than ttl seconds ago """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT scenes FROM scene_queries WHERE key=? AND created > ?;", (key, time.time() - self.ttl))
+        result = db_cursor.fetchone()
+        db_connection.close()
+
+        if result is None:
+            return None
+        return [Scene(*scene) for scene in json.loads(result[0])]
+
+    def put(self, key: str, scenes: list):
+        db_connection = self.connect()
+        db_connection.execute("INSERT OR REPLACE INTO scene_queries (key, scenes, created) VALUES (?, ?, ?);",
+                              (key, json.dumps([list(scene) for scene in scenes]), time.time()))
+        db_connection.commit()
+        db_connection.close()
+
+    def delete_expired(self):
+        db_connection = self.connect()
+        db_connection.execute("DELETE FROM scene_queries WHERE created <= ?;", (time.time() - self.ttl,))
+        db_connection.commit()
+        db_connection.close()
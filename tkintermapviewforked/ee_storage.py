@@ -0,0 +1,303 @@
+import io
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Union
+
+from PIL import Image
+
+from .ee_codecs import DEFAULT_CODEC, EE_CODECS, decode_image_data, decode_image_file, encode_image_data
+
+
+def to_day_number(day: Union[str, date]) -> int:
+    """ converts YYYY-MM-DD string or date to the day number used in images_index """
+
+    if isinstance(day, str):
+        day = date(int(day[0:4]), int(day[5:7]), int(day[8:10]))
+    return day.toordinal()
+
+
+class EEImageStore:
+    """ Reads stored EE images from the database on demand
+        and keeps a few decoded images in a LRU cache
+        New images are encoded with the codec of the database, each image is decoded with its own codec """
+
+    def __init__(self, path: str, cache_size: int = 8, thumbnail_size: tuple = (85, 85)):
+        self.db_path = path
+        self.cache_size = cache_size
+        self.thumbnail_size = thumbnail_size
+
+        self.image_cache: "OrderedDict[int, Image.Image]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.codec = self.load_codec()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def load_codec(self) -> str:
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT value FROM settings WHERE key='codec';")
+        result = db_cursor.fetchone()
+        db_connection.close()
+        return result[0] if result is not None else DEFAULT_CODEC
+
+    def set_codec(self, codec: str):
+        """ sets codec of new images of the database, stored images keep theirs until recompressed """
+
+        if codec not in EE_CODECS:
+            raise ValueError(f"Unknown codec {codec}")
+
+        db_connection = self.connect()
+        db_connection.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('codec', ?);", (codec,))
+        db_connection.commit()
+        db_connection.close()
+        self.codec = codec
+
+    def load_metadata(self, after_eeid: int = None) -> list:
+        """ returns (eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness) of stored images without image data """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        if after_eeid is None:
+            db_cursor.execute("SELECT id, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness FROM images ORDER BY id;")
+        else:
+            db_cursor.execute("SELECT id, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness FROM images WHERE id>? ORDER BY id;",
+                              (after_eeid,))
+        metadata = db_cursor.fetchall()
+        db_connection.close()
+        return metadata
+
+    def find_containing(self, top_left: tuple, bottom_right: tuple,
+                        date_from: Union[str, date], date_until: Union[str, date], cloudiness: int) -> list:
+        """ returns ids of images which contain the region and fit the date range and cloudiness, newest first """
+
+        min_lat, max_lat = sorted((top_left[0], bottom_right[0]))
+        min_lon, max_lon = sorted((top_left[1], bottom_right[1]))
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        # index stores bounds rounded outwards, so bounds are checked again in images
+        db_cursor.execute("""SELECT i.id FROM images_index r, images i
+                              WHERE r.min_lat < ? AND r.max_lat > ? AND r.min_lon < ? AND r.max_lon > ?
+                                AND r.fday >= ? AND r.lday <= ? AND r.max_cloud <= ? AND i.id = r.id
+                                AND min(i.tlxd, i.brxd) < ? AND max(i.tlxd, i.brxd) > ?
+                                AND min(i.tlyd, i.bryd) < ? AND max(i.tlyd, i.bryd) > ?
+                              ORDER BY i.id DESC;""",
+                          (min_lat, max_lat, min_lon, max_lon,
+                           to_day_number(date_from), to_day_number(date_until), cloudiness,
+                           min_lat, max_lat, min_lon, max_lon))
+        ids = [eeid for eeid, in db_cursor.fetchall()]
+        db_connection.close()
+        return ids
+
+    def find_intersecting(self, top_left: tuple, bottom_right: tuple,
+                          date_from: Union[str, date], date_until: Union[str, date], cloudiness: int) -> list:
+        """ returns (eeid, tlxd, tlyd, brxd, bryd) of images which overlap the region
+            and fit the date range and cloudiness, newest first """
+
+        min_lat, max_lat = sorted((top_left[0], bottom_right[0]))
+        min_lon, max_lon = sorted((top_left[1], bottom_right[1]))
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""SELECT i.id, i.tlxd, i.tlyd, i.brxd, i.bryd FROM images_index r, images i
+                              WHERE r.max_lat > ? AND r.min_lat < ? AND r.max_lon > ? AND r.min_lon < ?
+                                AND r.fday >= ? AND r.lday <= ? AND r.max_cloud <= ? AND i.id = r.id
+                              ORDER BY i.id DESC;""",
+                          (min_lat, max_lat, min_lon, max_lon,
+                           to_day_number(date_from), to_day_number(date_until), cloudiness))
+        footprints = db_cursor.fetchall()
+        db_connection.close()
+        return footprints
+
+    def find_fitting(self, date_from: Union[str, date], date_until: Union[str, date], cloudiness: int) -> set:
+        """ returns ids of images which fit the date range and cloudiness """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT id FROM images_index WHERE fday >= ? AND lday <= ? AND max_cloud <= ?;",
+                          (to_day_number(date_from), to_day_number(date_until), cloudiness))
+        ids = {eeid for eeid, in db_cursor.fetchall()}
+        db_connection.close()
+        return ids
+
+    def read_image_data(self, eeid: int) -> Union[tuple, None]:
+        """ returns (encoded image, codec) """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT image, codec FROM images WHERE id=?;", (eeid,))
+        result = db_cursor.fetchone()
+        db_connection.close()
+        return result
+
+    def read_image(self, eeid: int, max_size: tuple = None) -> Union[Image.Image, None]:
+        """ returns decoded image, data is streamed to the decoder from the database without copying it whole,
+            the image is reduced to at least max_size if its codec allows it """
+
+        db_connection = self.connect()
+        try:
+            db_cursor = db_connection.cursor()
+            # id is the rowid of images
+            db_cursor.execute("SELECT codec FROM images WHERE id=?;", (eeid,))
+            result = db_cursor.fetchone()
+            if result is None:
+                return None
+
+            with db_connection.blobopen("images", "image", eeid, readonly=True) as blob:
+                return decode_image_file(blob, len(blob), result[0], max_size=max_size)
+        finally:
+            db_connection.close()
+
+    def cache_image(self, eeid: int, image: Image.Image):
+        with self.lock:
+            self.image_cache[eeid] = image
+            self.image_cache.move_to_end(eeid)
+            while len(self.image_cache) > self.cache_size:
+                self.image_cache.popitem(last=False)
+
+    def get_image(self, eeid: int) -> Union[Image.Image, None]:
+        """ returns decoded image, from the cache if it was used recently """
+
+        with self.lock:
+            if eeid in self.image_cache:
+                self.image_cache.move_to_end(eeid)
+                return self.image_cache[eeid]
+
+        image = self.read_image(eeid)
+        if image is None:
+            return None
+
+        self.cache_image(eeid, image)
+        return image
+
+    def encode_thumbnail(self, image: Image.Image) -> bytes:
+        buffer = io.BytesIO()
+        image.resize(self.thumbnail_size).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def save_thumbnail(self, eeid: int, data: bytes):
+        db_connection = self.connect()
+        db_connection.execute("INSERT OR REPLACE INTO thumbnails (id, thumbnail) VALUES (?, ?);", (eeid, data))
+        db_connection.commit()
+        db_connection.close()
+
+    def load_thumbnails(self) -> dict:
+        """ returns all pre-encoded thumbnails by image id """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT id, thumbnail FROM thumbnails;")
+        thumbnails = dict(db_cursor.fetchall())
+        db_connection.close()
+        return thumbnails
+
+    def get_thumbnail(self, eeid: int) -> Union[Image.Image, None]:
+        """ returns thumbnail of the image, if it was not saved yet it is made from the full image """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT thumbnail FROM thumbnails WHERE id=?;", (eeid,))
+        result = db_cursor.fetchone()
+        db_connection.close()
+
+        if result is not None:
+            return Image.open(io.BytesIO(result[0]))
+
+        with self.lock:
+            image = self.image_cache.get(eeid)
+
+        if image is None:
+            image = self.read_image(eeid, max_size=self.thumbnail_size)
+            if image is None:
+                return None
+
+        data = self.encode_thumbnail(image)
+        self.save_thumbnail(eeid, data)
+        return Image.open(io.BytesIO(data))
+
+    def backfill_thumbnails(self):
+        """ makes thumbnails for images saved before there was a thumbnails table """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT id FROM images WHERE id NOT IN (SELECT id FROM thumbnails);")
+        missing = [eeid for eeid, in db_cursor.fetchall()]
+        db_connection.close()
+
+        for eeid in missing:
+            image = self.read_image(eeid, max_size=self.thumbnail_size)
+            if image is not None:
+                self.save_thumbnail(eeid, self.encode_thumbnail(image))
+
+        if missing:
+            print("Made thumbnails for", len(missing), "images")
+
+    def save_image(self, pilimage: Image.Image, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness,
+                   scene_id: str = None) -> int:
+        """ saves an image to the database and returns its id, scene_id is id of the source scene in its collection """
+
+        codec = self.codec
+        eeid = self.save_image_data(encode_image_data(pilimage, codec), self.encode_thumbnail(pilimage),
+                                    tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, scene_id=scene_id, codec=codec)
+        self.cache_image(eeid, pilimage)
+        return eeid
+
+    def save_image_data(self, data: bytes, thumbnail: bytes, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness,
+                        scene_id: str = None, codec: str = DEFAULT_CODEC) -> int:
+        """ saves an image already encoded with codec with its encoded thumbnail and returns its id """
+
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""INSERT INTO images (tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image, scene_id, codec) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                          (tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, data, scene_id, codec))
+        eeid = db_cursor.lastrowid
+        db_cursor.execute("INSERT OR REPLACE INTO thumbnails (id, thumbnail) VALUES (?, ?);", (eeid, thumbnail))
+        db_connection.commit()
+        db_connection.close()
+        return eeid
+
+    def recompress(self, codec: str = None) -> tuple:
+        """ re-encodes images stored with other codecs than codec or the codec of the database,
+            an image at a time, so it can run in background, returns (images, bytes before, bytes after) """
+
+        codec = codec or self.codec
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT id FROM images WHERE codec != ? ORDER BY id;", (codec,))
+        ids = [eeid for eeid, in db_cursor.fetchall()]
+        db_connection.close()
+
+        count, old_size, new_size = 0, 0, 0
+        for eeid in ids:
+            result = self.read_image_data(eeid)
+            if result is None:
+                # Deleted meanwhile
+                continue
+
+            data = encode_image_data(decode_image_data(*result), codec)
+            db_connection = self.connect()
+            db_connection.execute("UPDATE images SET image=?, codec=? WHERE id=?;", (data, codec, eeid))
+            db_connection.commit()
+            db_connection.close()
+
+            count += 1
+            old_size += len(result[0])
+            new_size += len(data)
+
+        with self.lock:
+            self.image_cache.clear()
+        return count, old_size, new_size
+
+    def delete_image(self, eeid: int):
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("DELETE FROM thumbnails WHERE id=?;", (eeid,))
+        db_cursor.execute("DELETE FROM images WHERE id=?;", (eeid,))
+        db_connection.commit()
+        db_connection.close()
+
+        with self.lock:
+            self.image_cache.pop(eeid, None)
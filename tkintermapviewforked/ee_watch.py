@@ -0,0 +1,118 @@
+import sqlite3
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple, Union
+
+from .ee_backends import ImageryBackend
+from .ee_downloads import DownloadChunk, EEDownloader
+
+
+class WatchedRegion(NamedTuple):
+    id: int
+    name: str
+    tlxd: float
+    tlyd: float
+    brxd: float
+    bryd: float
+    cloudiness: int
+    visualized: bool
+    scale: float
+    since: str  # first date to look for scenes at, YYYY-MM-DD
+    last_scene_time: Union[int, None]  # acquisition time in ms of the newest queued scene
+    last_sync: Union[float, None]
+
+
+class WatchedRegions:
+    """ Regions kept in the EE database which are synced with new acquisitions """
+
+    def __init__(self, path: str):
+        self.db_path = path
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def add(self, name: str, region: tuple, cloudiness: int, since: str, visualized: bool, scale: float) -> int:
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""INSERT INTO watched_regions (name, tlxd, tlyd, brxd, bryd, cloudiness, visualized, scale, since)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                          (name, *region, cloudiness, int(visualized), scale, since))
+        region_id = db_cursor.lastrowid
+        db_connection.commit()
+        db_connection.close()
+        return region_id
+
+    def remove(self, region_id: int):
+        db_connection = self.connect()
+        db_connection.execute("DELETE FROM watched_regions WHERE id=?;", (region_id,))
+        db_connection.commit()
+        db_connection.close()
+
+    def get_all(self) -> list:
+        db_connection = self.connect()
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""SELECT id, name, tlxd, tlyd, brxd, bryd, cloudiness, visualized, scale,
+                                    since, last_scene_time, last_sync FROM watched_regions ORDER BY id;""")
+        regions = [WatchedRegion(*row[:7], bool(row[7]), *row[8:]) for row in db_cursor.fetchall()]
+        db_connection.close()
+        return regions
+
+    def set_synced(self, region_id: int, last_scene_time: Union[int, None]):
+        db_connection = self.connect()
+        db_connection.execute("UPDATE watched_regions SET last_scene_time=coalesce(?, last_scene_time), last_sync=? WHERE id=?;",
+                              (last_scene_time, time.time(), region_id))
+        db_connection.commit()
+        db_connection.close()
+
+
+def sync_watched_region(region: WatchedRegion, watched: WatchedRegions, backend: ImageryBackend,
+                        downloader: EEDownloader) -> int:
+    """ queues scenes of the region acquired after the last synced one and scenes which failed to download,
+        returns their number, costs one scenes query if there is nothing new """
+
+    # The watermark moves on when scenes are queued, failed ones are looked up again from the oldest of them
+    failed = downloader.queue.find_failed_scenes(region.tlxd, region.tlyd, region.brxd, region.bryd)
+    times = [*failed.values(), region.last_scene_time] if region.last_scene_time is not None else list(failed.values())
+    since_time = min(times, default=None)
+
+    if since_time is not None:
+        # Dates are whole days in queries, so scenes of the last synced day are filtered by time
+        fdate = datetime.fromtimestamp(since_time / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+    else:
+        fdate = region.since
+    ldate = (date.today() + timedelta(days=1)).isoformat()
+
+    query = DownloadChunk(None, None, region.tlxd, region.tlyd, region.brxd, region.bryd,
+                          fdate, ldate, region.cloudiness, region.visualized, region.scale, 0)
+    # Cached query results may be older than the newest acquisitions
+    scenes = [scene for scene in backend.list_scenes(query)
+              if region.last_scene_time is None or scene.time > region.last_scene_time or scene.id in failed]
+    # Failed scenes are older than the watermark unless they are new as well
+    last_scene_time = max((scene.time for scene in scenes
+                           if region.last_scene_time is None or scene.time > region.last_scene_time), default=None)
+
+    if scenes:
+        # Scenes may be already downloaded as a time series of the region
+        known = downloader.queue.find_queued_scenes(region.tlxd, region.tlyd, region.brxd, region.bryd)
+        scenes = [scene for scene in scenes if scene.id not in known]
+    if scenes:
+        downloader.add_scenes_job((region.tlxd, region.tlyd, region.brxd, region.bryd), scenes,
+                                  fdate, ldate, region.cloudiness, region.visualized, region.scale)
+
+    watched.set_synced(region.id, last_scene_time)
+    return len(scenes)
+
+
+def sync_watched_regions(watched: WatchedRegions, backend: ImageryBackend, downloader: EEDownloader) -> int:
+    """ syncs every watched region and returns number of queued scenes """
+
+    queued = 0
+    for region in watched.get_all():
+        try:
+            count = sync_watched_region(region, watched, backend, downloader)
+        except Exception as e:
+            print("Failed to sync region", region.name, "because of", e)
+            continue
+        print("Region", region.name, "has", count, "new scenes")
+        queued += count
+    return queued
@@ -0,0 +1,30 @@
+""" entry of processes of ImageProcessPool, started as python -m tkintermapviewforked.ee_worker,
+    so workers import only the package and not the main module of the application with its side effects """
+import pickle
+import sys
+
+from .ee_processing import encode_shared_array
+
+
+def main():
+    results = sys.stdout.buffer
+    # Prints of imported modules must not get between results
+    sys.stdout = sys.stderr
+    tasks = sys.stdin.buffer
+
+    while True:
+        try:
+            task = pickle.load(tasks)
+        except EOFError:
+            break
+
+        try:
+            result = ("ok", encode_shared_array(*task))
+        except Exception as e:
+            result = ("error", f"{type(e).__name__}: {e}")
+        pickle.dump(result, results)
+        results.flush()
+
+
+if __name__ == "__main__":
+    main()
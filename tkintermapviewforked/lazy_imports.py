@@ -0,0 +1,24 @@
+# Heavy modules which are not needed until authentication, search or a download happens
+# are imported on first use, so the window appears without waiting for them.
+# Python keeps imported modules in sys.modules, so later calls only look them up
+
+
+def get_ee():
+    import ee
+    return ee
+
+
+def get_geemap():
+    # geemap pulls in a large dependency tree, it is only needed to download bands
+    import geemap
+    return geemap
+
+
+def get_geocoder():
+    import geocoder
+    return geocoder
+
+
+def get_pyperclip():
+    import pyperclip
+    return pyperclip
@@ -9,28 +9,43 @@ import PIL
 import sys
 import io
 import sqlite3
-import pyperclip
-import geocoder
+import weakref
 from datetime import datetime
 from PIL import Image, ImageTk
 from typing import Callable, List, Dict, Union, Tuple
 from functools import partial
 
-import numpy
-
 from .canvas_position_marker import CanvasPositionMarker
 from .canvas_tile import CanvasTile
-from .utility_functions import decimal_to_osm, osm_to_decimal
+from .utility_functions import decimal_to_osm, osm_to_decimal, subtract_rectangles, rectangles_area
 from .canvas_button import CanvasButton
 from .canvas_path import CanvasPath
 from .canvas_polygon import CanvasPolygon
 from .canvas_ee_image import CanvasEEImage
+from .canvas_tile_coverage import CanvasTileCoverage
+from .ee_storage import EEImageStore
+from .ee_catalog import EEImageCatalog
+from .ee_downloads import DownloadQueue, DownloadChunk, DownloadProgress, EEDownloader
+from .ee_processing import EE_IMAGE_DARKNESS, numpy_to_image, get_region_dimensions, slice_image_to_tiles, store_downloaded_image, get_stored_metadata
+from .ee_processing import crop_region, get_adaptive_scale, ImageProcessPool
+from .ee_backends import EE_COLLECTION, ImageryBackend, EarthEngineBackend, FetchResult, fetch_chunk, find_new_scenes
+from .ee_scenes import SceneQueryCache
+from .ee_watch import WatchedRegions, sync_watched_regions
+from .tile_storage import update_tiles_database, insert_tiles, select_tile, delete_unreferenced_blobs, migrate_tiles
+from .tile_storage import TileAccessRecorder, evict_tiles, compact_tiles_database, vacuum_tiles_database
+from .tile_storage import TileCacheCounters, TileCoverage, get_tile_statistics, get_tiles_size
+from .lazy_imports import get_ee, get_geocoder, get_pyperclip
 
-import ee
-import geemap
-
-EE_IMAGE_DARKNESS = 10
 EE_IMAGE_SHOW_DISTANCE = 0.1
+EE_MIN_GAP_SIZE = 0.0005  # uncovered strips thinner than this in degrees are not downloaded
+EE_DOWNLOAD_WORKERS = 4
+EE_PROCESS_WORKERS = 2
+EE_PIXEL_BUDGET = 4096 * 4096  # pixels of a region downloaded with adaptive scale
+EE_PREVIEW_PIXELS = 512 * 512
+TILES_MAINTENANCE_INTERVAL = 60  # seconds between checks of the tiles database quota
+TILES_IDLE_TIME = 30  # seconds without map interaction before the tiles database is compacted
+EE_TILE_TIMEOUT = 10  # seconds to wait for a tile of the live EE layer
+TILE_COVERAGE_REDRAW_INTERVAL = 0.5  # seconds between redraws of the coverage overlay while tiles are saved
 
 class TkinterMapView(tkinter.Frame):
     def __init__(self, *args,
@@ -40,10 +55,17 @@ class TkinterMapView(tkinter.Frame):
                  bg_color: str = None,
                  database_path: str = None,
                  ee_database_path: str = None,
+                 ee_image_store: EEImageStore = None,
+                 ee_catalog: EEImageCatalog = None,
+                 imagery_backend: ImageryBackend = None,
                  use_database_only: bool = False,
                  search_database_path: str = None,
                  autosave: bool = False,
                  max_zoom: int = 19,
+                 tile_server: str = None,
+                 position: Tuple[float, float] = None,
+                 zoom: int = 17,
+                 preload_size: Tuple[int, int] = None,
                  set_connection_status=None,
                  get_connection_status=None,
                  eeid: list[int]=None,
@@ -154,11 +176,13 @@ class TkinterMapView(tkinter.Frame):
         self.canvas_polygon_list: List[CanvasPolygon] = []
 
         self.tile_image_cache: Dict[str, PIL.ImageTk.PhotoImage] = {}
+        # identical stored tiles share a decoded image while any of them is cached
+        self.tile_hash_cache: "weakref.WeakValueDictionary[bytes, PIL.ImageTk.PhotoImage]" = weakref.WeakValueDictionary()
         self.empty_tile_image = ImageTk.PhotoImage(Image.new("RGB", (self.tile_size, self.tile_size), (190, 190, 190)))  # used for zooming and moving
         self.not_loaded_tile_image = ImageTk.PhotoImage(Image.new("RGB", (self.tile_size, self.tile_size), (250, 250, 250)))  # only used when image not found on tile server
 
         # tile server and database
-        self.tile_server = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+        self.tile_server = tile_server if tile_server is not None else "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
         self.database_path = database_path
         self.use_database_only = use_database_only
         self.autosave = autosave
@@ -195,22 +219,58 @@ class TkinterMapView(tkinter.Frame):
             # db_cursor.execute(create_server_table)
             db_cursor.execute(create_tiles_table)
             # db_cursor.execute(create_sections_table)
+            update_tiles_database(db_cursor)
             db_connection.commit()
             db_connection.close()
 
+            # tiles saved before deduplication are moved to tile_blobs once
+            threading.Thread(daemon=True, target=migrate_tiles, args=(self.database_path,)).start()
+
+        # tiles database quota, least recently read tiles are evicted when the map is idle
+        self.tiles_quota: Union[int, None] = None
+        self.tiles_server_quotas: Dict[str, int] = {}
+        self.last_interaction_time = time.time()
+        self.tile_access = None
+        if self.database_path is not None:
+            self.tile_access = TileAccessRecorder(self.database_path)
+            threading.Thread(daemon=True, target=self.tiles_maintenance).start()
+
+        # where requested tiles were found and which tiles are stored, for statistics and the coverage overlay
+        self.tile_cache_counters = TileCacheCounters()
+        self.tile_coverage = None
+        self.canvas_tile_coverage: Union[CanvasTileCoverage, None] = None
+        self.tile_coverage_redraw_time = 0.0
+        if self.database_path is not None:
+            self.tile_coverage = TileCoverage(self.database_path)
+
         # search storage
         self.search_database_path = search_database_path
 
         # ee compatibility
         self.is_ee_authenticated = False
         self.ee_database_path = ee_database_path
+        self.ee_image_store = ee_image_store
+        if self.ee_image_store is None and self.ee_database_path is not None:
+            self.ee_image_store = EEImageStore(self.ee_database_path)
+        self.ee_catalog = ee_catalog  # in-memory metadata of stored images, the images index is used without it
         self.use_ee_database = True
         self.canvas_ee_image_list: List[CanvasEEImage] = []
-        self.ee_collection = None
+        # source of downloaded images, EE by default
+        self.imagery_backend = imagery_backend if imagery_backend is not None else EarthEngineBackend()
+        if self.imagery_backend.scene_cache is None and self.ee_database_path is not None:
+            self.imagery_backend.scene_cache = SceneQueryCache(self.ee_database_path)
+        # ee images sliced into XYZ tiles and composited over map tiles
+        self.use_ee_tiles = False
+        self.ee_tiles_zoom_range: Tuple[int, int] = (10, 16)
+        self.ee_tile_overlays: Dict[str, int] = {}  # synthetic server -> max sliced zoom
+        # live EE composite layer, its key includes filter parameters and is used as server in the tiles database
+        self.ee_live_layer: Union[str, None] = None
+        self.tile_server_urls: Dict[str, str] = {}  # synthetic server -> real tile url
         # ee settings
         self.date_from = None
         self.date_until = None
         self.cloudiness = None
+        self.fit_ee_ids: Union[set, None] = None  # ids of stored images which fit the settings above
 
         # polygon settings
         self.is_regime_polygon = False
@@ -234,9 +294,12 @@ class TkinterMapView(tkinter.Frame):
             image_load_thread.start()
             self.image_load_thread_pool.append(image_load_thread)
 
-        # set initial position
-        self.set_zoom(17)
-        self.set_position(52.516268, 13.377695)  # Brandenburger Tor, Berlin
+        # set initial position, tiles around it are read from the database before the first paint
+        self.set_zoom(zoom)
+        if position is None:
+            position = (52.516268, 13.377695)  # Brandenburger Tor, Berlin
+        self.preload_tiles(*position, size=preload_size)
+        self.set_position(*position)
 
         # right click menu
         self.right_click_menu_commands: List[dict] = []  # list of dictionaries with "label": str, "command": Callable, "pass_coords": bool
@@ -250,8 +313,28 @@ class TkinterMapView(tkinter.Frame):
         self.last_filter_position = [1000, 1000]
         self.initiate_filtering()
 
-        self.to_crop_queue = []
-        self.crop_thread = threading.Thread(daemon=True, target=self.crop_and_add_image_thread)
+        # Downloads are queued in the EE database and resumed after authentication
+        self.download_queue = None
+        self.ee_downloader = None
+        self.watched_regions = None
+        self.download_progress = DownloadProgress()
+        # Downloaded bands are converted and encoded in other processes
+        self.ee_process_pool = None
+        self.ee_previews = {}  # job id -> preview canvas images shown until the job is finished
+        self.ee_previews_lock = threading.RLock()
+        if self.ee_database_path is not None:
+            self.download_queue = DownloadQueue(self.ee_database_path)
+            self.ee_process_pool = ImageProcessPool(EE_PROCESS_WORKERS, thumbnail_size=self.ee_image_store.thumbnail_size)
+            self.watched_regions = WatchedRegions(self.ee_database_path)
+            self.ee_downloader = EEDownloader(self.download_queue,
+                                              fetch=self.fetch_ee_chunk,
+                                              process=self.add_downloaded_ee_image,
+                                              workers=EE_DOWNLOAD_WORKERS,
+                                              is_ready=self.imagery_backend.is_ready,
+                                              on_idle=self.on_ee_downloads_finished)
+            self.ee_downloader.add_listener(self.download_progress)
+            self.ee_downloader.add_listener(self.on_ee_download_event)
+            self.ee_downloader.start()
 
     def default_get_connection_status(self):
         return self.button_connection.text
@@ -273,6 +356,10 @@ class TkinterMapView(tkinter.Frame):
 
     def destroy(self):
         self.running = False
+        if self.tile_access is not None:
+            self.tile_access.flush()
+        if self.ee_process_pool is not None:
+            self.ee_process_pool.shutdown()
         super().destroy()
 
     def draw_rounded_corners(self):
@@ -330,7 +417,7 @@ class TkinterMapView(tkinter.Frame):
 
         def click_coordinates_event():
             try:
-                pyperclip.copy(f"{coordinate_mouse_pos[0]:.7f}, {coordinate_mouse_pos[1]:.7f}")
+                get_pyperclip().copy(f"{coordinate_mouse_pos[0]:.7f}, {coordinate_mouse_pos[1]:.7f}")
                 tkinter.messagebox.showinfo(title="", message="Coordinates copied to clipboard!")
 
             except Exception as err:
@@ -372,6 +459,16 @@ class TkinterMapView(tkinter.Frame):
         self.canvas.delete("tile")
         self.image_load_queue_results = []
         self.draw_initial_array()
+        if self.canvas_tile_coverage is not None:
+            self.load_tile_coverage()
+
+    def reload_tiles(self):
+        """Drops cached tile images and loads them again, e.g. when overlays change"""
+        self.image_load_queue_tasks = []
+        self.tile_image_cache: Dict[str, PIL.ImageTk.PhotoImage] = {}
+        self.canvas.delete("tile")
+        self.image_load_queue_results = []
+        self.draw_initial_array()
 
     def get_position(self) -> tuple:
         """ returns current middle position of map widget in decimal coordinates """
@@ -470,7 +567,7 @@ class TkinterMapView(tkinter.Frame):
             location = db_cursor.fetchone()
 
         if location is None:
-            location = geocoder.osm(address_string)
+            location = get_geocoder().osm(address_string)
 
             # there is no such location
             if not location.ok:
@@ -547,16 +644,28 @@ class TkinterMapView(tkinter.Frame):
         if cloudiness is not None:
             self.cloudiness = cloudiness
 
+        self.update_fit_ee_ids()
+
         #print(f"self.cloudiness = {self.cloudiness}, cloudiness.get() = {cloudiness}")
 
+    def update_fit_ee_ids(self):
+        """Looks up ids of stored images which fit the map settings in the catalog or in the images index"""
+        if self.date_from is None or self.date_until is None:
+            return
+        if self.ee_catalog is not None:
+            self.fit_ee_ids = self.ee_catalog.fitting_ids(self.date_from, self.date_until, self.cloudiness)
+        elif self.ee_image_store is not None:
+            self.fit_ee_ids = self.ee_image_store.find_fitting(self.date_from, self.date_until, self.cloudiness)
+
 
     def ee_authenticate_thread(self, on_authentication, on_fail):
         try:
             print("Authenticating in Earth Engine")
-            ee.Authenticate()
-            ee.Initialize(project="ee-era")
+            self.imagery_backend.authenticate()
             print("Earth Engine authenticated")
             self.is_ee_authenticated = True
+            if self.ee_downloader is not None:
+                self.ee_downloader.wake()
             if on_authentication is not None:
                 on_authentication()
 
@@ -577,248 +686,417 @@ class TkinterMapView(tkinter.Frame):
 
     @staticmethod
     def numpy_to_image(npimage):
-        # def color_function(cell):
-        #     new_cell = []
-        arr = numpy.array([[[min(255, color/EE_IMAGE_DARKNESS) for color in cell] for cell in row] for row in npimage])
-
-        img = Image.fromarray((
-                    arr
-            ).astype("uint8"))
-
-        # Find border to crop
-        min_x = img.size[0]
-        max_x = 0
-        min_y = img.size[1]
-        max_y = 0
-        for x in range(img.size[0]):
-            for y in range(img.size[1]):
-                color = img.getpixel(xy=(x, y))
-                if color != (0, 0, 0):
-                    min_x = x if x < min_x else min_x
-                    max_x = x if x > max_x else max_x
-                    min_y = y if y < min_y else min_y
-                    max_y = y if y > max_y else max_y
-        max_x += 1
-        max_y += 1
-
-        # Get proportion of part to crop
-        from_top = min_y / img.size[1]
-        from_bottom = 1 - max_y / img.size[1]
-        from_left = min_x / img.size[0]
-        from_right = 1 - max_x / img.size[0]
-
-        cimg = img.crop((min_x, min_y, max_x, max_y)).convert(mode="RGBA")
-
-        # Convert remaining black pixels to transparent pixels
-        for x in range(cimg.size[0]):
-            for y in range(cimg.size[1]):
-                if cimg.getpixel(xy=(x, y)) == (0, 0, 0, 255):
-                    cimg.putpixel(xy=(x, y), value=(0, 0, 0, 0))
-
-        return cimg, from_left, from_right, from_top, from_bottom, img
+        return numpy_to_image(npimage, EE_IMAGE_DARKNESS)
+
+    @staticmethod
+    def get_region_dimensions(tlxd, tlyd, brxd, bryd, scale):
+        """Returns size in pixels of a region at scale in meters per pixel"""
+        return get_region_dimensions(tlxd, tlyd, brxd, bryd, scale)
 
     def save_ee_image(self, pilimage, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness):
         """Saves an EE image to the database"""
-        db_connection = sqlite3.connect(self.ee_database_path)
+        return self.ee_image_store.save_image(pilimage, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness)
+
+    @staticmethod
+    def get_ee_tile_server(eeid: int) -> str:
+        return f"ee://{eeid}"
+
+    def slice_ee_image(self, eeid, pilimage, tlxd, tlyd, brxd, bryd):
+        """Reprojects an EE image into Web Mercator XYZ tiles of self.ee_tiles_zoom_range
+           and saves them to the tiles database under synthetic server ee://<eeid>.
+           Stored image is treated as linear in latitude and longitude"""
+        if self.database_path is None or tlxd == brxd or tlyd == bryd:
+            return
+
+        server = self.get_ee_tile_server(eeid)
+        db_connection = sqlite3.connect(self.database_path, timeout=10)
         db_cursor = db_connection.cursor()
-        buffer = io.BytesIO()
-        pilimage.save(buffer, format="PNG")
-        db_cursor.execute("""INSERT INTO images (tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image) VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
-                          (tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, buffer.getvalue()))
+        try:
+            db_cursor.execute("INSERT OR REPLACE INTO server (url, max_zoom) VALUES (?, ?);", (server, self.ee_tiles_zoom_range[1]))
+        except sqlite3.OperationalError:
+            pass  # there is no server table in databases created by the widget itself
+
+        # Tiles of stored images are not a cache, so they are never evicted
+        insert_tiles(db_cursor, ((zoom, x, y, server, tile) for zoom, x, y, tile in
+                                 slice_image_to_tiles(pilimage, tlxd, tlyd, brxd, bryd,
+                                                      self.ee_tiles_zoom_range, self.tile_size)),
+                     pinned=True)
+
         db_connection.commit()
         db_connection.close()
 
-    def crop_and_add_image_thread(self):
-        """Crops images and adds them"""
-        while self.to_crop_queue:
+    def is_ee_image_sliced(self, eeid) -> bool:
+        if self.database_path is None:
+            return False
 
-            tlxd, tlyd, brxd, bryd, fdate, ldate, cloud, rgb_img = self.to_crop_queue.pop()
+        db_connection = sqlite3.connect(self.database_path, timeout=10)
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT 1 FROM tiles WHERE server=? LIMIT 1;", (self.get_ee_tile_server(eeid),))
+        result = db_cursor.fetchone()
+        db_connection.close()
+        return result is not None
 
-            pilimage, from_left, from_right, from_top, from_bottom, defimage = self.numpy_to_image(rgb_img)
-            print("Successfully cropped image")
+    def delete_ee_tiles(self, eeid):
+        """Deletes tiles of a sliced EE image from the tiles database"""
+        self.remove_ee_tile_overlay(eeid)
+        if self.database_path is None:
+            return
 
-            ntlxd, nbrxd, ntlyd, nbryd = (tlxd * (1 - from_top) + brxd * (from_top),
-                                          tlxd * (from_bottom) + brxd * (1 - from_bottom),
-                                          tlyd * (1 - from_left) + bryd * from_left,
-                                          tlyd * from_right + bryd * (1 - from_right))
+        server = self.get_ee_tile_server(eeid)
+        db_connection = sqlite3.connect(self.database_path, timeout=10)
+        db_cursor = db_connection.cursor()
+        # Only images of the deleted tiles may be left without references
+        db_cursor.execute("SELECT DISTINCT tile_hash FROM tiles WHERE server=? AND tile_hash IS NOT NULL;", (server,))
+        hashes = [tile_hash for tile_hash, in db_cursor.fetchall()]
+        db_cursor.execute("DELETE FROM tiles WHERE server=?;", (server,))
+        delete_unreferenced_blobs(db_cursor, hashes)
+        try:
+            db_cursor.execute("DELETE FROM server WHERE url=?;", (server,))
+        except sqlite3.OperationalError:
+            pass
+        db_connection.commit()
+        db_connection.close()
 
-            total_eeid = self.eeid[0]
-            self.eeid[0] += 1
+    def add_ee_tile_overlay(self, eeid, pilimage, tlxd, tlyd, brxd, bryd):
+        """Shows an EE image as a tile overlay, slices it first if it is not in the tiles database yet"""
+        def slice_and_add():
+            if not self.is_ee_image_sliced(eeid):
+                self.slice_ee_image(eeid, pilimage, tlxd, tlyd, brxd, bryd)
+            # tkinter is not thread-safe, the overlay is shown from the Tk loop
+            self.after(0, self.register_ee_tile_overlay, eeid)
 
-            try:
-                self.add_ee_image(eeid=total_eeid,
-                                  position=(ntlxd, ntlyd),
-                                  brposition=(nbrxd, nbryd),
-                                  image=pilimage,
-                                  fdate=fdate,
-                                  ldate=ldate,
-                                  cloudiness=cloud)
-
-                # Save cropped image
-                try:
-                    self.save_ee_image(
-                        pilimage=pilimage,
-                        tlxd=ntlxd,
-                        tlyd=ntlyd,
-                        brxd=nbrxd,
-                        bryd=nbryd,
-                        fdate=fdate,
-                        ldate=ldate,
-                        cloudiness=cloud)
+        threading.Thread(daemon=True, target=slice_and_add).start()
 
-                except Exception as e:
-                    print("Failed to save image ", e)
+    def register_ee_tile_overlay(self, eeid):
+        self.ee_tile_overlays[self.get_ee_tile_server(eeid)] = self.ee_tiles_zoom_range[1]
+        self.reload_tiles()
 
-                self.master.master.render_image_frame(item=(total_eeid, ntlxd, ntlyd,
-                                                            nbrxd, nbryd, fdate, ldate, cloud, pilimage), new=True)
-                self.initiate_filtering(forced=True)
+    def remove_ee_tile_overlay(self, eeid):
+        if self.ee_tile_overlays.pop(self.get_ee_tile_server(eeid), None) is not None:
+            self.reload_tiles()
 
-            except Exception as e:
-                # Add uncropped and opaque image if any error occur
-                print("Failed image adding because of:\n\t", end="")
-                print(e, "\nAdded default image instead")
-                self.add_ee_image(eeid=total_eeid,
-                                  position=(tlxd, tlyd),
-                                  brposition=(brxd, bryd),
-                                  image=defimage,
-                                  fdate=fdate,
-                                  ldate=ldate,
-                                  cloudiness=cloud)
+    def get_ee_live_layer_key(self, date_from: str, date_until: str, cloudiness: int) -> str:
+        return f"ee-live://{EE_COLLECTION}?from={date_from}&until={date_until}&cloud={cloudiness}"
 
-            finally:
-                self.master.master.number_of_images_downloading -= 1
+    def ee_live_layer_thread(self, date_from: str, date_until: str, cloudiness: int):
+        key = self.get_ee_live_layer_key(date_from, date_until, cloudiness)
 
-                if self.master.master.number_of_images_downloading < 0:
-                    print("Something went wrong")
+        if key not in self.tile_server_urls and self.is_ee_authenticated:
+            try:
+                ee = get_ee()
+                composite = (ee.ImageCollection(EE_COLLECTION)
+                             .filterDate(date_from, date_until)
+                             .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', min(100, cloudiness + 10)))
+                             .median())
+                map_id = composite.getMapId({"bands": ['B4', 'B3', 'B2'], "min": 0, "max": 255 * EE_IMAGE_DARKNESS})
+                self.tile_server_urls[key] = map_id["tile_fetcher"].url_format
 
-                if self.master.master.number_of_images_downloading == 0:
-                    self.master.master.reset_download_button()
+            except Exception as e:
+                print("Failed to get EE map tiles because of ", e)
 
-    def get_ee_image_thread(self, tlxd, tlyd, brxd, bryd, fdate, ldate, cloud):
-        """This function downloads an image in numpy array and appends it to the
-           list of images to crop and add to the system"""
-        self.master.master.number_of_images_downloading += 1
-        bbox = ee.Geometry.BBox(tlyd, brxd, bryd, tlxd)
+        # Without url the layer is still shown from the tiles database, tkinter is not thread-safe
+        self.after(0, self.show_ee_live_layer, key)
 
-        if self.ee_collection is None:
-            self.ee_collection = ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+    def show_ee_live_layer(self, key: str):
+        self.ee_live_layer = key
+        self.reload_tiles()
 
-        ee_image = (self.ee_collection
-                    .filterBounds(bbox)  # Фильтруем по области
-                    .filterDate(fdate, ldate)  # Укажите нужный диапазон дат example: '2023-09-30' YYYY-MM-DD
-                    #.filter(ee.Filter.gt('CLOUDY_PIXEL_PERCENTAGE', max(0, cloud - 10)))
-                    .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', min(100, cloud + 10)))
-                    #.sort('CLOUDY_PIXEL_PERCENTAGE')
-                    .sort('system:time_start', False)  # Сортируем по времени (последние изображения первыми)
-                    # .select(['B4', 'B3', 'B2'])
-                    .first())  # Берем первое изображение
+    def set_ee_live_layer(self, date_from: str, date_until: str, cloudiness: int):
+        """Shows filtered EE composite as a tile layer, its tiles are cached like map tiles"""
+        ee_thread = threading.Thread(daemon=True, target=self.ee_live_layer_thread,
+                                     args=(date_from, date_until, cloudiness))
+        ee_thread.start()
 
-        print("Downloading image")
+    def remove_ee_live_layer(self):
+        if self.ee_live_layer is not None:
+            self.ee_live_layer = None
+            self.reload_tiles()
+
+    def switch_ee_tiles(self):
+        self.use_ee_tiles = not self.use_ee_tiles
+
+    def set_ee_tiles_zoom_range(self, zoom_from: int, zoom_to: int):
+        self.ee_tiles_zoom_range = (zoom_from, zoom_to)
+
+    def add_downloaded_ee_image(self, chunk: DownloadChunk, result: FetchResult) -> Union[int, None]:
+        """Crops downloaded image, saves and adds it, returns id of the saved image
+           If the scene was already stored its image is shown instead
+           Runs in download threads, the image is shown from the Tk loop"""
+        if result.eeid is not None:
+            self.after(0, self.show_stored_ee_image, result.eeid)
+            return result.eeid
+
+        if result.image is None:
+            return None
+
+        # The chunk is retried if saving fails
+        total_eeid, pilimage, region, defimage = store_downloaded_image(self.ee_image_store, chunk, result.image,
+                                                                        scene_id=result.scene.id if result.scene else None,
+                                                                        pool=self.ee_process_pool)
+        print("Successfully cropped image")
+        self.eeid[0] = total_eeid
+        if pilimage is None:
+            # Images encoded in worker processes are decoded only to be shown
+            pilimage = defimage = self.ee_image_store.get_image(total_eeid)
+
+        self.after(0, self.show_downloaded_ee_image, total_eeid, chunk, region, pilimage, defimage)
+        return total_eeid
+
+    def show_stored_ee_image(self, eeid: int):
+        index = self.master.master.get_ee_image_index(eeid)
+        if index is not None:
+            self.master.master.load_images_on_map(index=index, forced_to_show=True)
+
+    def show_downloaded_ee_image(self, eeid: int, chunk: DownloadChunk, region: tuple, pilimage: Image.Image,
+                                 defimage: Image.Image):
+        """Shows a downloaded image and adds it to the catalog and the images list"""
+        ntlxd, ntlyd, nbrxd, nbryd = region
+        fdate, ldate, cloud = get_stored_metadata(chunk)
 
         try:
-            rgb_img = geemap.ee_to_numpy(ee_image, bands=['B4', 'B3', 'B2'],
-                                         region=bbox, scale=self.master.master.get_scale())
+            self.show_ee_image(eeid=eeid,
+                               position=(ntlxd, ntlyd),
+                               brposition=(nbrxd, nbryd),
+                               image=pilimage,
+                               fdate=fdate,
+                               ldate=ldate,
+                               cloudiness=cloud)
+
+            item = (eeid, ntlxd, ntlyd, nbrxd, nbryd, fdate, ldate, cloud)
+            row = self.master.master.add_ee_image_item(item)
+            self.master.master.render_image_frame(row, new=True)
+            self.update_fit_ee_ids()
+            self.initiate_filtering(forced=True)
+
+        except Exception as e:
+            # Add uncropped and opaque image if any error occur
+            print("Failed image adding because of:\n\t", end="")
+            print(e, "\nAdded default image instead")
+            self.add_ee_image(eeid=eeid,
+                              position=(chunk.tlxd, chunk.tlyd),
+                              brposition=(chunk.brxd, chunk.bryd),
+                              image=defimage,
+                              fdate=fdate,
+                              ldate=ldate,
+                              cloudiness=cloud)
+
+    def fetch_ee_chunk(self, chunk: DownloadChunk) -> FetchResult:
+        """Downloads image of the chunk in numpy array from the imagery backend
+           unless its scene is already stored"""
+        print("Downloading image")
+        result = fetch_chunk(self.imagery_backend, self.download_queue, chunk)
+        if result.image is not None:
             print("Successfully downloaded image")
+        return result
+
+    def get_download_scale(self, region: tuple) -> float:
+        """Returns scale of the region from the pixel budget and the map zoom in adaptive mode,
+           otherwise the scale set in options"""
+        if self.master.master.is_adaptive_scale:
+            return get_adaptive_scale(*region, EE_PIXEL_BUDGET, self.zoom)
+        return self.master.master.get_scale()
+
+    def queue_ee_download(self, regions: list, date_from: str, date_until: str, cloudiness: int,
+                          scale: float = None) -> int:
+        """Adds a download job for (tlxd, tlyd, brxd, bryd) regions"""
+        if scale is None:
+            scale = self.master.master.get_scale()
+        return self.ee_downloader.add_job(regions, date_from, date_until, cloudiness,
+                                          visualized=self.master.master.is_downloading_visualized,
+                                          scale=scale)
+
+    def ee_preview_thread(self, regions: list, date_from: str, date_until: str, cloudiness: int, scale: float):
+        """Shows fast low resolution previews of the regions and then queues them in full resolution"""
+        previews = []
+        for region in regions:
+            try:
+                preview = self.fetch_ee_preview(region, date_from, date_until, cloudiness)
+            except Exception as e:
+                print("Failed to download preview because of", e)
+                continue
+            if preview is not None:
+                previews.append(preview)
+
+        # Events of the job wait for the lock, so a fast job can not finish before its previews are registered
+        with self.ee_previews_lock:
+            job_id = self.queue_ee_download(regions, date_from, date_until, cloudiness, scale=scale)
+            if previews:
+                self.ee_previews[job_id] = []
+                self.after(0, self.show_ee_previews, job_id, previews)
+
+    def fetch_ee_preview(self, region: tuple, date_from: str, date_until: str, cloudiness: int):
+        """Downloads the scene full resolution chunks will have at EE_PREVIEW_PIXELS and returns
+           (position, brposition, image, date, cloudiness) of it, or None if the scene is already stored"""
+        query = DownloadChunk(None, None, *region, date_from, date_until, cloudiness, True,
+                              get_adaptive_scale(*region, EE_PREVIEW_PIXELS), 0)
+        scenes = self.imagery_backend.find_scenes(query)
+        if not scenes or self.download_queue.find_stored_scene(scenes[0].id, *region) is not None:
+            return None
+
+        pilimage, from_left, from_right, from_top, from_bottom, _ = numpy_to_image(
+            self.imagery_backend.fetch(query, scenes[0]))
+        tlxd, tlyd, brxd, bryd = crop_region(*region, from_left, from_right, from_top, from_bottom)
+        return (tlxd, tlyd), (brxd, bryd), pilimage, scenes[0].date, round(scenes[0].cloudiness)
+
+    def show_ee_previews(self, job_id: int, previews: list):
+        """Shows previews as canvas images which are not stored, unless their job is already finished"""
+        with self.ee_previews_lock:
+            if job_id not in self.ee_previews:
+                return
+            for position, brposition, pilimage, scene_date, cloudiness in previews:
+                self.ee_previews[job_id].append(self.add_ee_image(eeid=None,
+                                                                  position=position,
+                                                                  brposition=brposition,
+                                                                  image=pilimage,
+                                                                  fdate=scene_date,
+                                                                  ldate=scene_date,
+                                                                  cloudiness=cloudiness))
+
+    def delete_ee_previews(self, previews: list):
+        for preview in previews:
+            preview.delete()
+
+    def on_ee_download_event(self, event: dict):
+        # Full resolution chunks are drawn over the preview, so it is removed when all of them are finished
+        if event["type"] not in ("done", "failed"):
+            return
+        with self.ee_previews_lock:
+            if event["job_id"] in self.ee_previews and self.download_queue.count_unfinished(event["job_id"]) == 0:
+                self.after(0, self.delete_ee_previews, self.ee_previews.pop(event["job_id"]))
 
-            self.to_crop_queue.append((tlxd, tlyd, brxd, bryd, fdate, ldate, cloud, rgb_img))
+    def get_ee_time_series(self, date_from: str, date_until: str, cloudiness: int):
+        """Downloads every scene of the date range which fits cloudiness for the selected region"""
+        top_left = self.region_polygon.position_list[0]
+        bottom_right = self.region_polygon.position_list[2]
+
+        if not self.imagery_backend.is_ready():
+            print("Authentication required")
+            self.master.master.reset_download_button()
+            return
 
-            if not self.crop_thread.is_alive():
-                self.crop_thread.run()
+        ee_thread = threading.Thread(daemon=True, target=self.ee_time_series_thread,
+                                     args=(top_left + bottom_right, date_from, date_until, cloudiness,
+                                           self.master.master.is_downloading_visualized,
+                                           self.get_download_scale(top_left + bottom_right)))
+        ee_thread.start()
 
+    def ee_time_series_thread(self, region, date_from, date_until, cloudiness, visualized, scale):
+        # Scenes are listed for the whole region, a chunk with unknown id describes the query
+        query = DownloadChunk(None, None, *region, date_from, date_until, cloudiness, visualized, scale, 0)
+        try:
+            scenes = find_new_scenes(self.imagery_backend, self.download_queue, query)
         except Exception as e:
+            print("Failed to list scenes because of", e)
+            self.after(0, self.master.master.reset_download_button)
+            return
 
-            if not str(e).startswith("Total"):
-                # Generic exception handle
-                raise Exception(e)
-
-            # Too large image exception handle
-            print("Split")
-            center_x = (tlxd + brxd) / 2
-            center_y = (tlyd + bryd) / 2
-
-            corners = [(tlxd, tlyd, center_x, center_y),  # Top left
-                       (tlxd, center_y, center_x, bryd),  # Top right
-                       (center_x, tlyd, brxd, center_y),  # Bottom left
-                       (center_x, center_y, brxd, bryd)]  # Bottom right
-            for index, corner in enumerate(corners):
-                ee_image_thread = threading.Thread(daemon=True,
-                                                   target=self.get_ee_image_thread,
-                                                   args=corner + (fdate, ldate, cloud)
-                                                   )
-                ee_image_thread.start()
+        if not scenes:
+            print("All scenes of the region are already downloaded")
+            self.after(0, self.master.master.reset_download_button)
+            return
 
-    def get_ee_image_depr(self, top_left: Tuple[float, float], bottom_right: Tuple[float, float],
-                          date_from: str, date_until: str, cloudiness: int, forced: bool = False):
-        if not forced:
-            for index, img in enumerate(self.master.master.ee_images_list):
+        print("Downloading", len(scenes), "scenes from", scenes[-1].date, "to", scenes[0].date)
+        self.ee_downloader.add_scenes_job(region, scenes, date_from, date_until, cloudiness, visualized, scale)
 
-                eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloud, image = img
+    def watch_ee_region(self, name: str, date_from: str, cloudiness: int):
+        """Saves the selected region to be synced with scenes acquired since date_from"""
+        top_left = self.region_polygon.position_list[0]
+        bottom_right = self.region_polygon.position_list[2]
+        self.watched_regions.add(name, top_left + bottom_right, cloudiness, date_from,
+                                 visualized=self.master.master.is_downloading_visualized,
+                                 scale=self.get_download_scale(top_left + bottom_right))
+
+    def sync_watched_regions(self):
+        """Queues scenes of watched regions acquired after the last sync"""
+        if not self.imagery_backend.is_ready():
+            print("Authentication required")
+            self.master.master.reset_download_button()
+            return
 
-                nfdate = datetime(int(fdate[0:4]), int(fdate[5:7]), int(fdate[8:10]))
-                ndate_from = datetime(int(date_from[0:4]), int(date_from[5:7]), int(date_from[8:10]))
+        ee_thread = threading.Thread(daemon=True, target=self.sync_watched_regions_thread)
+        ee_thread.start()
+
+    def sync_watched_regions_thread(self):
+        if not sync_watched_regions(self.watched_regions, self.imagery_backend, self.ee_downloader):
+            print("No new scenes in watched regions")
+            self.after(0, self.master.master.reset_download_button)
 
-                nldate = datetime(int(ldate[0:4]), int(ldate[5:7]), int(ldate[8:10]))
-                ndate_until = datetime(int(date_until[0:4]), int(date_until[5:7]), int(date_until[8:10]))
+    def on_ee_downloads_finished(self):
+        print("All downloads finished")
+        with self.ee_previews_lock:
+            for job_id in list(self.ee_previews):
+                self.after(0, self.delete_ee_previews, self.ee_previews.pop(job_id))
+        self.after(0, self.master.master.reset_download_button)
 
-                if (tlxd > top_left[0]
-                      and tlyd < top_left[1]
-                      and brxd < bottom_right[0]
-                      and bryd > bottom_right[1]
-                      and nfdate >= ndate_from
-                      and nldate <= ndate_until
-                      and cloud <= cloudiness):
+    def get_ee_image_depr(self, top_left: Tuple[float, float], bottom_right: Tuple[float, float],
+                          date_from: str, date_until: str, cloudiness: int, forced: bool = False):
+        if not forced:
+            for eeid in self.ee_image_store.find_containing(top_left, bottom_right,
+                                                            date_from, date_until, cloudiness):
+                index = self.master.master.get_ee_image_index(eeid)
+                if index is not None:
                     print("Found suitable image in database")
                     self.master.master.load_images_on_map(index=index, forced_to_show=True)
                     #self.master.master.find_ee_image(index=index)
                     return
 
-        if not self.is_ee_authenticated:
+        if not self.imagery_backend.is_ready():
             print("Authentication required")
             return
 
-        ee_image_thread = threading.Thread(daemon=True,
-                                           target=self.get_ee_image_thread,
-                                           args=top_left + bottom_right + (date_from, date_until, cloudiness))
-        ee_image_thread.start()
+        self.queue_ee_download([top_left + bottom_right], date_from, date_until, cloudiness)
 
     def get_ee_image_new(self, date_from: str, date_until: str, cloudiness: int,
                          forced: bool = False):
         top_left = self.region_polygon.position_list[0]
         bottom_right = self.region_polygon.position_list[2]
+        gaps = [top_left + bottom_right]
 
-        # Common case
+        # Common case, stored images cover the region fully or partly
         if not forced:
-            for index, img in enumerate(self.master.master.ee_images_list):
-
-                eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloud, image = img
-
-                nfdate = datetime(int(fdate[0:4]), int(fdate[5:7]), int(fdate[8:10]))
-                ndate_from = datetime(int(date_from[0:4]), int(date_from[5:7]), int(date_from[8:10]))
-
-                nldate = datetime(int(ldate[0:4]), int(ldate[5:7]), int(ldate[8:10]))
-                ndate_until = datetime(int(date_until[0:4]), int(date_until[5:7]), int(date_until[8:10]))
-
-                if (tlxd > top_left[0]
-                      and tlyd < top_left[1]
-                      and brxd < bottom_right[0]
-                      and bryd > bottom_right[1]
-                      and nfdate >= ndate_from
-                      and nldate <= ndate_until
-                      and cloud <= cloudiness):
-                    print("Found suitable image in database")
-                    self.master.master.load_images_on_map(index=index, forced_to_show=True)
-                    #self.master.master.find_ee_image(index=index)
-                    return
+            gaps = self.find_ee_coverage_gaps(top_left, bottom_right, date_from, date_until, cloudiness)
+            if not gaps:
+                print("Found suitable images in database")
+                self.master.master.reset_download_button()
+                return
 
         # Required download case
-        if not self.is_ee_authenticated:
+        if not self.imagery_backend.is_ready():
             print("Authentication required")
+            self.master.master.reset_download_button()
             return
 
-        ee_image_thread = threading.Thread(daemon=True,
-                                           target=self.get_ee_image_thread,
-                                           args=top_left + bottom_right + (date_from, date_until, cloudiness))
-        ee_image_thread.start()
+        print("Downloading", len(gaps), "uncovered parts of the region")
+        scale = self.get_download_scale(top_left + bottom_right)
+        if self.master.master.is_adaptive_scale:
+            print("Adaptive scale is", scale, "m/px")
+            ee_thread = threading.Thread(daemon=True, target=self.ee_preview_thread,
+                                         args=(gaps, date_from, date_until, cloudiness, scale))
+            ee_thread.start()
+        else:
+            self.queue_ee_download(gaps, date_from, date_until, cloudiness, scale=scale)
+
+    def find_ee_coverage_gaps(self, top_left: Tuple[float, float], bottom_right: Tuple[float, float],
+                              date_from: str, date_until: str, cloudiness: int) -> list:
+        """Shows stored images which cover the region and returns its uncovered parts as rectangles
+           Newer images are preferred, an image is shown only if it covers something the newer ones do not"""
+        region = top_left + bottom_right
+        gaps = [region]
+        footprints = []
+        for eeid, tlxd, tlyd, brxd, bryd in self.ee_image_store.find_intersecting(top_left, bottom_right,
+                                                                                   date_from, date_until, cloudiness):
+            new_gaps = subtract_rectangles(region, footprints + [(tlxd, tlyd, brxd, bryd)], EE_MIN_GAP_SIZE)
+            if rectangles_area(new_gaps) >= rectangles_area(gaps):
+                continue
+            footprints.append((tlxd, tlyd, brxd, bryd))
+            gaps = new_gaps
+
+            index = self.master.master.get_ee_image_index(eeid)
+            if index is not None:
+                self.master.master.load_images_on_map(index=index, forced_to_show=True)
+            if not gaps:
+                break
+        return gaps
 
     def switch_ee(self):
         self.use_ee_database = not self.use_ee_database
@@ -844,24 +1122,39 @@ class TkinterMapView(tkinter.Frame):
         self.canvas_ee_image_list.append(ee_image)
         return ee_image
 
+    def show_ee_image(self,
+                      eeid: int,
+                      position: Tuple[float, float],
+                      brposition: Tuple[float, float],
+                      image: Image,
+                      fdate: datetime,
+                      ldate: datetime,
+                      cloudiness: int):
+        """Shows an EE image either as a canvas image or as a tile overlay"""
+        if self.use_ee_tiles:
+            self.add_ee_tile_overlay(eeid, image, *position, *brposition)
+        else:
+            self.add_ee_image(eeid, position, brposition, image, fdate, ldate, cloudiness)
+
     def load_ee_images(self, images):
-        for eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image in images:
+        """Shows images by their metadata, image data is read from the database on demand"""
+        for eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness in images:
 
-            pilimage = Image.open(io.BytesIO(image))
-            self.add_ee_image(eeid, (tlxd, tlyd), (brxd, bryd), pilimage, fdate, ldate, cloudiness)
+            pilimage = self.ee_image_store.get_image(eeid)
+            if pilimage is None:
+                print("There is no image", eeid, "in database")
+                continue
+            self.show_ee_image(eeid, (tlxd, tlyd), (brxd, bryd), pilimage, fdate, ldate, cloudiness)
 
     def unload_ee_images(self, images):
-        for eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness, image in images:
-            for index, loaded_image in enumerate(self.canvas_ee_image_list):
+        for eeid, tlxd, tlyd, brxd, bryd, fdate, ldate, cloudiness in images:
+            self.remove_ee_tile_overlay(eeid)
+
+            for loaded_image in self.canvas_ee_image_list:
                 if eeid == loaded_image.eeid:
+                    loaded_image.delete()
                     break
 
-            else:  # If there is no such image
-                index = -1
-
-            if index > -1:
-                self.canvas_ee_image_list.pop(index)
-
 
     # === Other stuff ===
 
@@ -897,6 +1190,7 @@ class TkinterMapView(tkinter.Frame):
         self.canvas_polygon_list = []
 
     def manage_z_order(self):
+        self.canvas.lift("tile_coverage")
         self.canvas.lift("ee_image")
         self.canvas.lift("polygon")
         self.canvas.lift("path")
@@ -971,28 +1265,87 @@ class TkinterMapView(tkinter.Frame):
                 for key in keys_to_delete:
                     del self.tile_image_cache[key]
 
+    def preload_tiles(self, deg_x: float, deg_y: float, size: Tuple[int, int] = None, ring: int = 1) -> int:
+        """ reads stored tiles of a view centered at a position with one query and puts them into the image cache,
+            size is the one of the view in pixels, the current one if not set, ring is tiles added around it """
+
+        if self.database_path is None:
+            return 0
+
+        width, height = size if size is not None else (self.width, self.height)
+        zoom = round(self.zoom)
+        center_x, center_y = decimal_to_osm(deg_x, deg_y, zoom)
+        half_width = width / 2 / self.tile_size
+        half_height = height / 2 / self.tile_size
+        last_tile = 2 ** zoom - 1
+        x_from = max(0, math.floor(center_x - half_width) - ring)
+        x_to = min(last_tile, math.ceil(center_x + half_width) + ring)
+        y_from = max(0, math.floor(center_y - half_height) - ring)
+        y_to = min(last_tile, math.ceil(center_y + half_height) + ring)
+
+        db_connection = sqlite3.connect(self.database_path, timeout=10)
+        try:
+            db_cursor = db_connection.cursor()
+            db_cursor.execute("""SELECT t.x, t.y, coalesce(b.data, t.tile_image), t.tile_hash
+                                   FROM tiles t LEFT JOIN tile_blobs b ON b.hash = t.tile_hash
+                                  WHERE t.zoom=? AND t.x BETWEEN ? AND ? AND t.y BETWEEN ? AND ? AND t.server=?;""",
+                              (zoom, x_from, x_to, y_from, y_to, self.tile_server))
+            rows = db_cursor.fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Failed to preload tiles because of {e}")
+            rows = []
+        finally:
+            db_connection.close()
+
+        for x, y, data, tile_hash in rows:
+            image_tk = self.tile_hash_cache.get(tile_hash) if tile_hash is not None else None
+            if image_tk is None:
+                try:
+                    image_tk = ImageTk.PhotoImage(Image.open(io.BytesIO(data)))
+                except PIL.UnidentifiedImageError:
+                    continue
+                if tile_hash is not None:
+                    self.tile_hash_cache[tile_hash] = image_tk
+            self.tile_image_cache[f"{zoom} {x} {y}"] = image_tk
+            self.tile_access.record(zoom, x, y, self.tile_server)
+            self.tile_cache_counters.count("database")
+
+        return len(rows)
+
     def request_image(self, zoom: int, x: int, y: int, db_cursor=None) -> ImageTk.PhotoImage:
 
         # if database is available check first if tile is in database, if not try to use server
         if db_cursor is not None:
 
             try:
-                db_cursor.execute("SELECT t.tile_image FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND t.server=?;",
-                                  (zoom, x, y, self.tile_server))
-                result = db_cursor.fetchone()
+                result = select_tile(db_cursor, zoom, x, y, self.tile_server)
 
                 if result is not None:
-                    image = Image.open(io.BytesIO(result[0]))
-                    image_tk = ImageTk.PhotoImage(image)
+                    self.tile_access.record(zoom, x, y, self.tile_server)
+                    self.tile_cache_counters.count("database")
+                    data, tile_hash = result
+                    image_tk = None
+                    if tile_hash is not None and self.ee_live_layer is None and not self.ee_tile_overlays:
+                        image_tk = self.tile_hash_cache.get(tile_hash)
+
+                    if image_tk is None:
+                        image = Image.open(io.BytesIO(data))
+                        composited = self.composite_ee_tile_overlays(image, zoom, x, y, db_cursor)
+                        image_tk = ImageTk.PhotoImage(composited)
+                        if tile_hash is not None and composited is image:
+                            self.tile_hash_cache[tile_hash] = image_tk
+
                     self.tile_image_cache[f"{zoom} {x} {y}"] = image_tk
                     return image_tk
                 elif self.use_database_only:
+                    self.tile_cache_counters.count("missing")
                     return self.empty_tile_image
                 else:
                     pass
 
             except sqlite3.OperationalError:
                 if self.use_database_only:
+                    self.tile_cache_counters.count("missing")
                     return self.empty_tile_image
                 else:
                     pass
@@ -1020,8 +1373,8 @@ class TkinterMapView(tkinter.Frame):
                     # create buffer because we need to save and load the image and to prevent using local drive
                     buffer = io.BytesIO()
                     image.save(buffer, format="PNG")
-                    insert_tile_cmd = """INSERT INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);"""
-                    cursor.execute(insert_tile_cmd, (zoom, x, y, self.tile_server, buffer.getvalue()))
+                    insert_tiles(cursor, [(zoom, x, y, self.tile_server, buffer.getvalue())], replace=False,
+                                 coverage=self.tile_coverage)
                     db_connection.commit()
 
                 except sqlite3.OperationalError as e:
@@ -1042,32 +1395,198 @@ class TkinterMapView(tkinter.Frame):
 
                 image.paste(image_overlay, (0, 0), image_overlay)
 
+            image = self.composite_ee_tile_overlays(image, zoom, x, y, db_cursor)
+
             if self.running:
                 image_tk = ImageTk.PhotoImage(image)
             else:
                 return self.empty_tile_image
 
+            self.tile_cache_counters.count("server")
             self.tile_image_cache[f"{zoom} {x} {y}"] = image_tk
             return image_tk
 
         except PIL.UnidentifiedImageError:  # image does not exist for given coordinates
             # print("Unidentified Image")
+            self.tile_cache_counters.count("missing")
             self.tile_image_cache[f"{zoom} {x} {y}"] = self.empty_tile_image
             return self.empty_tile_image
 
         except requests.exceptions.ConnectionError:
             if self.get_connection_status() != "0":
                 self.set_connection_status(False)
+            self.tile_cache_counters.count("missing")
             return self.empty_tile_image
 
         except Exception as e:
             # print("Broad exception: ", e)
+            self.tile_cache_counters.count("missing")
             return self.empty_tile_image
 
-    def get_tile_image_from_cache(self, zoom: int, x: int, y: int):
+    def get_ee_overlay_tile(self, server: str, max_zoom: int, zoom: int, x: int, y: int, db_cursor) -> Union[Image.Image, None]:
+        """Returns overlay tile of a sliced EE image, beyond max_zoom the tile is cut out of its ancestor"""
+        zoom_diff = max(0, zoom - max_zoom)
+        result = select_tile(db_cursor, zoom - zoom_diff, x >> zoom_diff, y >> zoom_diff, server)
+        if result is None:
+            return None
+
+        overlay = Image.open(io.BytesIO(result[0])).convert("RGBA")
+        if zoom_diff > 0:
+            part = overlay.size[0] / 2 ** zoom_diff
+            left = (x - ((x >> zoom_diff) << zoom_diff)) * part
+            top = (y - ((y >> zoom_diff) << zoom_diff)) * part
+            overlay = overlay.resize(overlay.size, resample=0, box=(left, top, left + part, top + part))
+
+        return overlay
+
+    def get_tile_url(self, server: str, zoom: int, x: int, y: int) -> str:
+        url = self.tile_server_urls.get(server, server)
+        return url.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
+
+    def get_ee_live_tile(self, server: str, zoom: int, x: int, y: int, db_cursor) -> Union[Image.Image, None]:
+        """Returns tile of the live EE layer from the tiles database or from EE, loaded tiles are always saved"""
+        if db_cursor is not None:
+            result = select_tile(db_cursor, zoom, x, y, server)
+            if result is not None:
+                self.tile_access.record(zoom, x, y, server)
+                return Image.open(io.BytesIO(result[0])).convert("RGBA")
+
+        if server not in self.tile_server_urls or self.use_database_only:
+            return None
+
+        try:
+            answer = requests.get(self.get_tile_url(server, zoom, x, y), headers={"User-Agent": "TkinterMapView"},
+                                  timeout=EE_TILE_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to load EE tile because of {e}")
+            return None
+        if answer.status_code != 200:
+            return None
+
+        if self.database_path is not None:
+            db_connection = sqlite3.connect(self.database_path, timeout=10)
+            try:
+                insert_tiles(db_connection.cursor(), [(zoom, x, y, server, answer.content)])
+                db_connection.commit()
+            except sqlite3.OperationalError as e:
+                print(f"Failed to insert EE tile because of {e}")
+            finally:
+                db_connection.close()
+
+        return Image.open(io.BytesIO(answer.content)).convert("RGBA")
+
+    def composite_ee_tile_overlays(self, image: Image.Image, zoom: int, x: int, y: int, db_cursor) -> Image.Image:
+        """Pastes the live EE layer and tiles of EE images shown as overlays over a map tile"""
+        live_layer = self.ee_live_layer
+        if live_layer is not None:
+            overlay = self.get_ee_live_tile(live_layer, zoom, x, y, db_cursor)
+            if overlay is not None:
+                if overlay.size != image.size:
+                    overlay = overlay.resize(image.size, resample=0)
+                image = image.convert("RGBA")
+                image.paste(overlay, (0, 0), overlay)
+
+        if db_cursor is None:
+            return image
+
+        for server, max_zoom in list(self.ee_tile_overlays.items()):
+            overlay = self.get_ee_overlay_tile(server, max_zoom, zoom, x, y, db_cursor)
+            if overlay is not None:
+                if overlay.size != image.size:
+                    overlay = overlay.resize(image.size, resample=0)
+                image = image.convert("RGBA")
+                image.paste(overlay, (0, 0), overlay)
+
+        return image
+
+    def set_tiles_quota(self, max_bytes: Union[int, None] = None, server_quotas: Dict[str, int] = None):
+        """Sets bytes the tiles database may take for all servers and for single servers"""
+        self.tiles_quota = max_bytes
+        self.tiles_server_quotas = dict(server_quotas or {})
+
+    def is_idle(self) -> bool:
+        last_interaction = max(self.last_mouse_down_time or 0, self.last_interaction_time)
+        return (self.running and time.time() - last_interaction > TILES_IDLE_TIME
+                and not self.image_load_queue_tasks)
+
+    def tiles_maintenance(self):
+        """Saves tile access times, evicts tiles over quota and compacts the tiles database while the map is idle"""
+        while self.running:
+            time.sleep(TILES_MAINTENANCE_INTERVAL)
+            if not self.is_idle():
+                continue
+
+            try:
+                self.tile_access.flush()
+                evicted = 0
+                for server, max_bytes in self.tiles_server_quotas.items():
+                    evicted += evict_tiles(self.database_path, max_bytes, server=server)
+                if self.tiles_quota is not None:
+                    evicted += evict_tiles(self.database_path, self.tiles_quota)
+                if evicted:
+                    print("Evicted", evicted, "least recently used tiles")
+                    self.tile_coverage.forget()
+                    if self.canvas_tile_coverage is not None:
+                        self.tile_coverage.load(self.tile_server)
+                compact_tiles_database(self.database_path, is_idle=self.is_idle)
+
+            except sqlite3.OperationalError as e:
+                print(f"Failed tiles database maintenance because of {e}")
+
+    def get_tile_statistics(self) -> dict:
+        """Returns stored tiles per server and zoom, their size and where requested tiles were found since start"""
+        statistics = {"cache": self.tile_cache_counters.get_ratios(),
+                      "cached_images": len(self.tile_image_cache)}
+        if self.database_path is not None:
+            db_connection = sqlite3.connect(self.database_path, timeout=10)
+            db_cursor = db_connection.cursor()
+            statistics["tiles"] = get_tile_statistics(db_cursor)
+            statistics["bytes"] = get_tiles_size(db_cursor)
+            db_connection.close()
+        return statistics
+
+    def vacuum_tiles_database(self) -> Union[Tuple[int, int], None]:
+        """Rebuilds the tiles database once so idle maintenance can compact it, returns its (old, new) size in bytes,
+        tiles are not saved until it is done"""
+        if self.database_path is None:
+            return None
+        self.tile_access.flush()
+        return vacuum_tiles_database(self.database_path)
+
+    def load_tile_coverage(self):
+        """Scans stored tiles of the current server once in background, later writes are added as they happen"""
+        server = self.tile_server
+        if self.tile_coverage.is_loaded(server):
+            return
+
+        def load():
+            try:
+                self.tile_coverage.load(server)
+            except sqlite3.OperationalError as e:
+                print(f"Failed to load tile coverage because of {e}")
+                self.tile_coverage.forget(server)
+
+        threading.Thread(daemon=True, target=load).start()
+
+    def show_tile_coverage(self, show: bool = True):
+        """Shows stored tiles of the current server and zoom over the map"""
+        if self.tile_coverage is None:
+            return
+
+        if show and self.canvas_tile_coverage is None:
+            self.canvas_tile_coverage = CanvasTileCoverage(self, self.tile_coverage)
+            self.load_tile_coverage()
+            self.canvas_tile_coverage.draw()
+        elif not show and self.canvas_tile_coverage is not None:
+            self.canvas_tile_coverage.delete()
+            self.canvas_tile_coverage = None
+
+    def get_tile_image_from_cache(self, zoom: int, x: int, y: int, count: bool = True):
         if f"{zoom} {x} {y}" not in self.tile_image_cache:
             return False
         else:
+            if count:
+                self.tile_cache_counters.count("memory")
             return self.tile_image_cache[f"{zoom} {x} {y}"]
 
     def load_images_background(self):
@@ -1087,7 +1606,8 @@ class TkinterMapView(tkinter.Frame):
                 x, y = task[0][1], task[0][2]
                 canvas_tile = task[1]
 
-                image = self.get_tile_image_from_cache(zoom, x, y)
+                # the tile was counted when it was queued
+                image = self.get_tile_image_from_cache(zoom, x, y, count=False)
                 if image is False:
                     image = self.request_image(zoom, x, y, db_cursor=db_cursor)
                     if image is None:
@@ -1117,6 +1637,13 @@ class TkinterMapView(tkinter.Frame):
             if zoom == round(self.zoom):
                 canvas_tile.set_image(image)
 
+        # coverage changes with loading and saving tiles, while many tiles are saved it is redrawn now and then
+        if (self.canvas_tile_coverage is not None
+                and self.canvas_tile_coverage.rendered_key != (self.tile_server, round(self.zoom), self.tile_coverage.version)
+                and time.time() - self.tile_coverage_redraw_time >= TILE_COVERAGE_REDRAW_INTERVAL):
+            self.tile_coverage_redraw_time = time.time()
+            self.canvas_tile_coverage.draw()
+
         # This function calls itself every 10 ms with tk.after() so that the image updates come
         # from the main GUI thread, because tkinter can only be updated from the main thread.
         if self.running:
@@ -1287,6 +1814,8 @@ class TkinterMapView(tkinter.Frame):
                 polygon.draw(move=not called_after_zoom)
             if self.region_polygon is not None:
                 self.region_polygon.draw(move=not called_after_zoom)
+            if self.canvas_tile_coverage is not None:
+                self.canvas_tile_coverage.draw()
 
             self.initiate_filtering()
 
@@ -1453,6 +1982,7 @@ class TkinterMapView(tkinter.Frame):
             self.last_zoom = round(self.zoom)
 
     def mouse_zoom(self, event):
+        self.last_interaction_time = time.time()
         relative_mouse_x = event.x / self.width  # mouse pointer position on map (x=[0..1], y=[0..1])
         relative_mouse_y = event.y / self.height
 
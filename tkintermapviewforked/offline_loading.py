@@ -8,10 +8,11 @@ import math
 from PIL import Image, UnidentifiedImageError
 
 from .utility_functions import decimal_to_osm, osm_to_decimal
+from .tile_storage import update_tiles_database, insert_tiles, TileCoverage
 
 
 class OfflineLoader:
-    def __init__(self, path=None, tile_server=None, max_zoom=19):
+    def __init__(self, path=None, tile_server=None, max_zoom=19, coverage: TileCoverage = None):
         if path is None:
             self.db_path = os.path.join(os.path.abspath(os.getcwd()), "offline_tiles.db")
         else:
@@ -23,6 +24,8 @@ class OfflineLoader:
             self.tile_server = tile_server
 
         self.max_zoom = max_zoom
+        # tile coverage of a map widget using the same database, seeded tiles appear in its overlay
+        self.coverage = coverage
 
         self.task_queue = []
         self.result_queue = []
@@ -131,6 +134,7 @@ class OfflineLoader:
         db_cursor.execute(create_server_table)
         db_cursor.execute(create_tiles_table)
         db_cursor.execute(create_sections_table)
+        update_tiles_database(db_cursor)
         db_connection.commit()
 
         # check if section is already in database
@@ -182,9 +186,9 @@ class OfflineLoader:
                     result_counter += 1
 
                     if loading_result[-1] is not None:
-                        insert_tile_cmd = """INSERT INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);"""
                         try:
-                            db_cursor.execute(insert_tile_cmd, loading_result)
+                            insert_tiles(db_cursor, [loading_result], replace=False, pinned=True,
+                                         coverage=self.coverage)
                         except sqlite3.OperationalError as e:
                             print()
                             print(f"Failed to finish downloading because of {e}")
@@ -204,6 +208,13 @@ class OfflineLoader:
 
             print(f" {result_counter:>8} tiles loaded")
 
+            # Seeded sections are kept out of eviction, tiles which were already cached too
+            db_cursor.execute("UPDATE tiles SET pinned=1 WHERE server=? AND zoom=? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?;",
+                              (self.tile_server, zoom,
+                               math.floor(upper_left_tile_pos[0]), math.ceil(lower_right_tile_pos[0]),
+                               math.floor(upper_left_tile_pos[1]), math.ceil(lower_right_tile_pos[1])))
+            db_connection.commit()
+
         print("", end="\n\n")
 
         # insert loading section in database
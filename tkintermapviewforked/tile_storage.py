@@ -0,0 +1,414 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Union
+
+import numpy
+
+# Tile images are stored once per content in tile_blobs, tiles reference them by tile_hash
+# and keep an empty tile_image, tiles saved before keep their image in tile_image until migrated
+TILE_STORAGE_COMMANDS = (
+    """CREATE TABLE IF NOT EXISTS tile_blobs (
+                        hash BLOB PRIMARY KEY NOT NULL,
+                        data BLOB NOT NULL);""",
+)
+
+SELECT_TILE = """SELECT coalesce(b.data, t.tile_image), t.tile_hash FROM tiles t LEFT JOIN tile_blobs b ON b.hash = t.tile_hash
+                  WHERE t.zoom=? AND t.x=? AND t.y=? AND t.server=?;"""
+
+EMPTY_TILE_IMAGE = b""
+
+# Coverage bitmaps of zooms above this one have a cell per tile of this zoom, 1024x1024 cells
+COVERAGE_MAX_ZOOM = 10
+
+# Columns added to tiles, last_access is time of the last read of the tile,
+# pinned tiles are seeded by OfflineLoader or sliced from EE images and never evicted
+TILES_COLUMNS = (
+    ("tile_hash", "BLOB"),
+    ("last_access", "REAL NOT NULL DEFAULT 0"),
+    ("pinned", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+
+def update_tiles_database(cursor: sqlite3.Cursor):
+    """ creates the blobs table and the hash column of tiles if there are none """
+    for command in TILE_STORAGE_COMMANDS:
+        cursor.execute(command)
+    cursor.execute("PRAGMA table_info(tiles);")
+    columns = [row[1] for row in cursor.fetchall()]
+    for column, definition in TILES_COLUMNS:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE tiles ADD COLUMN {column} {definition};")
+    cursor.execute("CREATE INDEX IF NOT EXISTS tiles_tile_hash ON tiles (tile_hash);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (pinned, last_access);")
+    enable_incremental_vacuum(cursor)
+
+
+def enable_incremental_vacuum(cursor: sqlite3.Cursor):
+    """ turns on incremental vacuum of a database without tiles, it takes a VACUUM which is instant while the
+        database is empty, filled databases are switched only by vacuum_tiles_database on request """
+
+    cursor.execute("PRAGMA auto_vacuum;")
+    if cursor.fetchone()[0] == 2 or cursor.connection.in_transaction:
+        return
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM tiles) OR EXISTS(SELECT 1 FROM tile_blobs);")
+    if cursor.fetchone()[0]:
+        return
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    cursor.execute("VACUUM;")
+
+
+def hash_tile(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def insert_tiles(cursor: sqlite3.Cursor, tiles, replace: bool = True, pinned: bool = False,
+                 coverage: "TileCoverage" = None):
+    """ saves (zoom, x, y, server, image data) tiles storing each distinct image once,
+        existing tiles are replaced unless replace is False, then sqlite3.IntegrityError is raised for them,
+        saved tiles are marked in coverage if it is given """
+
+    rows = []
+    blobs = {}
+    now = time.time()
+    for zoom, x, y, server, data in tiles:
+        tile_hash = hash_tile(data)
+        blobs[tile_hash] = data
+        rows.append((zoom, x, y, server, EMPTY_TILE_IMAGE, tile_hash, now, int(pinned)))
+
+    cursor.executemany("INSERT OR IGNORE INTO tile_blobs (hash, data) VALUES (?, ?);", blobs.items())
+    cursor.executemany(f"INSERT {'OR REPLACE ' if replace else ''}INTO tiles (zoom, x, y, server, tile_image, tile_hash, last_access, pinned) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                       rows)
+    if coverage is not None:
+        coverage.add_tiles([row[:4] for row in rows])
+
+
+def select_tile(cursor: sqlite3.Cursor, zoom: int, x: int, y: int, server: str) -> Union[tuple, None]:
+    """ returns (image data, hash) of a tile, hash is None for tiles which are not migrated yet """
+
+    cursor.execute(SELECT_TILE, (zoom, x, y, server))
+    return cursor.fetchone()
+
+
+def delete_unreferenced_blobs(cursor: sqlite3.Cursor, hashes=None) -> int:
+    """ deletes blobs no tile references, only of hashes if they are given,
+        then returns bytes of deleted blobs """
+
+    if hashes is None:
+        cursor.execute("DELETE FROM tile_blobs WHERE hash NOT IN (SELECT tile_hash FROM tiles WHERE tile_hash IS NOT NULL);")
+        return 0
+
+    freed = 0
+    for tile_hash in set(hashes):
+        if tile_hash is None:
+            continue
+        cursor.execute("SELECT length(data) FROM tile_blobs WHERE hash=? AND NOT EXISTS (SELECT 1 FROM tiles WHERE tile_hash=?);",
+                       (tile_hash, tile_hash))
+        result = cursor.fetchone()
+        if result is not None:
+            cursor.execute("DELETE FROM tile_blobs WHERE hash=?;", (tile_hash,))
+            freed += result[0]
+    return freed
+
+
+def get_tiles_size(cursor: sqlite3.Cursor, server: str = None) -> int:
+    """ returns bytes of tile images, of all servers together with shared images counted once,
+        or of the server with its shared images counted for each tile """
+
+    if server is not None:
+        cursor.execute("""SELECT coalesce(sum(length(coalesce(b.data, t.tile_image))), 0)
+                            FROM tiles t LEFT JOIN tile_blobs b ON b.hash = t.tile_hash WHERE t.server=?;""", (server,))
+        return cursor.fetchone()[0]
+
+    cursor.execute("SELECT coalesce(sum(length(data)), 0) FROM tile_blobs;")
+    size = cursor.fetchone()[0]
+    cursor.execute("SELECT coalesce(sum(length(tile_image)), 0) FROM tiles;")
+    return size + cursor.fetchone()[0]
+
+
+def evict_tiles(path: str, max_bytes: int, server: str = None, batch_size: int = 500) -> int:
+    """ deletes least recently used tiles which are not pinned, of the server or of all servers,
+        until their images take at most max_bytes as get_tiles_size counts them, returns number of deleted tiles """
+
+    db_connection = sqlite3.connect(path, timeout=10)
+    db_cursor = db_connection.cursor()
+    size = get_tiles_size(db_cursor, server)
+    deleted = 0
+    while size > max_bytes:
+        db_cursor.execute(f"""SELECT t.rowid, t.tile_hash, length(t.tile_image), coalesce(length(b.data), 0)
+                                FROM tiles t LEFT JOIN tile_blobs b ON b.hash = t.tile_hash
+                               WHERE t.pinned=0 {'AND t.server=?' if server is not None else ''}
+                               ORDER BY t.last_access LIMIT ?;""",
+                          (server, batch_size) if server is not None else (batch_size,))
+        rows = db_cursor.fetchall()
+        if not rows:
+            print("Tiles over quota are pinned")
+            break
+
+        # Only as many tiles as are over quota, shared images may free less, then the next batch follows
+        excess = size - max_bytes
+        for count, (_, _, image_size, blob_size) in enumerate(rows, 1):
+            excess -= image_size + blob_size
+            if excess <= 0:
+                rows = rows[:count]
+                break
+
+        db_cursor.executemany("DELETE FROM tiles WHERE rowid=?;", [(row[0],) for row in rows])
+        freed = delete_unreferenced_blobs(db_cursor, [row[1] for row in rows])
+        db_connection.commit()
+        deleted += len(rows)
+
+        # Shared images are counted for each tile of a server, but only once for all servers
+        if server is not None:
+            size -= sum(image_size + blob_size for _, _, image_size, blob_size in rows)
+        else:
+            size -= sum(image_size for _, _, image_size, _ in rows) + freed
+
+    db_connection.close()
+    return deleted
+
+
+def compact_tiles_database(path: str, pages: int = 256, is_idle=None) -> int:
+    """ returns free pages of the database to the file system a few pages per transaction
+        while is_idle() is true, returns number of pages left free
+        Databases filled before incremental vacuum was turned on are left as they are,
+        a full VACUUM locks the database for long, so it is only done by vacuum_tiles_database """
+
+    db_connection = sqlite3.connect(path, timeout=10)
+    db_cursor = db_connection.cursor()
+    db_cursor.execute("PRAGMA auto_vacuum;")
+    is_incremental = db_cursor.fetchone()[0] == 2
+
+    while True:
+        db_cursor.execute("PRAGMA freelist_count;")
+        free_pages = db_cursor.fetchone()[0]
+        if not is_incremental or not free_pages or (is_idle is not None and not is_idle()):
+            break
+        db_cursor.execute(f"PRAGMA incremental_vacuum({int(pages)});")
+        db_cursor.fetchall()
+
+    db_connection.close()
+    return free_pages
+
+
+def vacuum_tiles_database(path: str) -> tuple:
+    """ rebuilds the database with incremental vacuum turned on and returns its (old, new) size in bytes,
+        the database is locked until it is done, which takes minutes for large ones """
+
+    db_connection = sqlite3.connect(path, timeout=10)
+    db_cursor = db_connection.cursor()
+    db_cursor.execute("PRAGMA page_size;")
+    page_size = db_cursor.fetchone()[0]
+    db_cursor.execute("PRAGMA page_count;")
+    old_size = db_cursor.fetchone()[0] * page_size
+
+    db_cursor.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    db_cursor.execute("VACUUM;")
+
+    db_cursor.execute("PRAGMA page_count;")
+    new_size = db_cursor.fetchone()[0] * page_size
+    db_connection.close()
+    return old_size, new_size
+
+
+class TileAccessRecorder:
+    """ Collects reads of stored tiles and writes their last_access in batches
+        instead of a write per read """
+
+    def __init__(self, path: str, flush_interval: float = 30.0, max_pending: int = 1000):
+        self.db_path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}  # (zoom, x, y, server) -> time of the last read
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, zoom: int, x: int, y: int, server: str):
+        with self.lock:
+            self.pending[(zoom, x, y, server)] = time.time()
+            is_due = (len(self.pending) >= self.max_pending
+                      or time.time() - self.last_flush >= self.flush_interval)
+        if is_due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.last_flush = time.time()
+        if not pending:
+            return
+
+        db_connection = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            db_connection.executemany("UPDATE tiles SET last_access=? WHERE zoom=? AND x=? AND y=? AND server=?;",
+                                      [(accessed, *key) for key, accessed in pending.items()])
+            db_connection.commit()
+        except sqlite3.OperationalError as e:
+            print(f"Failed to save tile access times because of {e}")
+        finally:
+            db_connection.close()
+
+
+def migrate_tiles(path: str, batch_size: int = 1000) -> tuple:
+    """ moves images of tiles saved before into tile_blobs, a batch per transaction,
+        so the map can be used meanwhile, returns (migrated tiles, distinct images) """
+
+    db_connection = sqlite3.connect(path, timeout=10)
+    db_cursor = db_connection.cursor()
+    update_tiles_database(db_cursor)
+    db_connection.commit()
+
+    migrated = 0
+    while True:
+        db_cursor.execute("SELECT rowid, tile_image FROM tiles WHERE tile_hash IS NULL LIMIT ?;", (batch_size,))
+        rows = db_cursor.fetchall()
+        if not rows:
+            break
+
+        blobs = {}
+        updates = []
+        for rowid, data in rows:
+            tile_hash = hash_tile(data)
+            blobs[tile_hash] = data
+            updates.append((EMPTY_TILE_IMAGE, tile_hash, rowid))
+        db_cursor.executemany("INSERT OR IGNORE INTO tile_blobs (hash, data) VALUES (?, ?);", blobs.items())
+        db_cursor.executemany("UPDATE tiles SET tile_image=?, tile_hash=? WHERE rowid=?;", updates)
+        db_connection.commit()
+        migrated += len(rows)
+
+    db_cursor.execute("SELECT count(*) FROM tile_blobs;")
+    distinct = db_cursor.fetchone()[0]
+    db_connection.close()
+
+    if migrated:
+        print("Moved", migrated, "tiles into", distinct, "distinct images")
+    return migrated, distinct
+
+
+class TileStatistics(NamedTuple):
+    server: str
+    zoom: int
+    tiles: int
+    bytes: int  # shared images are counted for each tile
+    pinned: int
+    oldest_access: Union[float, None]  # None if no tile was read or saved since access times are kept
+    newest_access: Union[float, None]
+
+
+def get_tile_statistics(cursor: sqlite3.Cursor) -> list:
+    """ returns TileStatistics of every server and zoom in the tiles database """
+
+    cursor.execute("""SELECT t.server, t.zoom, count(*), coalesce(sum(length(coalesce(b.data, t.tile_image))), 0),
+                             sum(t.pinned), min(nullif(t.last_access, 0)), max(nullif(t.last_access, 0))
+                        FROM tiles t LEFT JOIN tile_blobs b ON b.hash = t.tile_hash
+                       GROUP BY t.server, t.zoom ORDER BY t.server, t.zoom;""")
+    return [TileStatistics(*row) for row in cursor.fetchall()]
+
+
+class TileCacheCounters:
+    """ Counts where requested map tiles were found while the map runs """
+
+    SOURCES = ("memory", "database", "server", "missing")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.SOURCES, 0)
+        self.lock = threading.Lock()
+
+    def count(self, source: str):
+        with self.lock:
+            self.counts[source] += 1
+
+    def get_ratios(self) -> dict:
+        """ returns {source: (count, share of all requests)} """
+        with self.lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        return {source: (count, count / total if total else 0.0) for source, count in counts.items()}
+
+
+class TileCoverage:
+    """ Per server and zoom bitmaps of stored tiles, bitmaps of zooms above max_zoom have cells of max_zoom
+        tiles set if any tile inside the cell is stored. A server is scanned once when it is loaded,
+        then writes of the map are added as they happen, so drawing never queries the database """
+
+    def __init__(self, path: str, max_zoom: int = COVERAGE_MAX_ZOOM):
+        self.db_path = path
+        self.max_zoom = max_zoom
+        self.bitmaps = {}  # server -> {zoom: bool array [y, x]}
+        self.version = 0  # changes with every set cell
+        self.lock = threading.Lock()
+
+    def get_bitmap_zoom(self, zoom: int) -> int:
+        return min(zoom, self.max_zoom)
+
+    def is_loaded(self, server: str) -> bool:
+        return server in self.bitmaps
+
+    def load(self, server: str, batch_size: int = 100_000):
+        """ builds bitmaps of the server scanning its tiles once """
+
+        # Tiles written during the scan are added to the bitmaps the scan is merged into
+        with self.lock:
+            self.bitmaps.setdefault(server, {})
+
+        db_connection = sqlite3.connect(self.db_path, timeout=10)
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("SELECT zoom, x, y FROM tiles WHERE server=?;", (server,))
+        while True:
+            rows = db_cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            tiles = numpy.array(rows, dtype=numpy.int64)
+            with self.lock:
+                bitmaps = self.bitmaps.setdefault(server, {})
+                for zoom in numpy.unique(tiles[:, 0]).tolist():
+                    zoom_tiles = tiles[tiles[:, 0] == zoom]
+                    shift = zoom - self.get_bitmap_zoom(zoom)
+                    bitmap = self.get_or_create(bitmaps, zoom)
+                    bitmap[zoom_tiles[:, 2] >> shift, zoom_tiles[:, 1] >> shift] = True
+                self.version += 1
+        db_connection.close()
+
+    def get_or_create(self, bitmaps: dict, zoom: int) -> numpy.ndarray:
+        if zoom not in bitmaps:
+            size = 2 ** self.get_bitmap_zoom(zoom)
+            bitmaps[zoom] = numpy.zeros((size, size), dtype=bool)
+        return bitmaps[zoom]
+
+    def add_tiles(self, tiles):
+        """ marks saved (zoom, x, y, server) tiles, servers which are not loaded are skipped,
+            version changes once if any cell is set """
+
+        with self.lock:
+            changed = False
+            for zoom, x, y, server in tiles:
+                bitmaps = self.bitmaps.get(server)
+                if bitmaps is None:
+                    continue
+                shift = zoom - self.get_bitmap_zoom(zoom)
+                bitmap = self.get_or_create(bitmaps, zoom)
+                if not bitmap[y >> shift, x >> shift]:
+                    bitmap[y >> shift, x >> shift] = True
+                    changed = True
+            if changed:
+                self.version += 1
+
+    def get(self, server: str, zoom: int) -> Union[tuple, None]:
+        """ returns (bitmap zoom, bitmap) of stored tiles of the zoom, None if there are none or server is not loaded """
+
+        bitmaps = self.bitmaps.get(server)
+        if bitmaps is None or zoom not in bitmaps:
+            return None
+        return self.get_bitmap_zoom(zoom), bitmaps[zoom]
+
+    def forget(self, server: str = None):
+        """ drops bitmaps of the server or of all servers, e.g. after tiles were deleted, they are loaded again on demand """
+
+        with self.lock:
+            if server is None:
+                self.bitmaps = {}
+            else:
+                self.bitmaps.pop(server, None)
+            self.version += 1
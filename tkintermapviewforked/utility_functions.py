@@ -1,7 +1,8 @@
-import geocoder
 import math
 from typing import Union
 
+from .lazy_imports import get_geocoder
+
 
 def decimal_to_osm(lat_deg: float, lon_deg: float, zoom: int) -> tuple:
     """ converts decimal coordinates to internal OSM coordinates"""
@@ -26,29 +27,88 @@ def osm_to_decimal(tile_x: Union[int, float], tile_y: Union[int, float], zoom: i
     return lat_deg, lon_deg
 
 
-def convert_coordinates_to_address(deg_x: float, deg_y: float) -> geocoder.osm_reverse.OsmReverse:
+def subtract_rectangles(rectangle: tuple, holes: list, min_size: float = 0.0) -> list:
+    """ returns rectangles (top, left, bottom, right) covering the part of rectangle which is not covered by holes,
+        uncovered cells of the grid made by all edges are merged into few rectangles,
+        rectangles thinner than min_size are dropped """
+
+    top, bottom = max(rectangle[0], rectangle[2]), min(rectangle[0], rectangle[2])
+    left, right = min(rectangle[1], rectangle[3]), max(rectangle[1], rectangle[3])
+
+    lats = {top, bottom}
+    lons = {left, right}
+    clipped = []
+    for hole in holes:
+        hole_top = min(max(hole[0], hole[2]), top)
+        hole_bottom = max(min(hole[0], hole[2]), bottom)
+        hole_left = max(min(hole[1], hole[3]), left)
+        hole_right = min(max(hole[1], hole[3]), right)
+        if hole_top <= hole_bottom or hole_right <= hole_left:
+            continue
+        clipped.append((hole_top, hole_left, hole_bottom, hole_right))
+        lats.update((hole_top, hole_bottom))
+        lons.update((hole_left, hole_right))
+
+    lats = sorted(lats, reverse=True)
+    lons = sorted(lons)
+
+    rectangles = []
+    runs = {}  # (first column, last column) -> first row of the rectangle growing down
+    for row in range(len(lats) - 1):
+        center_lat = (lats[row] + lats[row + 1]) / 2
+        row_runs = []
+        column = 0
+        while column < len(lons) - 1:
+            start = column
+            while column < len(lons) - 1 and not any(
+                    hole[2] < center_lat < hole[0] and hole[1] < (lons[column] + lons[column + 1]) / 2 < hole[3]
+                    for hole in clipped):
+                column += 1
+            if column > start:
+                row_runs.append((start, column))
+            column += 1
+
+        for run in list(runs):
+            if run not in row_runs:
+                rectangles.append((lats[runs.pop(run)], lons[run[0]], lats[row], lons[run[1]]))
+        for run in row_runs:
+            runs.setdefault(run, row)
+
+    for run, first_row in runs.items():
+        rectangles.append((lats[first_row], lons[run[0]], lats[-1], lons[run[1]]))
+
+    return [r for r in rectangles if r[0] - r[2] >= min_size and r[3] - r[1] >= min_size]
+
+
+def rectangles_area(rectangles: list) -> float:
+    """ returns sum of areas of (top, left, bottom, right) rectangles in square degrees """
+
+    return sum(abs(r[0] - r[2]) * abs(r[3] - r[1]) for r in rectangles)
+
+
+def convert_coordinates_to_address(deg_x: float, deg_y: float) -> "geocoder.osm_reverse.OsmReverse":
     """ returns address object with the following attributes:
         street, housenumber, postal, city, state, country, latlng
         Geocoder docs: https://geocoder.readthedocs.io/api.html#reverse-geocoding """
 
-    result = geocoder.osm([deg_x, deg_y], method="reverse")
+    result = get_geocoder().osm([deg_x, deg_y], method="reverse")
     return result
 
 
 def convert_coordinates_to_city(deg_x: float, deg_y: float) -> str:
     """ returns city name """
-    return geocoder.osm([deg_x, deg_y], method="reverse").city
+    return get_geocoder().osm([deg_x, deg_y], method="reverse").city
 
 
 def convert_coordinates_to_country(deg_x: float, deg_y: float) -> str:
     """ returns country name """
-    return geocoder.osm([deg_x, deg_y], method="reverse").country
+    return get_geocoder().osm([deg_x, deg_y], method="reverse").country
 
 
 def convert_address_to_coordinates(address_string: str) -> tuple:
     """ returns address object for given coords or None if no address found """
 
-    result = geocoder.osm(address_string)
+    result = get_geocoder().osm(address_string)
 
     if result.ok:
         return tuple(result.latlng)